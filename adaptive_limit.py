@@ -0,0 +1,403 @@
+''' Adaptive limit of the requests in flight to each BMC.
+
+BMC web servers (ILO 4 and the older IDRACs above all) slow down sharply or
+answer 503 when they get too many requests at once, and how many is too
+many depends on the model and firmware. Each host gets an AIMD limiter:
+
+    latency flat       the limit grows by one per window of requests, while
+                       the requests use all of it
+    latency rising     the limit shrinks by LATENCY_BACKOFF
+    503, 429, timeout  the limit is cut by BACKOFF, the request waits
+    or Retry-After     (Retry-After, RETRY_DELAY by default) and is retried
+
+A window is as many requests as the limit, the latency is flat while the
+mean of a window stays within LATENCY_TOLERANCE of the baseline: the average
+latency of the requests sent alone, which follows a BMC that really got
+slower. A limit that got throttled is not tried again for CEILING_TIME.
+The learned limits are kept per host for the process and saved per BMC
+model and firmware in 'hc limits.json', so the next sweeps (and the servers
+of the same model) start from them.
+'''
+
+import os
+import json
+import time
+import asyncio
+import threading
+import email.utils
+
+import fanout
+import host_guard
+
+# Bounds and start of the limit of the requests in flight
+MIN_LIMIT = 1
+MAX_LIMIT = 16
+INITIAL_LIMIT = fanout.MAX_INFLIGHT
+# Smallest window of requests between two increases
+MIN_WINDOW = 4
+# Latency is flat while the mean of a window is below baseline * LATENCY_TOLERANCE
+LATENCY_TOLERANCE = 1.5
+# Weight of a new latency in the baseline
+BASELINE_WEIGHT = 0.2
+# Multiplicative decreases: throttled or timed out, latency rising
+BACKOFF = 0.5
+LATENCY_BACKOFF = 0.9
+# Seconds a throttled limit is not tried again
+CEILING_TIME = 60
+# Http statuses of a throttled request, retried up to RETRIES times
+THROTTLE_STATUSES = (429, 503)
+RETRIES = 2
+# Seconds to wait before a retry without Retry-After, and at most with it
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+# Learned limits, per BMC model and firmware
+LIMITS_FILE = 'hc limits.json'
+
+
+def retry_after(response):
+    ''' Seconds of the Retry-After header of a response (delay or http
+    date), None without one.'''
+
+    value = response.getheader('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return RETRY_DELAY
+
+
+class AimdLimiter(object):
+    ''' Limit of the requests in flight to one BMC, see the module
+    docstring. Threads wait in acquire, tasks in acquire_async; every
+    acquire is followed by a release of its token with the outcome of the
+    request.'''
+
+    def __init__(self, limit=INITIAL_LIMIT, minLimit=MIN_LIMIT, maxLimit=MAX_LIMIT):
+        self.limit = float(min(max(limit, minLimit), maxLimit))
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.inflight = 0
+        # Latency of the requests sent alone, seconds
+        self.baseline = None
+        # (vendor, model, firmware) of the BMC, see identify
+        self.key = None
+        self.learned = False
+        self.stats = {'requests': 0, 'throttled': 0, 'failed': 0, 'increases': 0, 'decreases': 0}
+        self._started = 0
+        self._cutAt = 0
+        self._window = []
+        self._saturated = False
+        self._holdUntil = 0
+        # Limit that got throttled, not tried again until its time
+        self._ceiling = (None, 0)
+        self._condition = threading.Condition()
+        self._waiters = []
+
+    def _try_acquire(self):
+        # Called with the lock held, returns the token of the request
+        # (sequence number, sent alone) or None when it has to wait
+        if self.inflight >= int(self.limit) or time.monotonic() < self._holdUntil:
+            return None
+        self.inflight += 1
+        self._started += 1
+        if self.inflight >= int(self.limit):
+            self._saturated = True
+        return (self._started, self.inflight == 1)
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                token = self._try_acquire()
+                if token is not None:
+                    return token
+                hold = self._holdUntil - time.monotonic()
+                self._condition.wait(hold if hold > 0 else None)
+
+    async def acquire_async(self):
+        while True:
+            with self._condition:
+                token = self._try_acquire()
+                if token is not None:
+                    return token
+                hold = self._holdUntil - time.monotonic()
+                if hold <= 0:
+                    waiter = asyncio.get_running_loop().create_future()
+                    self._waiters.append(waiter)
+            if hold > 0:
+                await asyncio.sleep(hold)
+                continue
+            try:
+                await waiter
+            finally:
+                with self._condition:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+
+    def _wake(self):
+        # Called with the lock held
+        self._condition.notify_all()
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.get_loop().call_soon_threadsafe(_set_done, waiter)
+        self._waiters = []
+
+    def release(self, token, latency, throttled=False, failed=False, delay=None):
+        ''' Ends a request: latency in seconds, throttled for a 503/429 or a
+        Retry-After, failed for a timeout or a connection error, delay is
+        the Retry-After in seconds.'''
+
+        sequence, alone = token
+        with self._condition:
+            self.inflight -= 1
+            self.stats['requests'] += 1
+            if throttled or failed:
+                self.stats['throttled' if throttled else 'failed'] += 1
+                # Requests sent before the last cut do not cut again
+                if sequence > self._cutAt:
+                    self._cutAt = self._started
+                    self._ceiling = (int(self.limit), time.monotonic() + CEILING_TIME)
+                    self._decrease(BACKOFF)
+                if delay is not None:
+                    self._holdUntil = max(self._holdUntil, time.monotonic() + min(delay, MAX_RETRY_DELAY))
+            else:
+                if alone:
+                    self.baseline = latency if self.baseline is None else \
+                        self.baseline + (latency - self.baseline) * BASELINE_WEIGHT
+                self._window.append(latency)
+                if len(self._window) >= max(int(self.limit), MIN_WINDOW):
+                    self._adjust()
+            self._wake()
+
+    def start_from(self, limit):
+        ''' Sets the limit, unless the limiter already learned one.'''
+
+        with self._condition:
+            if not self.learned:
+                self.limit = float(min(max(limit, self.minLimit), self.maxLimit))
+                self._wake()
+
+    def _decrease(self, factor):
+        self.limit = max(self.minLimit, self.limit * factor)
+        self.stats['decreases'] += 1
+        self._window = []
+        self._saturated = False
+
+    def _adjust(self):
+        # End of a window, called with the lock held
+        mean = sum(self._window) / len(self._window)
+        if self.baseline is None:
+            self.baseline = min(self._window)
+        ceiling, until = self._ceiling
+        maxLimit = min(self.maxLimit, ceiling - 1) if ceiling and time.monotonic() < until else self.maxLimit
+        if mean > self.baseline * LATENCY_TOLERANCE:
+            self._decrease(LATENCY_BACKOFF)
+        elif self._saturated and self.limit + 1 <= maxLimit:
+            self.limit += 1
+            self.stats['increases'] += 1
+        self.learned = True
+        self._window = []
+        self._saturated = False
+
+
+def _set_done(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class LimitStore(object):
+    ''' Learned limits saved in a json file: per BMC model and firmware, and
+    the model and firmware of each host. Written atomically.'''
+
+    def __init__(self, path=LIMITS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as limitsFile:
+                return json.load(limitsFile)
+        except (OSError, ValueError):
+            return {'models': {}, 'hosts': {}}
+
+    @staticmethod
+    def _name(key):
+        return ' / '.join(str(part) for part in key)
+
+    def limit_of(self, key=None, host=None):
+        ''' Learned limit of a BMC model and firmware, or of the model and
+        firmware a host had last time, None when there is none.'''
+
+        limits = self._load()
+        if key is None:
+            key = limits['hosts'].get(host)
+            if key is None:
+                return None
+        return limits['models'].get(self._name(key))
+
+    def save(self, host, key, limit):
+        tmpPath = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.get_ident())
+        with self._lock:
+            limits = self._load()
+            limits['hosts'][host] = list(key)
+            limits['models'][self._name(key)] = round(limit, 2)
+            try:
+                with open(tmpPath, 'w') as limitsFile:
+                    json.dump(limits, limitsFile, indent=2, sort_keys=True)
+                os.replace(tmpPath, self.path)
+            except OSError:
+                pass
+
+
+_defaultStore = None
+_limiters = {}
+_defaultLock = threading.Lock()
+
+
+def default_store():
+    ''' Store shared by all the limiters of the process.'''
+
+    global _defaultStore
+    with _defaultLock:
+        if _defaultStore is None:
+            _defaultStore = LimitStore()
+    return _defaultStore
+
+
+def limiter_for(host):
+    ''' Limiter of a host, kept for the process so the limit learned by a
+    sweep carries over to the next ones. A new limiter starts from the limit
+    saved for the model and firmware of the host.'''
+
+    with _defaultLock:
+        limiter = _limiters.get(host)
+    if limiter is not None:
+        return limiter
+    limit = default_store().limit_of(host=host)
+    with _defaultLock:
+        return _limiters.setdefault(host, AimdLimiter(limit or INITIAL_LIMIT))
+
+
+def _failed(error):
+    return host_guard.failure_kind(error) == 'unreachable'
+
+
+class AdaptiveConnection(object):
+    ''' Wraps a redfish connection so that the requests in flight to the BMC
+    are bounded by the AIMD limiter of the host. Throttled requests are
+    retried, see the module docstring. Each attempt is paced by pacer, when
+    set (see rate_limit.limited), after it gets its slot and before its
+    latency is timed. Everything but get is passed through to the wrapped
+    connection.'''
+
+    def __init__(self, connection, host, limiter):
+        self.connection = connection
+        self.host = host
+        self.limiter = limiter
+        self.pacer = None
+
+    @property
+    def maxLimit(self):
+        return self.limiter.maxLimit
+
+    def _outcome(self, response, attempt):
+        delay = retry_after(response)
+        throttled = response.status in THROTTLE_STATUSES
+        retry = throttled and attempt < RETRIES
+        if retry and delay is None:
+            delay = RETRY_DELAY
+        return throttled or delay is not None, delay, retry
+
+    def get(self, path, *args, **kwargs):
+        for attempt in range(RETRIES + 1):
+            token = self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                if self.pacer is not None:
+                    self.pacer.wait()
+                    start = time.monotonic()
+                response = self.connection.get(path, *args, **kwargs)
+            except Exception as e:
+                self.limiter.release(token, time.monotonic() - start, failed=_failed(e))
+                raise
+            if self.pacer is not None:
+                self.pacer.charge(response)
+            throttled, delay, retry = self._outcome(response, attempt)
+            self.limiter.release(token, time.monotonic() - start, throttled, delay=delay)
+            if not retry:
+                return response
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class AsyncAdaptiveConnection(AdaptiveConnection):
+    ''' Same as AdaptiveConnection, for an async_redfish client.'''
+
+    async def get(self, path, *args, **kwargs):
+        for attempt in range(RETRIES + 1):
+            token = await self.limiter.acquire_async()
+            start = time.monotonic()
+            try:
+                if self.pacer is not None:
+                    await self.pacer.wait_async()
+                    start = time.monotonic()
+                response = await self.connection.get(path, *args, **kwargs)
+            except BaseException as e:
+                self.limiter.release(token, time.monotonic() - start,
+                                     failed=isinstance(e, Exception) and _failed(e))
+                raise
+            if self.pacer is not None:
+                self.pacer.charge(response)
+            throttled, delay, retry = self._outcome(response, attempt)
+            self.limiter.release(token, time.monotonic() - start, throttled, delay=delay)
+            if not retry:
+                return response
+
+
+def adaptive(connection, host=None, limiter=None):
+    ''' Returns the connection wrapped in an AdaptiveConnection, unless one of
+    its wrappers already is one. host defaults to the base url of the client,
+    limiter to the one of the host (see limiter_for).'''
+
+    if fanout.find_wrapper(connection, AdaptiveConnection) is not None:
+        return connection
+    host = host or connection.base_url
+    limiter = limiter or limiter_for(host)
+    if asyncio.iscoroutinefunction(connection.get):
+        return AsyncAdaptiveConnection(connection, host, limiter)
+    return AdaptiveConnection(connection, host, limiter)
+
+
+def identify(connection, vendor, model, firmware):
+    ''' Tells the limiter of an adaptive connection the model and firmware
+    of its BMC. A limiter that has not learned anything yet starts from the
+    limit saved for them.'''
+
+    adaptiveConnection = fanout.find_wrapper(connection, AdaptiveConnection)
+    if adaptiveConnection is None:
+        return
+    limiter = adaptiveConnection.limiter
+    limiter.key = (vendor, model, firmware)
+    limit = default_store().limit_of(limiter.key)
+    if limit:
+        limiter.start_from(limit)
+
+
+def remember(connection):
+    ''' Saves the limit learned for the host of an adaptive connection, under
+    the model and firmware given to identify.
+
+    Output: the limiter, None for a connection that is not adaptive'''
+
+    adaptiveConnection = fanout.find_wrapper(connection, AdaptiveConnection)
+    if adaptiveConnection is None:
+        return None
+    limiter = adaptiveConnection.limiter
+    if limiter.key is not None and limiter.learned:
+        default_store().save(adaptiveConnection.host, limiter.key, limiter.limit)
+    return limiter
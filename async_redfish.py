@@ -0,0 +1,310 @@
+import ssl
+import json
+import gzip
+import zlib
+import asyncio
+from urllib.parse import urlsplit, urlencode
+import fanout
+
+# Main Uri addresses
+ROOT_URI = '/redfish/v1/'
+SESSIONS_URI = '/redfish/v1/SessionService/Sessions'
+
+# Connection defaults
+MAX_CONNECTIONS = 4
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+LOGIN_FAILURE_DELAY = 5
+
+
+def _unreachable(message):
+    # The errors are those of the redfish library, which takes longer to
+    # import than this whole client: it is only imported on a failure
+    from redfish.rest.v1 import ServerDownOrUnreachableError
+    return ServerDownOrUnreachableError(message)
+
+
+def _bad_credentials():
+    from redfish.rest.v1 import InvalidCredentialsError
+    return InvalidCredentialsError(LOGIN_FAILURE_DELAY)
+
+
+class RedfishResponse(object):
+    ''' Response returned by the async client. Mimics the RestResponse of the
+    redfish library: status, read (body text), dict (parsed json, None when
+    the body is not json) and getheader(). The json is parsed only once.'''
+
+    def __init__(self, status, headers, body, path=None):
+        self.status = status
+        self.path = path
+        self._headers = {key.lower(): value for key, value in headers.items()}
+        self._body = body
+        self._dict = None
+
+    @property
+    def read(self):
+        return self._body.decode('utf-8', 'ignore')
+
+    @property
+    def dict(self):
+        if self._dict is None and self._body:
+            try:
+                self._dict = json.loads(self._body)
+            except ValueError:
+                return None
+        return self._dict
+
+    @property
+    def session_key(self):
+        return self.getheader('x-auth-token')
+
+    @property
+    def session_location(self):
+        return self.getheader('location')
+
+    def getheader(self, name):
+        return self._headers.get(name.lower())
+
+    def getheaders(self):
+        return dict(self._headers)
+
+
+class AsyncRedfishClient(object):
+    ''' Asyncio Redfish client. Keeps a small pool of keep-alive connections
+    per BMC so several requests to the same server can be in flight, while a
+    single event loop drives many servers at once.
+
+    Same usage as redfish.RedfishClient: login(), get(uri).dict, logout(),
+    but every call is a coroutine. Connection failures and timeouts raise
+    ServerDownOrUnreachableError, bad credentials InvalidCredentialsError.'''
+
+    def __init__(self, base_url, username=None, password=None, sessionKey=None, sessionLocation=None,
+                 maxConnections=MAX_CONNECTIONS, connectTimeout=CONNECT_TIMEOUT,
+                 readTimeout=READ_TIMEOUT, sslContext=None):
+        if '://' not in base_url:
+            base_url = 'https://' + base_url
+        url = urlsplit(base_url)
+        self.base_url = base_url
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.hostHeader = url.netloc
+        self.username = username
+        self.password = password
+        self.session_key = sessionKey
+        self.session_location = sessionLocation
+        self.root = None
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        if url.scheme == 'https' and sslContext is None:
+            # BMCs ship self signed certificates, same as the redfish library
+            sslContext = ssl.create_default_context()
+            sslContext.check_hostname = False
+            sslContext.verify_mode = ssl.CERT_NONE
+        self._ssl = sslContext if url.scheme == 'https' else None
+        self._maxConnections = maxConnections
+        self._slots = None
+        self._idle = []
+
+    async def _connect(self):
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self._ssl),
+                self.connectTimeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise _unreachable('Unable to connect to {}: {!r}'.format(self.base_url, e))
+
+    def _build_request(self, method, path, args, body, headers):
+        if args:
+            path += ('&' if '?' in path else '?') + urlencode(args)
+        requestHeaders = {
+            'Host': self.hostHeader,
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'OData-Version': '4.0',
+            'Connection': 'keep-alive',
+        }
+        if self.session_key:
+            requestHeaders['X-Auth-Token'] = self.session_key
+        payload = b''
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            requestHeaders['Content-Type'] = 'application/json'
+        if payload or method in ('POST', 'PUT', 'PATCH'):
+            requestHeaders['Content-Length'] = str(len(payload))
+        requestHeaders.update(headers or {})
+        lines = ['{} {} HTTP/1.1'.format(method, path)]
+        lines += ['{}: {}'.format(key, value) for key, value in requestHeaders.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload
+
+    async def _exchange(self, reader, writer, request, method):
+        writer.write(request)
+        await writer.drain()
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise ConnectionResetError('Connection closed by server')
+        status = int(statusLine.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            headers['connection'] = 'close'
+
+        encoding = headers.get('content-encoding', '').lower()
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        keepAlive = headers.get('connection', '').lower() != 'close'
+        return status, headers, body, keepAlive
+
+    async def request(self, method, path, args=None, body=None, headers=None):
+        ''' Sends one request over a pooled connection. A kept alive connection
+        that was closed by the BMC is retried once on a fresh one.
+
+        Input: http method, uri, query args, json body and extra headers
+        Output: RedfishResponse object'''
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._maxConnections)
+        request = self._build_request(method, path, args, body, headers)
+        async with self._slots:
+            for attempt in range(2):
+                reused = attempt == 0 and bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await self._connect()
+                try:
+                    status, respHeaders, respBody, keepAlive = await asyncio.wait_for(
+                        self._exchange(reader, writer, request, method), self.readTimeout)
+                except (OSError, EOFError, ValueError, IndexError, asyncio.TimeoutError) as e:
+                    writer.close()
+                    if reused and not isinstance(e, asyncio.TimeoutError):
+                        continue
+                    raise _unreachable('{} {} failed on {}: {!r}'.format(
+                        method, path, self.base_url, e))
+                if keepAlive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                return RedfishResponse(status, respHeaders, respBody, path)
+
+    async def get(self, path, args=None, headers=None):
+        return await self.request('GET', path, args=args, headers=headers)
+
+    async def post(self, path, body, args=None, headers=None):
+        return await self.request('POST', path, args=args, body=body, headers=headers)
+
+    async def delete(self, path, headers=None):
+        return await self.request('DELETE', path, headers=headers)
+
+    async def login(self):
+        ''' Creates a Redfish session and keeps its X-Auth-Token for the next
+        requests. A client created with a session key skips the login.'''
+
+        if self.root is None:
+            resp = await self.get(ROOT_URI)
+            if resp.status != 200:
+                raise _unreachable('Server not reachable, return code: %d' % resp.status)
+            self.root = resp
+        if self.session_key:
+            return
+        try:
+            loginUri = self.root.dict['Links']['Sessions']['@odata.id']
+        except (KeyError, TypeError):
+            loginUri = SESSIONS_URI
+        resp = await self.post(loginUri, {'UserName': self.username, 'Password': self.password})
+        if resp.status not in (200, 201) or not resp.session_key:
+            raise _bad_credentials()
+        self.session_key = resp.session_key
+        location = resp.session_location
+        if location and '://' in location:
+            location = urlsplit(location).path
+        self.session_location = location
+
+    async def logout(self):
+        ''' Deletes the session (if any) and closes the pooled connections.'''
+
+        try:
+            if self.session_location:
+                await self.delete(self.session_location)
+        finally:
+            self.session_key = None
+            self.session_location = None
+            await self.close()
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+
+async def get_all(client, uris):
+    ''' Fetches a list of uris concurrently. The number of requests really
+    in flight is bounded by the connection pool of the client.
+
+    Input: async client and list of uris
+    Output: list with the responses, in the same order as the uris'''
+
+    return await asyncio.gather(*[client.get(uri) for uri in uris])
+
+
+async def get_collections(client, uris, withUris=False):
+    ''' Async version of fanout.get_collections: fetches several collections
+    and all of their members concurrently, with $expand when the BMC
+    supports it.
+
+    Input: async client, list of collection uris and whether the member uris
+    should be returned with the responses
+    Output: list with one list of member responses (or (uri, response)
+    tuples) per collection'''
+
+    root = client.root.dict if client.root is not None else (await client.get(ROOT_URI)).dict
+    query = fanout.expand_query(root)
+    if query:
+        collections = await get_all(client, [fanout.expanded_uri(uri, query) for uri in uris])
+        collections = await asyncio.gather(*[
+            client.get(uri) if collection.status != 200 else _done(collection)
+            for uri, collection in zip(uris, collections)])
+    else:
+        collections = await get_all(client, uris)
+    itemLists = [fanout.split_members(collection.dict['Members']) for collection in collections]
+    missing = [uri for items in itemLists for uri, response in items if response is None]
+    fetched = iter(await get_all(client, missing))
+    itemLists = [[(uri, response if response is not None else next(fetched)) for uri, response in items]
+                 for items in itemLists]
+    if withUris:
+        return itemLists
+    return [[response for _, response in items] for items in itemLists]
+
+
+async def get_members(client, uri, withUris=False):
+    ''' Async version of fanout.get_members.'''
+
+    return (await get_collections(client, [uri], withUris))[0]
+
+
+async def _done(value):
+    return value
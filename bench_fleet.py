@@ -0,0 +1,281 @@
+''' Fleet-scale benchmark of the healthcheck sweeps, against simulated BMCs
+(see bmc_simulator).
+
+Every run starts a fleet, sweeps it once in a child process (so its memory
+and CPU are not mixed with the simulator's) and reports the sweep time, the
+requests and bytes per host, the peak RSS of the sweep and the p50/p99 of
+the time each host was busy. Results can be written as json and saved as a
+baseline; later runs compared to the baseline fail on regressions.
+
+    python bench_fleet.py --sizes 10 100 1000 --modes threads async --json results.json
+    python bench_fleet.py --save-baseline
+    python bench_fleet.py --baseline "hc bench baseline.json"
+
+Modes:
+    threads        serversHC.create_hcfiles
+    async          serversHC.create_hcfiles_async
+    experimental   buildHC_experimental.create_hcfiles (build_healthcheck on
+                   the HC_uris mapped by health_check_map)
+    map            health_check_map.build_hc_uris
+'''
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import contextlib
+
+import bmc_simulator
+
+MODES = ('threads', 'async', 'experimental', 'map')
+DEFAULT_MODES = ('threads', 'async')
+SIZES = (10, 100, 1000, 5000)
+# Lognormal request latency of the BMCs, (median seconds, sigma)
+LATENCY_PROFILES = {
+    'none': (0, 0),
+    'lan': (0.01, 0.5),
+    'bmc': (0.12, 0.6),
+    'congested': (0.3, 1.0),
+}
+DEFAULT_PROFILE = 'bmc'
+# Fraction of the BMCs with a failing component
+FAIL_RATE = 0.05
+SEED = 1
+BASELINE_FILE = 'hc bench baseline.json'
+# Allowed growth of each metric over the baseline before it is a regression
+TOLERANCES = {
+    'requestsPerHost': 0.02,
+    'bytesPerHost': 0.05,
+    'wallTime': 0.25,
+    'hostP99': 0.5,
+}
+
+
+def percentile(values, fraction):
+    ''' Nearest-rank percentile, None without values.'''
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def peak_rss_kb():
+    ''' Peak resident memory of this process, in KiB.'''
+
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_sweep(mode):
+    ''' Runs one sweep in the current directory, which holds servers.json
+    (and serverData.json for experimental). Called in the child process.
+
+    Output: dict with the wall time, the hosts checked, the hosts that
+    failed and the peak RSS'''
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if mode == 'map':
+            import health_check_map
+            start = time.monotonic()
+            health_check_map.build_hc_uris('servers.json')
+            wallTime = time.monotonic() - start
+            with open('serverData.json') as dataFile:
+                checked, failed = len(json.load(dataFile)), 0
+        elif mode == 'experimental':
+            import buildHC_experimental
+            start = time.monotonic()
+            buildHC_experimental.create_hcfiles()
+            wallTime = time.monotonic() - start
+            checked = len(os.listdir('hc dump')) if os.path.isdir('hc dump') else 0
+            failed = len(buildHC_experimental.servers) - checked
+        else:
+            import serversHC
+            start = time.monotonic()
+            if mode == 'async':
+                results, errors = serversHC.create_hcfiles_async()
+            else:
+                results, errors = serversHC.create_hcfiles()
+            wallTime = time.monotonic() - start
+            checked, failed = len(results), len(errors)
+    return {'wallTime': wallTime, 'checked': checked, 'failed': failed, 'peakRssKb': peak_rss_kb()}
+
+
+def sweep_in_child(mode, directory):
+    ''' Runs run_sweep(mode) in a new python process working in directory.
+    Its output goes to bench.log in directory.'''
+
+    with open(os.path.join(directory, 'bench.log'), 'a') as log:
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', mode], cwd=directory,
+                               stdout=subprocess.PIPE, stderr=log, universal_newlines=True)
+    if child.returncode:
+        raise RuntimeError('{} sweep failed, see {}'.format(mode, os.path.join(directory, 'bench.log')))
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+
+def bench_fleet(size, modes=DEFAULT_MODES, profile=DEFAULT_PROFILE, failRate=FAIL_RATE, spread=True,
+                warm=False, seed=SEED, directory=None):
+    ''' Benchmarks the modes on one simulated fleet.
+
+    Input: number of BMCs, modes (see MODES), latency profile (see
+    LATENCY_PROFILES), fraction of failing BMCs, one loopback address per
+    BMC, warm (measure a second sweep, with the caches of the first one),
+    random seed, work directory (a temporary one by default)
+    Output: list of result dicts, one per mode'''
+
+    latency, sigma = LATENCY_PROFILES[profile]
+    workDir = directory or tempfile.mkdtemp(prefix='hc bench ')
+    bmcs = bmc_simulator.build_fleet(size, failRate=failRate, seed=seed, latency=latency, latencySigma=sigma)
+    simulator = bmc_simulator.Simulator(bmcs, spread=spread,
+                                        sslContext=bmc_simulator.ssl_context(directory=workDir)).start()
+    results = []
+    try:
+        mapped = None
+        for mode in modes:
+            runDir = os.path.join(workDir, '{}-{}-{}'.format(size, profile, mode))
+            os.makedirs(runDir, exist_ok=True)
+            with open(os.path.join(runDir, 'servers.json'), 'w') as serversFile:
+                json.dump(simulator.inventory(), serversFile)
+            if mode == 'experimental':
+                # Needs the HC_uris, mapped once per fleet outside the measure
+                if mapped is None:
+                    mapped = os.path.join(workDir, '{}-{}-mapping'.format(size, profile))
+                    os.makedirs(mapped, exist_ok=True)
+                    shutil.copy(os.path.join(runDir, 'servers.json'), mapped)
+                    sweep_in_child('map', mapped)
+                shutil.copy(os.path.join(mapped, 'serverData.json'), runDir)
+            if warm:
+                sweep_in_child(mode, runDir)
+                if mode == 'experimental':
+                    shutil.rmtree(os.path.join(runDir, 'hc dump'), ignore_errors=True)
+            simulator.reset()
+            sweep = sweep_in_child(mode, runDir)
+            stats = simulator.stats()
+            hostTimes = simulator.host_times()
+            results.append({
+                'mode': mode,
+                'hosts': size,
+                'profile': profile,
+                'warm': warm,
+                'wallTime': round(sweep['wallTime'], 3),
+                'hostsPerSecond': round(size / sweep['wallTime'], 2) if sweep['wallTime'] else None,
+                'checked': sweep['checked'],
+                'failed': sweep['failed'],
+                'requests': stats['requests'],
+                'requestsPerHost': round(stats['requests'] / size, 2),
+                'notModified': stats['notModified'],
+                'throttled': stats['throttled'],
+                'logins': stats['logins'],
+                'bytes': stats['bytesIn'] + stats['bytesOut'],
+                'bytesPerHost': round((stats['bytesIn'] + stats['bytesOut']) / size),
+                'peakRssKb': sweep['peakRssKb'],
+                'hostP50': round(percentile(hostTimes, 0.5) or 0, 3),
+                'hostP99': round(percentile(hostTimes, 0.99) or 0, 3),
+            })
+            print(format_result(results[-1]))
+    finally:
+        simulator.stop()
+        if directory is None:
+            shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+
+def run_key(result):
+    return '{}/{}/{}{}'.format(result['mode'], result['hosts'], result['profile'], '/warm' if result['warm'] else '')
+
+
+def format_result(result):
+    return ('{mode:<13}{hosts:>6} hosts  {wallTime:>9.2f}s  {requestsPerHost:>7.1f} req/host  '
+            '{bytesPerHost:>8} B/host  {peakRssKb:>8} KiB  p50 {hostP50:.2f}s  p99 {hostP99:.2f}s  '
+            'failed {failed}').format(**result)
+
+
+def compare(results, baseline, tolerances=TOLERANCES):
+    ''' Metrics of results that grew over their baseline by more than the
+    tolerance.
+
+    Input: result dicts and baseline ({run key: result dict})
+    Output: list of (run key, metric, baseline value, new value)'''
+
+    regressions = []
+    for result in results:
+        base = baseline.get(run_key(result))
+        if base is None:
+            continue
+        for metric, tolerance in tolerances.items():
+            if base.get(metric) is not None and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append((run_key(result), metric, base[metric], result[metric]))
+        if result['failed'] > base['failed']:
+            regressions.append((run_key(result), 'failed', base['failed'], result['failed']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the healthcheck sweeps on simulated fleets.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help='numbers of BMCs')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(DEFAULT_MODES))
+    parser.add_argument('--profile', choices=sorted(LATENCY_PROFILES), default=DEFAULT_PROFILE,
+                        help='latency distribution of the BMCs')
+    parser.add_argument('--fail-rate', type=float, default=FAIL_RATE)
+    parser.add_argument('--no-spread', action='store_true', help='all the BMCs on 127.0.0.1')
+    parser.add_argument('--warm', action='store_true', help='measure a second sweep, with warm caches')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--keep', help='work directory to keep, instead of a temporary one')
+    parser.add_argument('--json', help="file to write the results to, '-' for stdout")
+    parser.add_argument('--baseline', nargs='?', const=BASELINE_FILE,
+                        help='compare to a baseline, exit 1 on regressions')
+    parser.add_argument('--save-baseline', nargs='?', const=BASELINE_FILE, help='save the results as baseline')
+    parser.add_argument('--run', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run:
+        # Child process of sweep_in_child
+        print(json.dumps(run_sweep(args.run)))
+        return 0
+
+    bmc_simulator._raise_file_limit()
+    results = []
+    with contextlib.redirect_stdout(sys.stderr) if args.json == '-' else contextlib.nullcontext():
+        for size in args.sizes:
+            results += bench_fleet(size, args.modes, args.profile, args.fail_rate, not args.no_spread,
+                                   args.warm, args.seed, args.keep)
+
+    report = {'date': time.strftime('%Y-%m-%d %H:%M'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'results': results}
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as jsonFile:
+            json.dump(report, jsonFile, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.save_baseline):
+            with open(args.save_baseline) as baselineFile:
+                baseline = json.load(baselineFile)
+        baseline.update({run_key(result): result for result in results})
+        with open(args.save_baseline, 'w') as baselineFile:
+            json.dump(baseline, baselineFile, indent=2, sort_keys=True)
+        sys.stderr.write('Baseline saved to {}\n'.format(args.save_baseline))
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            regressions = compare(results, json.load(baselineFile))
+        for key, metric, old, new in regressions:
+            sys.stderr.write('REGRESSION {}: {} {} -> {}\n'.format(key, metric, old, new))
+        if regressions:
+            return 1
+        sys.stderr.write('No regression over {}\n'.format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,669 @@
+''' Local Redfish BMC simulator, to run the healthchecks, health_check_map
+and the sweeps without hardware.
+
+Each virtual BMC serves an iLO 4, iLO 5 or iDRAC resource tree built from
+the uris of the vendor modules (and optionally the HC_uris of
+serverData.json), with sessions, ETags, $expand and $select. Latency,
+concurrency limits, 503 throttling and failing components are
+configurable. All the BMCs of a fleet are served by one event loop, each on
+its own loopback address (127.1.x.y, so the fleet spans several subnets) or
+its own port.
+
+    python bmc_simulator.py --count 1000 --latency 0.05 --inventory servers_sim.json
+'''
+
+import sys
+import ssl
+import json
+import gzip
+import uuid
+import base64
+import random
+import os.path
+import subprocess
+import asyncio
+import hashlib
+import argparse
+import threading
+import time
+from http import HTTPStatus
+from fnmatch import fnmatchcase
+
+import ilo4HC
+import ilo5HC
+import idracHC
+import projection
+
+VENDORS = ('ilo4', 'ilo5', 'idrac')
+USERNAME = 'admin'
+PASSWORD = 'password'
+SESSIONS_URI = '/redfish/v1/SessionService/Sessions'
+SESSION_TIMEOUT = 1800
+# Seconds a throttled client is asked to wait
+RETRY_AFTER = 1
+# Self-signed certificate used when none is given (python-redfish only
+# speaks https)
+CERT_DIR = 'hc simulator'
+
+
+def _ok(**fields):
+    resource = {'Status': {'Health': 'OK', 'State': 'Enabled'}}
+    resource.update(fields)
+    return resource
+
+
+def _collection(uri, members):
+    return {'Members': [{'@odata.id': member} for member in members], 'Members@odata.count': len(members)}
+
+
+def _key(uri):
+    return uri.split('#')[0].split('?')[0].rstrip('/').lower()
+
+
+def ilo_tree(generation, hostname='ilo', memory=12, processors=2, drives=6):
+    ''' Resource tree of an iLO 4 or iLO 5, with the uris read by ilo4HC and
+    ilo5HC.
+
+    Output: dict {uri: resource}'''
+
+    hc = ilo4HC if generation == 4 else ilo5HC
+    oem = 'Hp' if generation == 4 else 'Hpe'
+    tree = {}
+    tree['/redfish/v1/'] = {'Oem': {oem: {'Manager': [{'ManagerType': 'iLO {}'.format(generation)}]}}}
+    if generation == 5:
+        tree['/redfish/v1/']['ProtocolFeaturesSupported'] = {
+            'ExpandQuery': {'ExpandAll': False, 'Levels': True, 'MaxLevels': 1, 'Links': False, 'NoLinks': True},
+            'SelectQuery': True}
+    tree[hc.SYSTEMS_URI] = _ok(HostName=hostname, Model='ProLiant DL360 Gen{}'.format(generation + 5),
+                               Oem={oem: {'Battery': [{'Condition': 'Ok'}],
+                                          'AggregateHealthStatus': {'BiosOrHardwareHealth': {
+                                              'Status': {'Health': 'OK'}}}}})
+    tree[hc.MANAGERS_URI] = _ok(FirmwareVersion='iLO {} v2.70'.format(generation), Oem={oem: {'iLOSelfTestResults': [
+        {'SelfTestName': name, 'Status': 'OK'} for name in ('NVRAMData', 'NVRAMSpace', 'EmbeddedFlash', 'EEPROM')] +
+        [{'SelfTestName': 'HostRom', 'Status': 'Informational'}]}})
+    tree[hc.CHASSIS_URI] = _ok()
+    tree[hc.POWER_URI] = {'PowerSupplies': [_ok(SerialNumber='5WBXK0{}'.format(index)) for index in range(2)]}
+    tree[hc.THERMAL_URI] = {'Fans': [_ok(FanName='Fan {}'.format(index)) for index in range(1, 7)],
+                            'Temperatures': [_ok(Name='{:02d}-Sensor'.format(index)) for index in range(1, 11)]}
+    dimms = ['{}/proc1dimm{}'.format(hc.MEMORY_URI, index) for index in range(1, memory + 1)]
+    tree[hc.MEMORY_URI] = _collection(hc.MEMORY_URI, dimms)
+    for dimm in dimms:
+        tree[dimm] = _ok(Name=dimm.rsplit('/', 1)[1], DIMMStatus='GoodInUse')
+    cpus = ['{}/{}'.format(hc.PROCESSORS_URI, index) for index in range(1, processors + 1)]
+    tree[hc.PROCESSORS_URI] = _collection(hc.PROCESSORS_URI, cpus)
+    for cpu in cpus:
+        tree[cpu] = _ok(Id=cpu.rsplit('/', 1)[1])
+    tree[hc.SSTORAGE_URI] = _ok()
+    array = hc.ARRAY_URI + '/0'
+    tree[hc.ARRAY_URI] = _collection(hc.ARRAY_URI, [array])
+    tree[array] = _ok(Id='0')
+    for name, count in (('LogicalDrives', 1), ('DiskDrives', drives), ('StorageEnclosures', 1)):
+        members = ['{}/{}/{}'.format(array, name, index) for index in range(count)]
+        tree['{}/{}'.format(array, name)] = _collection(array + '/' + name, members)
+        for member in members:
+            tree[member] = _ok(Id=member.rsplit('/', 1)[1])
+    adapter = hc.NETWORK_URI.rstrip('/') + '/1'
+    tree[hc.NETWORK_URI] = _collection(hc.NETWORK_URI, [adapter])
+    tree[adapter] = _ok(Name='HPE Ethernet 1Gb 4-port 331i Adapter',
+                        PhysicalPorts=[_ok(Name='Port {}'.format(index)) for index in range(1, 5)])
+    interfaces = ['{}/{}'.format(hc.ETHIF_URI, index) for index in range(1, 5)]
+    tree[hc.ETHIF_URI] = _collection(hc.ETHIF_URI, interfaces)
+    for interface in interfaces:
+        tree[interface] = _ok(Id=interface.rsplit('/', 1)[1])
+    tree[hc.EMBMEDIA_URI] = {'Controller': _ok()}
+    if generation == 5:
+        devices = ['{}{}'.format(ilo5HC.DEVICES_URI, index) for index in range(1, 5)]
+        tree[ilo5HC.DEVICES_URI] = _collection(ilo5HC.DEVICES_URI, devices)
+        for device in devices:
+            tree[device] = _ok(Name='Device {}'.format(device.rsplit('/', 1)[1]))
+    return tree
+
+
+def idrac_tree(hostname='idrac', memory=8, processors=2, drives=4):
+    ''' Resource tree of an iDRAC, with the uris read by idracHC.
+
+    Output: dict {uri: resource}'''
+
+    system = idracHC.SYSTEMS_URI
+    chassis = idracHC.CHASSIS_URI
+    psus = ['{}/Power/PowerSupplies/PSU.Slot.{}'.format(chassis, index) for index in (1, 2)]
+    fans = ['{}/Sensors/Fans/Fan.Embedded.{}'.format(chassis, index) for index in range(1, 7)]
+    tree = {}
+    tree['/redfish/v1/'] = {'Oem': {'Dell': {'ServiceTag': hostname.upper()}}, 'ProtocolFeaturesSupported': {
+        'ExpandQuery': {'ExpandAll': True, 'Levels': True, 'MaxLevels': 1, 'Links': True, 'NoLinks': True},
+        'SelectQuery': True}}
+    tree[system] = _ok(HostName=hostname, Model='PowerEdge R640',
+                       Links={'PoweredBy': [{'@odata.id': psu} for psu in psus],
+                              'CooledBy': [{'@odata.id': fan} for fan in fans]})
+    for psu in psus:
+        tree[psu] = _ok(Name=psu.rsplit('/', 1)[1])
+    for fan in fans:
+        tree[fan] = _ok(FanName=fan.rsplit('/', 1)[1])
+    tree['/redfish/v1/Managers/iDRAC.Embedded.1'] = _ok(FirmwareVersion='4.40.00.00')
+    tree[chassis] = _ok()
+    tree[idracHC.THERMAL_URI] = {'Temperatures': [_ok(Name='System Board Inlet Temp'),
+                                                  _ok(Name='CPU1 Temp'), _ok(Name='CPU2 Temp')]}
+    for uri, count, prefix in ((idracHC.MEMORY_URI, memory, 'DIMM.Socket.A'),
+                               (idracHC.PROCESSORS_URI, processors, 'CPU.Socket.')):
+        members = ['{}/{}{}'.format(uri, prefix, index) for index in range(1, count + 1)]
+        tree[uri] = _collection(uri, members)
+        for member in members:
+            tree[member] = _ok(Name=member.rsplit('/', 1)[1], Id=member.rsplit('/', 1)[1])
+    controller = idracHC.STORAGE_URI + '/RAID.Integrated.1-1'
+    disks = ['{}/Drives/Disk.Bay.{}:Enclosure.Internal.0-1'.format(idracHC.STORAGE_URI, index)
+             for index in range(drives)]
+    enclosure = '/redfish/v1/Chassis/Enclosure.Internal.0-1:RAID.Integrated.1-1'
+    tree[idracHC.STORAGE_URI] = _collection(idracHC.STORAGE_URI, [controller])
+    tree[controller] = _ok(Name='PERC H730P Mini', Drives=[{'@odata.id': disk} for disk in disks],
+                           Links={'Enclosures': [{'@odata.id': enclosure}, {'@odata.id': chassis}]})
+    for disk in disks:
+        tree[disk] = _ok(Name='Physical Disk ' + disk.rsplit('/', 1)[1].split(':')[0].split('.')[-1])
+    tree[enclosure] = _ok(Name='BP13G+ 0:1')
+    volumes = [controller + '/Volumes/Disk.Virtual.0:RAID.Integrated.1-1']
+    tree[controller + '/Volumes'] = _collection(controller + '/Volumes', volumes)
+    for volume in volumes:
+        tree[volume] = _ok(Name='Virtual Disk 0')
+    adapter = idracHC.NETWORK_URI + '/NIC.Integrated.1'
+    tree[idracHC.NETWORK_URI] = _collection(idracHC.NETWORK_URI, [adapter])
+    tree[adapter] = _ok(Id='NIC.Integrated.1')
+    for name in ('NetworkDeviceFunctions', 'NetworkPorts'):
+        members = ['{}/{}/NIC.Integrated.1-{}'.format(adapter, name, index) for index in range(1, 3)]
+        tree['{}/{}'.format(adapter, name)] = _collection(adapter + '/' + name, members)
+        for member in members:
+            tree[member] = _ok(Id=member.rsplit('/', 1)[1])
+    interfaces = [idracHC.ETHIF_URI + '/NIC.Integrated.1-{}-1'.format(index) for index in range(1, 3)]
+    tree[idracHC.ETHIF_URI] = _collection(idracHC.ETHIF_URI, interfaces)
+    for interface in interfaces:
+        tree[interface] = _ok(Id=interface.rsplit('/', 1)[1])
+    return tree
+
+
+def vendor_tree(vendor, hostname, **sizes):
+    if vendor == 'idrac':
+        return idrac_tree(hostname, **sizes)
+    return ilo_tree(4 if vendor == 'ilo4' else 5, hostname, **sizes)
+
+
+def add_uris(tree, uris):
+    ''' Adds a healthy resource for every uri missing from the tree, e.g. the
+    HC_uris of serverData.json.'''
+
+    keys = {_key(uri) for uri in tree}
+    for uri in uris:
+        if _key(uri) not in keys:
+            keys.add(_key(uri))
+            tree[uri.split('#')[0]] = _ok(Id=uri.rstrip('/').rsplit('/', 1)[1])
+    return tree
+
+
+def link_tree(tree, vendor):
+    ''' Completes a tree the way a BMC serves it: every resource gets its
+    @odata.id, missing parents become collections, every resource is linked
+    from its parent so the tree can be crawled from the root, and iLOs get a
+    ResourceDirectory. Also adds the session service.
+
+    Output: dict {normalized uri: resource}'''
+
+    tree = dict(tree)
+    tree.setdefault('/redfish/v1/SessionService', {'SessionTimeout': SESSION_TIMEOUT,
+                                                   'Sessions': {'@odata.id': SESSIONS_URI}})
+    tree['/redfish/v1/'] = dict(tree.get('/redfish/v1/', {}), Links={'Sessions': {'@odata.id': SESSIONS_URI}})
+    resources = {}
+    for uri, resource in tree.items():
+        resources[_key(uri)] = dict(resource, **{'@odata.id': resource.get('@odata.id', uri)})
+    # Deepest first, so the parents created on the way get linked too.
+    # Created parents are linked as properties, never as collection members
+    created = set()
+    for depth in range(max(key.count('/') for key in resources), 2, -1):
+        for key in [key for key in resources if key.count('/') == depth]:
+            uri = resources[key]['@odata.id']
+            parentKey = key.rsplit('/', 1)[0]
+            if parentKey not in resources:
+                resources[parentKey] = {'@odata.id': uri.rstrip('/').rsplit('/', 1)[0], 'Members': [],
+                                        'Members@odata.count': 0}
+                created.add(parentKey)
+            parent = resources[parentKey]
+            if any(_key(link) == key for link in _links(parent)):
+                continue
+            if 'Members' in parent and key not in created:
+                parent['Members'] = parent['Members'] + [{'@odata.id': uri}]
+                parent['Members@odata.count'] = len(parent['Members'])
+            else:
+                parent[uri.rstrip('/').rsplit('/', 1)[1]] = {'@odata.id': uri}
+    if vendor != 'idrac':
+        resources['/redfish/v1/resourcedirectory'] = {
+            '@odata.id': '/redfish/v1/ResourceDirectory/',
+            'Instances': [{'@odata.id': resource['@odata.id']} for resource in resources.values()]}
+    return resources
+
+
+def _links(resource, top=True):
+    ''' Uris referenced by a resource, at any depth.'''
+
+    if isinstance(resource, dict):
+        for key, value in resource.items():
+            if key == '@odata.id':
+                if not top and isinstance(value, str):
+                    yield value
+            else:
+                yield from _links(value, False)
+    elif isinstance(resource, list):
+        for item in resource:
+            yield from _links(item, False)
+
+
+def fail_components(resources, patterns, health='Critical'):
+    ''' Marks components as failing. Patterns match uris (case ignored, *
+    matches anything), 'uri#Field/index' fails one element of a list, e.g.
+    '/redfish/v1/Chassis/1/Thermal#Fans/2'. Resources are copied before
+    being changed, so trees can be shared between BMCs.'''
+
+    resources = dict(resources)
+    for pattern in patterns:
+        uriPattern, _, element = pattern.partition('#')
+        for key in [key for key in resources if fnmatchcase(key, _key(uriPattern))]:
+            resource = dict(resources[key])
+            if element:
+                field, _, index = element.rpartition('/')
+                items = list(resource[field])
+                items[int(index)] = dict(items[int(index)], Status={'Health': health, 'State': 'Enabled'})
+                resource[field] = items
+            else:
+                resource['Status'] = {'Health': health, 'State': 'Enabled'}
+                if 'DIMMStatus' in resource:
+                    resource['DIMMStatus'] = 'Degraded'
+            resources[key] = resource
+    return resources
+
+
+class VirtualBmc(object):
+    ''' One simulated BMC: serves its resources to authenticated clients
+    (session token or basic auth).
+
+    latency: seconds added to every request, plus up to jitter seconds
+    latencySigma: the latency is the median of a lognormal distribution of
+    this sigma instead of a constant, for the long tail of real BMCs
+    maxConcurrent: requests served at once, the others wait
+    throttleInflight: requests over this many in flight get 503
+    errorRate: fraction of the requests answered with 503'''
+
+    def __init__(self, resources, vendor, username=USERNAME, password=PASSWORD, latency=0, jitter=0,
+                 maxConcurrent=None, throttleInflight=None, errorRate=0, rand=None, latencySigma=0):
+        self.resources = resources
+        self.vendor = vendor
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.latencySigma = latencySigma
+        self.maxConcurrent = maxConcurrent
+        self.throttleInflight = throttleInflight
+        self.errorRate = errorRate
+        self.random = rand or random.Random()
+        self.url = None
+        self.sessions = {}
+        self.inflight = 0
+        self._slots = None
+        self.reset()
+
+    def reset(self):
+        ''' Clears the counters, e.g. between the runs of a benchmark.'''
+
+        self.stats = {'requests': 0, 'notModified': 0, 'throttled': 0, 'logins': 0, 'peakInflight': 0,
+                      'bytesIn': 0, 'bytesOut': 0}
+        # Monotonic times of the first request and of the last answer
+        self.firstRequest = None
+        self.lastResponse = None
+
+    def _authorized(self, headers):
+        if headers.get('x-auth-token') in self.sessions:
+            return True
+        scheme, _, credentials = headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'basic':
+            return False
+        try:
+            return base64.b64decode(credentials).decode() == '{}:{}'.format(self.username, self.password)
+        except ValueError:
+            return False
+
+    async def handle(self, method, target, headers, body):
+        ''' Answers one request.
+
+        Output: (status, headers, json payload or None)'''
+
+        self.stats['requests'] += 1
+        if self.firstRequest is None:
+            self.firstRequest = time.monotonic()
+        self.inflight += 1
+        self.stats['peakInflight'] = max(self.stats['peakInflight'], self.inflight)
+        try:
+            if (self.throttleInflight and self.inflight > self.throttleInflight) or \
+                    self.random.random() < self.errorRate:
+                self.stats['throttled'] += 1
+                return 503, {'Retry-After': str(RETRY_AFTER)}, {'error': {'code': 'Base.1.0.ServiceTemporarilyUnavailable'}}
+            if self.maxConcurrent:
+                if self._slots is None:
+                    self._slots = asyncio.Semaphore(self.maxConcurrent)
+                async with self._slots:
+                    return await self._respond(method, target, headers, body)
+            return await self._respond(method, target, headers, body)
+        finally:
+            self.inflight -= 1
+            self.lastResponse = time.monotonic()
+
+    async def _respond(self, method, target, headers, body):
+        if self.latency or self.jitter:
+            latency = self.latency
+            if self.latencySigma:
+                latency *= self.random.lognormvariate(0, self.latencySigma)
+            await asyncio.sleep(latency + self.random.uniform(0, self.jitter))
+        path, _, query = target.partition('?')
+        key = _key(path)
+        if method == 'POST' and key == _key(SESSIONS_URI):
+            try:
+                credentials = json.loads(body or b'{}')
+            except ValueError:
+                credentials = {}
+            if credentials.get('UserName') != self.username or credentials.get('Password') != self.password:
+                return 401, {}, {'error': {'code': 'Base.1.0.NoValidSession'}}
+            self.stats['logins'] += 1
+            token = uuid.uuid4().hex
+            location = '{}/{}'.format(SESSIONS_URI, token[:16])
+            self.sessions[token] = location
+            return 201, {'X-Auth-Token': token, 'Location': location}, {'@odata.id': location, 'Id': token[:16],
+                                                                         'UserName': self.username}
+        if key != '/redfish/v1' and not self._authorized(headers):
+            return 401, {}, {'error': {'code': 'Base.1.0.NoValidSession'}}
+        if method == 'DELETE':
+            for token, location in list(self.sessions.items()):
+                if _key(location) == key:
+                    del self.sessions[token]
+                    return 200, {}, {}
+            return 404, {}, {'error': {'code': 'Base.1.0.ResourceMissingAtURI'}}
+        if method not in ('GET', 'HEAD'):
+            return 405, {}, {'error': {'code': 'Base.1.0.OperationNotAllowed'}}
+        resource = self._resource(key, query)
+        if resource is None:
+            return 404, {}, {'error': {'code': 'Base.1.0.ResourceMissingAtURI'}}
+        etag = '"{}"'.format(hashlib.sha1(json.dumps(resource, sort_keys=True).encode()).hexdigest()[:16])
+        if headers.get('if-none-match') == etag:
+            self.stats['notModified'] += 1
+            return 304, {'ETag': etag}, None
+        return 200, {'ETag': etag}, resource
+
+    def _resource(self, key, query):
+        if key.startswith(_key(SESSIONS_URI) + '/'):
+            for location in self.sessions.values():
+                if _key(location) == key:
+                    return {'@odata.id': location, 'Id': location.rsplit('/', 1)[1], 'UserName': self.username}
+            return None
+        if key == _key(SESSIONS_URI):
+            return _collection(SESSIONS_URI, list(self.sessions.values()))
+        resource = self.resources.get(key)
+        if resource is None:
+            return None
+        features = self.resources['/redfish/v1'].get('ProtocolFeaturesSupported', {})
+        if '$expand' in query and features.get('ExpandQuery') and 'Members' in resource:
+            resource = dict(resource, Members=[self.resources.get(_key(member['@odata.id']), member)
+                                               for member in resource['Members']])
+        if '$select=' in query and features.get('SelectQuery'):
+            resource = projection.project(resource, query.split('$select=', 1)[1].split('&')[0].split(','))
+        return resource
+
+
+class Simulator(object):
+    ''' Serves a list of virtual BMCs from one event loop running in a
+    background thread. With spread, BMC n listens on its own loopback
+    address (127.1.x.y, 250 per /24) on port; otherwise they all listen on
+    host, each on its own port. With an ssl context (see ssl_context) the
+    BMCs serve https, the only scheme python-redfish accepts.'''
+
+    def __init__(self, bmcs, host='127.0.0.1', port=0, spread=False, sslContext=None):
+        self.bmcs = list(bmcs)
+        self.host = host
+        self.port = port
+        self.spread = spread
+        self.sslContext = sslContext
+        self._loop = None
+        self._servers = []
+        self._thread = None
+
+    def address(self, index):
+        if not self.spread:
+            return self.host
+        return '127.1.{}.{}'.format(index // 250, index % 250 + 1)
+
+    async def _serve(self, bmc, reader, writer):
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine.strip():
+                    break
+                method, target, _ = requestLine.decode('latin-1').split(' ', 2)
+                headers = {}
+                received = len(requestLine)
+                while True:
+                    line = await reader.readline()
+                    received += len(line)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length') or 0))
+                bmc.stats['bytesIn'] += received + len(body)
+                status, responseHeaders, payload = await bmc.handle(method, target, headers, body)
+                data = b'' if payload is None else json.dumps(payload).encode()
+                if data and 'gzip' in headers.get('accept-encoding', ''):
+                    data = gzip.compress(data, 1)
+                    responseHeaders['Content-Encoding'] = 'gzip'
+                lines = ['HTTP/1.1 {} {}'.format(status, HTTPStatus(status).phrase),
+                         'Content-Type: application/json', 'Content-Length: {}'.format(len(data))]
+                lines += ['{}: {}'.format(name, value) for name, value in responseHeaders.items()]
+                response = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (b'' if method == 'HEAD' else data)
+                bmc.stats['bytesOut'] += len(response)
+                writer.write(response)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, ssl.SSLError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _start(self):
+        scheme = 'https' if self.sslContext else 'http'
+        for index, bmc in enumerate(self.bmcs):
+            server = await asyncio.start_server(lambda reader, writer, bmc=bmc: self._serve(bmc, reader, writer),
+                                                self.address(index), self.port, ssl=self.sslContext)
+            self._servers.append(server)
+            host, port = server.sockets[0].getsockname()[:2]
+            bmc.url = '{}://{}:{}'.format(scheme, host, port)
+
+    def start(self):
+        ''' Starts serving, returns once every BMC listens.'''
+
+        started = threading.Event()
+        failure = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self._start())
+            except BaseException as e:
+                failure.append(e)
+                started.set()
+                return
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        if failure:
+            raise failure[0]
+        return self
+
+    async def _stop(self):
+        for server in self._servers:
+            server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def inventory(self):
+        ''' servers.json entries of the BMCs.'''
+
+        return {'bmc{}'.format(index): {'systemUrl': bmc.url, 'loginAccount': bmc.username,
+                                        'loginPassword': bmc.password}
+                for index, bmc in enumerate(self.bmcs)}
+
+    def _call(self, function):
+        # Runs function in the loop of the BMCs, between two requests
+        async def call():
+            return function()
+        return asyncio.run_coroutine_threadsafe(call(), self._loop).result()
+
+    def reset(self):
+        ''' Clears the counters of all the BMCs.'''
+
+        self._call(lambda: [bmc.reset() for bmc in self.bmcs])
+
+    def host_times(self):
+        ''' Seconds between the first request and the last answer of each
+        BMC that was queried: the time a healthcheck kept it busy.'''
+
+        return self._call(lambda: [bmc.lastResponse - bmc.firstRequest for bmc in self.bmcs
+                                   if bmc.firstRequest is not None])
+
+    def stats(self):
+        ''' Sum of the request counters of all the BMCs.'''
+
+        total = {}
+        for bmc in self.bmcs:
+            for name, value in bmc.stats.items():
+                total[name] = max(total.get(name, 0), value) if name.startswith('peak') else \
+                    total.get(name, 0) + value
+        return total
+
+
+def build_fleet(count, vendors=VENDORS, failRate=0, extraUris=(), seed=None, **bmcOptions):
+    ''' Virtual BMCs cycling over the vendors. BMCs of the same vendor share
+    their tree, only the resources they change are copied. With failRate,
+    that fraction of the BMCs get a failing component.
+
+    Input: number of BMCs, vendors, fraction of failing BMCs, uris added to
+    every tree, random seed and VirtualBmc options
+    Output: list of VirtualBmc'''
+
+    rand = random.Random(seed)
+    templates = {vendor: link_tree(add_uris(vendor_tree(vendor, 'template'), extraUris), vendor)
+                 for vendor in vendors}
+    bmcs = []
+    for index in range(count):
+        vendor = vendors[index % len(vendors)]
+        resources = dict(templates[vendor])
+        systemKey = _key(idracHC.SYSTEMS_URI if vendor == 'idrac' else ilo5HC.SYSTEMS_URI)
+        resources[systemKey] = dict(resources[systemKey], HostName='{}-{}'.format(vendor, index))
+        if rand.random() < failRate:
+            candidates = [key for key, resource in resources.items()
+                          if 'Status' in resource and key.count('/') > 4]
+            resources = fail_components(resources, [rand.choice(sorted(candidates))])
+        bmcs.append(VirtualBmc(resources, vendor, rand=random.Random(rand.random()), **bmcOptions))
+    return bmcs
+
+
+def fleet_from_server_data(serverData, **bmcOptions):
+    ''' One virtual BMC per server of serverData.json, serving the vendor tree
+    plus the HC_uris of the server.'''
+
+    bmcs = []
+    for server, serverInfo in serverData.items():
+        uris = serverInfo.get('HC_uris', [])
+        if any('System.Embedded.1' in uri for uri in uris):
+            vendor = 'idrac'
+        else:
+            vendor = 'ilo5' if any('/Chassis/1/Devices' in uri for uri in uris) else 'ilo4'
+        resources = link_tree(add_uris(vendor_tree(vendor, server), uris), vendor)
+        bmcs.append(VirtualBmc(resources, vendor, **bmcOptions))
+    return bmcs
+
+
+def _raise_file_limit():
+    # Every BMC is a listening socket
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def ssl_context(certFile=None, keyFile=None, directory=CERT_DIR):
+    ''' Server ssl context. Without a certificate, a self-signed one is
+    created once in directory with the openssl command.'''
+
+    if certFile is None:
+        certFile = os.path.join(directory, 'cert.pem')
+        keyFile = os.path.join(directory, 'key.pem')
+        if not os.path.exists(certFile):
+            os.makedirs(directory, exist_ok=True)
+            subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '3650',
+                            '-subj', '/CN=bmc-simulator', '-keyout', keyFile, '-out', certFile],
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certFile, keyFile)
+    return context
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve simulated Redfish BMCs.')
+    parser.add_argument('--count', type=int, default=3, help='number of BMCs')
+    parser.add_argument('--vendor', action='append', choices=VENDORS, help='vendors, can be repeated (all)')
+    parser.add_argument('--server-data', help='serverData.json to simulate, instead of --count')
+    parser.add_argument('--latency', type=float, default=0, help='seconds per request')
+    parser.add_argument('--jitter', type=float, default=0, help='random seconds added to the latency')
+    parser.add_argument('--latency-sigma', type=float, default=0,
+                        help='lognormal latency of median --latency and this sigma')
+    parser.add_argument('--max-concurrent', type=int, help='requests served at once per BMC')
+    parser.add_argument('--throttle', type=int, help='503 over this many requests in flight per BMC')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered 503')
+    parser.add_argument('--fail-rate', type=float, default=0, help='fraction of BMCs with a failing component')
+    parser.add_argument('--spread', action='store_true', help='one loopback address per BMC (Linux)')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--cert', help='certificate file (a self-signed one by default)')
+    parser.add_argument('--key', help='key of the certificate')
+    parser.add_argument('--http', action='store_true', help='plain http (the async client only)')
+    parser.add_argument('--inventory', default='servers_sim.json', help='servers.json file to write')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    options = {'latency': args.latency, 'jitter': args.jitter, 'latencySigma': args.latency_sigma,
+               'maxConcurrent': args.max_concurrent, 'throttleInflight': args.throttle,
+               'errorRate': args.error_rate}
+    if args.server_data:
+        with open(args.server_data) as dataFile:
+            bmcs = fleet_from_server_data(json.load(dataFile), **options)
+    else:
+        bmcs = build_fleet(args.count, tuple(args.vendor or VENDORS), args.fail_rate, seed=args.seed, **options)
+    sslContext = None if args.http else ssl_context(args.cert, args.key)
+    _raise_file_limit()
+    simulator = Simulator(bmcs, port=args.port, spread=args.spread, sslContext=sslContext).start()
+    with open(args.inventory, 'w') as inventoryFile:
+        json.dump(simulator.inventory(), inventoryFile, indent=2)
+    print('Serving {} BMCs, inventory in {}'.format(len(bmcs), args.inventory))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        simulator.stop()
+        print(json.dumps(simulator.stats()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,10 @@
 import sys
-import redfish
 import json
 import datetime
+import etag_cache
+import redfish_metrics
+import result_sinks
+import host_guard
 
 # Main Uri addresses
 ROOT_URI = '/redfish/v1/'
@@ -13,6 +16,8 @@ IDRACMAN_URI = '/redfish/v1/Managers/iDRAC.Embedded.1'
 # HP ONLY Resource URI
 RESOURCE_URI = '/redfish/v1/ResourceDirectory/'
 
+SERVERS_FILE = 'serverData.json'
+
 
 # Create time stamp
 dateStamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -28,20 +33,42 @@ def parse_json(filename):  # Parses the JSON data from a file, populates a Pytho
             print('Unable to load json')
             print(e)
 
-servers = parse_json('serverData.json')           
+_servers = None
+
+def load_servers(filename=None):
+    ''' Returns the servers dict with their HC_uris, read from filename
+    (SERVERS_FILE by default) the first time it is needed, as in serversHC.
+
+    Input: inventory file
+    Output: servers dict'''
+
+    global _servers
+    if filename is not None or _servers is None:
+        _servers = parse_json(filename or SERVERS_FILE)
+    return _servers
+
+def __getattr__(name):
+    # buildHC_experimental.servers is loaded on first use
+    if name == 'servers':
+        return load_servers()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 def open_connection(systemUrl, loginAccount, loginPassword):
     ''' Open a https session using redfish to a target server.
     If the connection is not established, either the server is down or redfish
-    is not supported.    
+    is not supported: the error of the redfish library is raised, as is
+    host_guard.UnknownServerError for a server that is neither HP nor Dell.
 
     Input: server address, user account and password
     Output: returns an object with the open session'''
-    
+
+    import redfish
+
+    serverConnection = etag_cache.conditional(redfish_metrics.measured(redfish.RedfishClient(
+        base_url=systemUrl, username=loginAccount, password=loginPassword, **host_guard.client_options()),
+        systemUrl), systemUrl)
+    serverConnection.login()
     try:
-        serverConnection = redfish.RedfishClient(base_url=systemUrl, username=loginAccount,
-                                      password=loginPassword)
-        serverConnection.login()
         serverInfo = serverConnection.get(ROOT_URI).dict
         if 'Hp' in serverInfo['Oem'] or 'Hpe' in serverInfo['Oem']:
             serverInfo = serverConnection.get(ILOSYS_URI).dict
@@ -50,13 +77,11 @@ def open_connection(systemUrl, loginAccount, loginPassword):
             serverInfo = serverConnection.get(IDRACSYS_URI).dict
             serverType = 'Dell'
         else:
-            print('Unknown server')
-            serverConnection.logout()
-            sys.exit()
-        print('Connected to', serverInfo['HostName'], 'Vendor:', serverType)
-    except redfish.ServerDownOrUnreachableError:
-        sys.stderr.write("ERROR: server not reachable or doesn't support Redfish.\n")
-        sys.exit()
+            raise host_guard.UnknownServerError('Unknown server ' + systemUrl)
+    except BaseException:
+        serverConnection.logout()
+        raise
+    print('Connected to', serverInfo['HostName'], 'Vendor:', serverType)
     return (serverConnection, serverInfo['HostName'], serverType)
 
 def parse_uri(serverConnection, uri):
@@ -144,18 +169,40 @@ def build_healthcheck(serverConnection, serverName, serverType, hcUris):
 
     
     
-def create_hcfiles():
-    for server in serverData:
-        serverConnection, serverName, serverType = open_connection(**serverData[server])
-        hcUris = serverData[server]['HC_uris']
-        serverHc = build_healthcheck(serverConnection, serverName, serverType, hcUris):
-        print('Creating healtcheck file...')
-        with open('hc dump/{}.json'.format(server), 'w') as hcFile:
-            json.dump(serverHc, hcFile)
-        print('File {}.json created successfully'.format(server))
-        serverConnection.logout()
-        
-        
-        
-        
-        
\ No newline at end of file
+def create_hcfiles(sink=None):
+    ''' Builds the healthcheck of every server of serverData.json from its
+    HC_uris and writes it to sink (see result_sinks, one file per server in
+    'hc dump' by default), which is closed at the end. A server that fails
+    gets a failure result in the sink (see host_guard.check_host) and the
+    others are still checked; servers without HC_uris are skipped.'''
+
+    def check(server, serverInfo):
+        serverConnection, serverName, serverType = open_connection(serverInfo['systemUrl'],
+                                                                   serverInfo['loginAccount'],
+                                                                   serverInfo['loginPassword'])
+        try:
+            serverHc = build_healthcheck(serverConnection, serverName, serverType, serverInfo['HC_uris'])
+        finally:
+            serverConnection.logout()
+        print('Creating healtcheck in {}...'.format(sink.name))
+        sink.write(server, serverHc)
+        print('Healthcheck of {} written successfully'.format(server))
+
+    if sink is None:
+        sink = result_sinks.open_sink()
+    try:
+        with result_sinks.progress_output(sink):
+            servers = load_servers()
+            for server in servers:
+                serverInfo = servers[server]
+                if 'HC_uris' not in serverInfo:
+                    sys.stderr.write('ERROR: no HC_uris for {}, skipped.\n'.format(server))
+                    continue
+                try:
+                    host_guard.check_host(server, serverInfo['systemUrl'],
+                                          lambda: check(server, serverInfo), sink)
+                except host_guard.HostFailure as e:
+                    sys.stderr.write('ERROR: {}: {}\n'.format(server, e))
+    finally:
+        sink.close()
+        redfish_metrics.export()
@@ -0,0 +1,216 @@
+import os
+import json
+import asyncio
+import hashlib
+import threading
+
+import fanout
+
+# Responses kept between sweeps, evicted least recently used first
+CACHE_DIR = 'hc cache'
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+# Share of maxBytes an eviction trims the store to, so the next saves do not
+# go over it (and rescan the directory) right away
+LOW_WATER = 0.9
+
+
+class EtagStore(object):
+    ''' On-disk store of the last response of each host and uri, with its
+    ETag. Every entry is a small json file named after a hash of host and uri,
+    written atomically so several sweeps can share the directory. The file
+    modification time is the last use: when the directory grows over
+    maxBytes, the least recently used entries are removed down to lowWater
+    of it.'''
+
+    def __init__(self, directory=CACHE_DIR, maxBytes=MAX_CACHE_BYTES, lowWater=LOW_WATER):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lowWater = lowWater
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, host, uri):
+        key = '{} {}'.format(host.rstrip('/').lower(), uri.rstrip('/'))
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def load(self, host, uri):
+        ''' Returns the (etag, resource) stored for the uri, None if there is
+        none.'''
+
+        path = self._path(host, uri)
+        try:
+            with open(path) as entryFile:
+                entry = json.load(entryFile)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry['etag'], entry['body']
+
+    def _entry_size(self, path):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return 0
+
+    def save(self, host, uri, etag, resource):
+        path = self._path(host, uri)
+        data = json.dumps({'host': host, 'uri': uri, 'etag': etag, 'body': resource})
+        tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmpPath, 'w') as entryFile:
+                entryFile.write(data)
+            # An overwritten entry only adds the difference
+            replacedSize = self._entry_size(path)
+            os.replace(tmpPath, path)
+        except OSError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data) - replacedSize
+            if self._size is None or self._size > self.maxBytes:
+                self.evict()
+
+    def discard(self, host, uri):
+        path = self._path(host, uri)
+        size = self._entry_size(path)
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def evict(self):
+        ''' Removes the least recently used entries until the store fits in
+        lowWater of maxBytes, and refreshes the size estimate.'''
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        size = sum(entrySize for _, entrySize, _ in entries)
+        target = self.maxBytes * self.lowWater
+        for _, entrySize, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entrySize
+        self._size = size
+
+
+_defaultStore = None
+_defaultLock = threading.Lock()
+
+
+def default_store():
+    ''' Store shared by all the connections of the process.'''
+
+    global _defaultStore
+    with _defaultLock:
+        if _defaultStore is None:
+            _defaultStore = EtagStore()
+    return _defaultStore
+
+
+class StoredResponse(fanout.InlineResponse):
+    ''' Response rebuilt from the store after a 304 Not Modified.'''
+
+    def __init__(self, resource, path, etag):
+        fanout.InlineResponse.__init__(self, resource, path)
+        self.etag = etag
+
+    def getheader(self, name):
+        return self.etag if name.lower() == 'etag' else None
+
+    def getheaders(self):
+        return {'etag': self.etag}
+
+
+class ConditionalConnection(object):
+    ''' Wraps a redfish connection so that resources fetched by a previous
+    sweep are revalidated with If-None-Match instead of transferred again.
+    On 304 the stored body is returned as a 200 response. Responses without
+    an ETag are not stored. Everything but get is passed through to the
+    wrapped connection.'''
+
+    def __init__(self, connection, host, store):
+        self.connection = connection
+        self.host = host
+        self.store = store
+        self.requests = 0
+        self.notModified = 0
+
+    def conditional_headers(self, path, headers):
+        stored = self.store.load(self.host, path)
+        if stored is None:
+            return None, headers
+        return stored, dict(headers or {}, **{'If-None-Match': stored[0]})
+
+    def handle_response(self, path, response, stored):
+        self.requests += 1
+        if response.status == 304 and stored is not None:
+            self.notModified += 1
+            return StoredResponse(stored[1], path, stored[0])
+        if response.status == 200:
+            etag = response.getheader('ETag')
+            if etag:
+                self.store.save(self.host, path, etag, response.dict)
+            elif stored is not None:
+                self.store.discard(self.host, path)
+        return response
+
+    def get(self, path, args=None, headers=None):
+        if args:
+            return self.connection.get(path, args=args, headers=headers)
+        stored, headers = self.conditional_headers(path, headers)
+        response = self.connection.get(path, headers=headers)
+        return self.handle_response(path, response, stored)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class AsyncConditionalConnection(ConditionalConnection):
+    ''' Same as ConditionalConnection, for an async_redfish client.'''
+
+    async def get(self, path, args=None, headers=None):
+        if args:
+            return await self.connection.get(path, args=args, headers=headers)
+        stored, headers = self.conditional_headers(path, headers)
+        response = await self.connection.get(path, headers=headers)
+        return self.handle_response(path, response, stored)
+
+
+def conditional(connection, host=None, store=None):
+    ''' Returns the connection wrapped in a ConditionalConnection, unless one
+    of its wrappers already is one. host defaults to the base url of the
+    client, store to the one shared by the process.'''
+
+    if fanout.find_wrapper(connection, ConditionalConnection) is not None:
+        return connection
+    if host is None:
+        host = connection.base_url
+    if store is None:
+        store = default_store()
+    if asyncio.iscoroutinefunction(connection.get):
+        return AsyncConditionalConnection(connection, host, store)
+    return ConditionalConnection(connection, host, store)
+
+
+def etag_stats(connection):
+    ''' Returns a (not modified, requests) tuple for a connection revalidated
+    with ETags, (0, 0) if it is not.'''
+
+    wrapper = fanout.find_wrapper(connection, ConditionalConnection)
+    if wrapper is None:
+        return (0, 0)
+    return (wrapper.notModified, wrapper.requests)
@@ -0,0 +1,178 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import span_trace
+
+# ILO and IDRAC web servers only handle a few requests at once
+MAX_INFLIGHT = 4
+
+ROOT_URI = '/redfish/v1/'
+
+
+class BoundedConnection(object):
+    ''' Wraps a redfish connection so that at most maxInflight requests are
+    sent to the BMC at once, whatever the number of threads sharing it.
+    Everything but get is passed through to the wrapped connection.'''
+
+    def __init__(self, connection, maxInflight=MAX_INFLIGHT):
+        self.connection = connection
+        self.maxInflight = maxInflight
+        self._slots = threading.BoundedSemaphore(maxInflight)
+
+    def get(self, path, *args, **kwargs):
+        with self._slots:
+            return self.connection.get(path, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def bounded(connection, maxInflight=None):
+    ''' Returns the connection wrapped in a BoundedConnection, unless it
+    already is one. maxInflight defaults to the maxLimit of an adaptive
+    connection (see adaptive_limit), which bounds the requests itself, and
+    to MAX_INFLIGHT otherwise.'''
+
+    if isinstance(connection, BoundedConnection):
+        return connection
+    if maxInflight is None:
+        maxInflight = getattr(connection, 'maxLimit', MAX_INFLIGHT)
+    return BoundedConnection(connection, maxInflight)
+
+
+def find_wrapper(connection, wrapperClass):
+    ''' Returns the wrapper of the given class in a chain of connection
+    wrappers (each keeping the wrapped one in .connection), or None.'''
+
+    while connection is not None:
+        if isinstance(connection, wrapperClass):
+            return connection
+        connection = vars(connection).get('connection') if hasattr(connection, '__dict__') else None
+    return None
+
+
+def member_uris(members):
+    ''' Flattens a Redfish Members/Links list ([{'@odata.id': uri}, ...]) to
+    a list of uris, the same way the vendor modules iterate them.'''
+
+    return [uri for member in members for uri in member.values()]
+
+
+def get_all(connection, uris):
+    ''' Fetches a list of uris in parallel. The number of requests in flight
+    is bounded by the maxInflight of the connection.
+
+    Input: redfish connection and list of uris
+    Output: list with the responses, in the same order as the uris'''
+
+    uris = list(uris)
+    if len(uris) < 2:
+        return [connection.get(uri) for uri in uris]
+    workers = min(len(uris), getattr(connection, 'maxInflight', MAX_INFLIGHT))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(span_trace.in_context(connection.get), uris))
+
+
+class InlineResponse(object):
+    ''' Response-like object for a member that came expanded inside its
+    collection, so the checks can read it like any other response.'''
+
+    status = 200
+
+    def __init__(self, resource, path=None):
+        self.dict = resource
+        self.path = path
+
+    def getheader(self, name):
+        return None
+
+
+def expand_query(root):
+    ''' Returns the query that makes the BMC inline the members of a
+    collection ($expand=.($levels=1)), or None when the service root does not
+    advertise ProtocolFeaturesSupported.ExpandQuery.
+
+    Input: service root dictionary
+    Output: query string or None'''
+
+    try:
+        expand = root['ProtocolFeaturesSupported']['ExpandQuery']
+    except (KeyError, TypeError):
+        return None
+    if not expand.get('NoLinks'):
+        return None
+    if expand.get('Levels'):
+        return '$expand=.($levels=1)'
+    return '$expand=.'
+
+
+def service_root(connection):
+    ''' Service root of the connection. The redfish clients keep the one
+    they read at login, otherwise it is fetched (once per session when the
+    connection is cached).'''
+
+    root = getattr(connection, 'root', None)
+    if root is not None:
+        return root.dict
+    return connection.get(ROOT_URI).dict
+
+
+def expanded_uri(uri, query):
+    return uri + ('&' if '?' in uri else '?') + query
+
+
+def split_members(members):
+    ''' Splits the Members of a collection into the ones that came expanded
+    and the ones that still have to be fetched.
+
+    Input: Members list of a collection
+    Output: list of (uri, InlineResponse or None) tuples, in collection order'''
+
+    items = []
+    for member in members:
+        if len(member) > 1 and '@odata.id' in member:
+            items.append((member['@odata.id'], InlineResponse(member, member['@odata.id'])))
+        else:
+            items += [(uri, None) for uri in member.values()]
+    return items
+
+
+def get_collections(connection, uris, withUris=False):
+    ''' Fetches several collections in parallel, then all of their members
+    in parallel. When the BMC supports $expand, each collection is requested
+    with its members inlined and only the members it did not expand are
+    fetched one by one.
+
+    Input: redfish connection, list of collection uris and whether the member
+    uris should be returned with the responses
+    Output: list with one list of member responses (or (uri, response)
+    tuples) per collection'''
+
+    query = expand_query(service_root(connection))
+    if query:
+        collections = get_all(connection, [expanded_uri(uri, query) for uri in uris])
+        retry = [uri for uri, collection in zip(uris, collections) if collection.status != 200]
+        if retry:
+            plain = iter(get_all(connection, retry))
+            collections = [collection if collection.status == 200 else next(plain)
+                           for collection in collections]
+    else:
+        collections = get_all(connection, uris)
+    itemLists = [split_members(collection.dict['Members']) for collection in collections]
+    missing = [uri for items in itemLists for uri, response in items if response is None]
+    fetched = iter(get_all(connection, missing))
+    itemLists = [[(uri, response if response is not None else next(fetched)) for uri, response in items] for items in itemLists]
+    if withUris:
+        return itemLists
+    return [[response for _, response in items] for items in itemLists]
+
+
+def get_members(connection, uri, withUris=False):
+    ''' Fetches a collection and then all of its members in parallel (or in
+    one request, see get_collections).
+
+    Input: redfish connection, collection uri and whether the member uris
+    should be returned with the responses
+    Output: list with the responses (or (uri, response) tuples) of the members'''
+
+    return get_collections(connection, [uri], withUris)[0]
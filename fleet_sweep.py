@@ -0,0 +1,124 @@
+import sys
+import time
+import asyncio
+import ipaddress
+from collections import deque
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Default pool sizes
+MAX_WORKERS = 32
+MAX_SUBNET_WORKERS = 8
+MAX_ASYNC_HOSTS = 256
+SUBNET_PREFIX = 24
+
+
+def subnet_key(systemUrl, prefix=SUBNET_PREFIX):
+    ''' Returns the subnet a BMC lives in, used to group hosts that share the
+    same management network segment.
+
+    Input: server address (e.g. https://198.18.238.203) and subnet prefix length
+    Output: subnet string (e.g. 198.18.238.0/24), or the hostname when the
+    address is not an IP'''
+
+    host = urlsplit(systemUrl if '//' in systemUrl else '//' + systemUrl).hostname or systemUrl
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return host
+    if address.version == 6 and prefix == SUBNET_PREFIX:
+        prefix = 64
+    return str(ipaddress.ip_network('{}/{}'.format(address, prefix), strict=False))
+
+
+def sweep(servers, task, maxWorkers=MAX_WORKERS, maxSubnetWorkers=MAX_SUBNET_WORKERS,
+          prefix=SUBNET_PREFIX):
+    ''' Runs task(server, serverInfo) for every server of the inventory on a
+    bounded thread pool. At most maxWorkers hosts are checked at once, and at
+    most maxSubnetWorkers of them share the same subnet. A host is only handed
+    to the pool when its subnet has a free slot, so a busy subnet never blocks
+    workers that could be serving another one.
+
+    Input: servers dict (as loaded from servers.json), task function,
+    global and per subnet concurrency
+    Output: tuple with the results and the errors, both dicts keyed by server
+    and ordered like the inventory'''
+
+    maxWorkers = max(1, maxWorkers)
+    maxSubnetWorkers = max(1, maxSubnetWorkers or maxWorkers)
+    queues = {}
+    for server in servers:
+        subnet = subnet_key(servers[server]['systemUrl'], prefix)
+        queues.setdefault(subnet, deque()).append(server)
+    subnetBusy = dict.fromkeys(queues, 0)
+    finished = {}
+    failed = {}
+    running = {}
+
+    def run(server):
+        start = time.monotonic()
+        try:
+            return task(server, servers[server])
+        finally:
+            print('Finished {} in {:.1f}s'.format(server, time.monotonic() - start))
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        while queues or running:
+            for subnet in list(queues):
+                queue = queues[subnet]
+                while queue and len(running) < maxWorkers and subnetBusy[subnet] < maxSubnetWorkers:
+                    server = queue.popleft()
+                    subnetBusy[subnet] += 1
+                    running[executor.submit(run, server)] = (server, subnet)
+                if not queue:
+                    del queues[subnet]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                server, subnet = running.pop(future)
+                subnetBusy[subnet] -= 1
+                try:
+                    finished[server] = future.result()
+                except Exception as e:
+                    sys.stderr.write('ERROR: {} failed: {!r}\n'.format(server, e))
+                    failed[server] = e
+
+    results = {server: finished[server] for server in servers if server in finished}
+    errors = {server: failed[server] for server in servers if server in failed}
+    return (results, errors)
+
+
+async def sweep_async(servers, task, maxHosts=MAX_ASYNC_HOSTS, maxSubnetHosts=MAX_SUBNET_WORKERS,
+                      prefix=SUBNET_PREFIX):
+    ''' Same as sweep, for coroutine tasks: one event loop checks up to
+    maxHosts servers at once, at most maxSubnetHosts of them per subnet.
+
+    Input: servers dict, coroutine function task(server, serverInfo),
+    global and per subnet concurrency
+    Output: tuple with the results and the errors, both dicts keyed by server
+    and ordered like the inventory'''
+
+    hostSlots = asyncio.Semaphore(max(1, maxHosts))
+    subnetSlots = {}
+
+    async def run(server):
+        subnet = subnet_key(servers[server]['systemUrl'], prefix)
+        if subnet not in subnetSlots:
+            subnetSlots[subnet] = asyncio.Semaphore(max(1, maxSubnetHosts or maxHosts))
+        async with subnetSlots[subnet], hostSlots:
+            start = time.monotonic()
+            try:
+                return await task(server, servers[server])
+            finally:
+                print('Finished {} in {:.1f}s'.format(server, time.monotonic() - start))
+
+    outcomes = await asyncio.gather(*[run(server) for server in servers], return_exceptions=True)
+    results = {}
+    errors = {}
+    for server, outcome in zip(servers, outcomes):
+        if isinstance(outcome, Exception):
+            sys.stderr.write('ERROR: {} failed: {!r}\n'.format(server, outcome))
+            errors[server] = outcome
+        else:
+            results[server] = outcome
+    return (results, errors)
@@ -0,0 +1,381 @@
+''' Declarative healthchecks.
+
+A vendor module describes its healthcheck as a list of checks, each one a
+title and a list of rules. Rules read sources:
+
+    resource(uri)                 the resource at uri
+    members(uri)                  the members of the collection at uri
+    links(source, field)          the resources linked from a field of each
+                                  resource of source (Links/PoweredBy...)
+    subcollection(source, name)   the members of the collection name under
+                                  each resource of source
+
+and turn them into healthcheck entries:
+
+    value(name, source, path)     a single value, e.g. Status/Health
+    items(name, source, ...)      OK, or 'Nok, check ...' with the labels of
+                                  the failing resources or list elements
+    self_tests(source, path)      one entry per ILO self test
+    group(name, rules, missing)   the rules, or {name: missing} on KeyError
+
+compile_plan turns the checks into a Plan: every source is fetched once,
+however many rules read it, and the sources only wait for the source they
+depend on, so all the requests of a healthcheck run in parallel. The plan
+also knows which fields are read from each resource (see projection).
+Paths are / separated, numbers index lists (Oem/Hp/Battery/0/Condition).'''
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import fanout
+import async_redfish
+import span_trace
+import redfish_metrics
+
+
+def resource(uri):
+    return ('resource', uri)
+
+
+def members(uri):
+    return ('members', uri)
+
+
+def links(source, field, contains=None, pattern=None):
+    ''' Resources linked from field of each resource of source. Only the uris
+    containing contains are followed. pattern is the uri pattern of the linked
+    resources, so their fields can be projected.'''
+
+    return ('links', source, field, contains, pattern)
+
+
+def subcollection(source, name):
+    return ('subcollection', source, name)
+
+
+def value(name, source, path, missing=None):
+    ''' Entry name is the value at path in the resource of source, or missing
+    when it does not exist (KeyError when missing is None).'''
+
+    return {'rule': 'value', 'name': name, 'source': source, 'path': path, 'missing': missing}
+
+
+def items(name, source, label, message, field=None, ok=('Status/Health', 'OK'), exempt=None,
+          skip=(), missing=None, onlyNok=False):
+    ''' Entry name is OK when all the elements pass, otherwise message
+    followed by their labels. Elements are the resources of source, or the
+    elements of the list at field in each of them. An element fails when the
+    value at ok[0] is not ok[1], unless the value at exempt[0] is exempt[1].
+
+    skip: exceptions that make an element be ignored
+    missing: value of the entry on KeyError (KeyError is raised when None)
+    onlyNok: the entry is left out when all the elements pass'''
+
+    return {'rule': 'items', 'name': name, 'source': source, 'label': label, 'message': message,
+            'field': field, 'ok': ok, 'exempt': exempt, 'skip': tuple(skip), 'missing': missing,
+            'onlyNok': onlyNok}
+
+
+def self_tests(source, path):
+    ''' One entry per ILO self test at path, with its status. Informational
+    tests are left out.'''
+
+    return {'rule': 'self_tests', 'source': source, 'path': path}
+
+
+def group(name, rules, missing):
+    return {'rule': 'group', 'name': name, 'rules': rules, 'missing': missing}
+
+
+def get_path(data, path):
+    ''' Value at a / separated path, numbers index lists. Raises KeyError
+    (or IndexError/TypeError) when the value does not exist.'''
+
+    for key in path.split('/'):
+        data = data[int(key)] if key.isdigit() and isinstance(data, list) else data[key]
+    return data
+
+
+def source_key(source):
+    ''' Sources reading the same uris share the same key, whatever the case
+    and trailing slashes of the uris.'''
+
+    return tuple(source_key(part) if isinstance(part, tuple) else
+                 part.rstrip('/').lower() if isinstance(part, str) and part.startswith('/') else part
+                 for part in source)
+
+
+def _parent(source):
+    return source[1] if source[0] in ('links', 'subcollection') else None
+
+
+def _rules(rules):
+    for rule in rules:
+        if rule['rule'] == 'group':
+            yield from _rules(rule['rules'])
+        else:
+            yield rule
+
+
+def _field_path(path):
+    # $select and projection work on properties, not on list elements
+    keys = []
+    for key in path.split('/'):
+        if key.isdigit():
+            break
+        keys.append(key)
+    return '/'.join(keys)
+
+
+class Plan(object):
+    ''' Compiled healthcheck: the checks, the distinct sources they read in
+    dependency order, and the fields read from each uri pattern.'''
+
+    def __init__(self, checks):
+        self.checks = checks
+        self.sources = []
+        self._keys = set()
+        reads = {}
+        for _, rules in checks:
+            for rule in _rules(rules):
+                self._add(rule['source'])
+                paths = reads.setdefault(source_key(rule['source']), [])
+                if rule['rule'] == 'items' and rule['field'] is None:
+                    paths += [rule['ok'][0], rule['label']] + ([rule['exempt'][0]] if rule['exempt'] else [])
+                else:
+                    paths.append(rule['path'] if 'path' in rule else rule['field'])
+        for source in self.sources:
+            if source[0] == 'links':
+                reads.setdefault(source_key(source[1]), []).append(source[2])
+        self.fields = {}
+        for source in self.sources:
+            pattern = self._pattern(source)
+            if pattern is None:
+                continue
+            fields = self.fields.setdefault(pattern, [])
+            for path in reads.get(source_key(source), []):
+                path = _field_path(path)
+                if path and path not in fields:
+                    fields.append(path)
+
+    def _add(self, source):
+        if source_key(source) in self._keys:
+            return
+        if _parent(source) is not None:
+            self._add(_parent(source))
+        self._keys.add(source_key(source))
+        self.sources.append(source)
+
+    def _pattern(self, source):
+        if source[0] == 'resource':
+            return source[1]
+        if source[0] == 'members':
+            return source[1].rstrip('/') + '/*'
+        if source[0] == 'links':
+            return source[4]
+        parentPattern = self._pattern(source[1])
+        if parentPattern is None:
+            return None
+        return parentPattern.rstrip('/') + '/' + source[2] + '/*'
+
+
+def compile_plan(checks):
+    ''' Input: list of (title, rules) checks, in the order of the healthcheck
+    Output: Plan'''
+
+    return Plan(checks)
+
+
+def _linked_uris(parentItems, field, contains):
+    return [uri for _, data in parentItems for uri in fanout.member_uris(get_path(data, field))
+            if contains is None or contains in uri]
+
+
+def _resolve(connection, source, parent):
+    ''' Fetches a source, once the source it depends on is fetched.
+
+    Output: list of (uri, resource) tuples'''
+
+    kind = source[0]
+    if kind == 'resource':
+        return [(source[1], connection.get(source[1]).dict)]
+    if kind == 'members':
+        return [(uri, response.dict) for uri, response in fanout.get_members(connection, source[1], withUris=True)]
+    parentItems = parent.result()
+    if kind == 'links':
+        uris = _linked_uris(parentItems, source[2], source[3])
+        return [(uri, response.dict) for uri, response in zip(uris, fanout.get_all(connection, uris))]
+    collections = fanout.get_collections(connection, [uri.rstrip('/') + '/' + source[2] for uri, _ in parentItems],
+                                         withUris=True)
+    return [(uri, response.dict) for collection in collections for uri, response in collection]
+
+
+async def _resolve_async(connection, source, parent):
+    kind = source[0]
+    if kind == 'resource':
+        return [(source[1], (await connection.get(source[1])).dict)]
+    if kind == 'members':
+        return [(uri, response.dict)
+                for uri, response in await async_redfish.get_members(connection, source[1], withUris=True)]
+    parentItems = await parent
+    if kind == 'links':
+        uris = _linked_uris(parentItems, source[2], source[3])
+        return [(uri, response.dict) for uri, response in zip(uris, await async_redfish.get_all(connection, uris))]
+    collections = await async_redfish.get_collections(
+        connection, [uri.rstrip('/') + '/' + source[2] for uri, _ in parentItems], withUris=True)
+    return [(uri, response.dict) for collection in collections for uri, response in collection]
+
+
+def _failing(element, ok, exempt):
+    return get_path(element, ok[0]) != ok[1] and (exempt is None or get_path(element, exempt[0]) != exempt[1])
+
+
+def _evaluate(rule, fetched, health):
+    kind = rule['rule']
+    if kind == 'group':
+        groupHealth = {}
+        try:
+            for groupRule in rule['rules']:
+                _evaluate(groupRule, fetched, groupHealth)
+        except KeyError:
+            health[rule['name']] = rule['missing']
+        else:
+            health.update(groupHealth)
+        return
+    if kind == 'value':
+        try:
+            health[rule['name']] = get_path(fetched(rule['source'])[0][1], rule['path'])
+        except KeyError:
+            if rule['missing'] is None:
+                raise
+            health[rule['name']] = rule['missing']
+        return
+    if kind == 'self_tests':
+        for test in get_path(fetched(rule['source'])[0][1], rule['path']):
+            if test['Status'] == 'Informational':
+                continue
+            health[test['SelfTestName']] = test['Status']
+        return
+    failed = []
+    try:
+        for _, data in fetched(rule['source']):
+            for element in (get_path(data, rule['field']) if rule['field'] else [data]):
+                try:
+                    if _failing(element, rule['ok'], rule['exempt']):
+                        failed.append(get_path(element, rule['label']))
+                except rule['skip']:
+                    continue
+    except KeyError:
+        if rule['missing'] is None:
+            raise
+        health[rule['name']] = rule['missing']
+        return
+    if len(failed) > 0:
+        health[rule['name']] = rule['message'] + ', '.join(failed)
+    elif not rule['onlyNok']:
+        health[rule['name']] = 'OK'
+
+
+def evaluate(plan, fetched):
+    ''' Builds the healthcheck dictionary from the fetched sources, in the
+    order of the checks. fetched(source) returns the (uri, resource) list of
+    a source, or raises the error met fetching it.'''
+
+    health = {}
+    for title, rules in plan.checks:
+        print('Checking {}...'.format(title))
+        for rule in rules:
+            _evaluate(rule, fetched, health)
+    return health
+
+
+def describe(source):
+    ''' Short description of a source, e.g. members /redfish/v1/Systems/1/Memory.'''
+
+    if source[0] in ('resource', 'members'):
+        return '{} {}'.format(source[0], source[1])
+    return '{} {} of {}'.format(source[0], source[2], describe(source[1]))
+
+
+def observe_checks(connection, plan, start, finished):
+    ''' Records how long each check waited for its sources, from the start
+    of the plan, in the metrics (see redfish_metrics) and as phase spans of
+    the trace (see span_trace) of the connection.
+
+    Input: connection, Plan, start time and {source key: (time it was
+    fetched, seconds its requests waited on the BMC, description)}'''
+
+    durations = {}
+    host = span_trace.host_of(connection)
+    for title, rules in plan.checks:
+        keys = set(source_key(rule['source']) for rule in _rules(rules)) & set(finished)
+        if not keys:
+            continue
+        critical = max(keys, key=lambda key: finished[key][0])
+        durations[title] = finished[critical][0] - start
+        span_trace.add_span(title, host, 'phase', start, finished[critical][0], lane='phase ' + title,
+                            bmcWaitMs=round(sum(finished[key][1] for key in keys) * 1000, 3),
+                            criticalSource=finished[critical][2])
+    end = max((fetched[0] for fetched in finished.values()), default=start)
+    redfish_metrics.observe_checks(connection, durations, end - start)
+
+
+def run_plan(connection, plan):
+    ''' Fetches all the sources of a plan in parallel (each one waits only for
+    the source it depends on) and evaluates the checks.
+
+    Input: redfish connection and Plan
+    Output: dictionary with the health status'''
+
+    futures = {}
+    finished = {}
+    host = span_trace.host_of(connection)
+    start = time.perf_counter()
+
+    def resolve(source, parent):
+        sourceSpan = None
+        try:
+            with span_trace.span(describe(source), host, 'source') as sourceSpan:
+                return _resolve(connection, source, parent)
+        finally:
+            finished[source_key(source)] = (time.perf_counter(), sourceSpan.wait if sourceSpan else 0,
+                                            describe(source))
+
+    # Sources are submitted in dependency order and each has its own worker,
+    # so a source never waits for a parent that did not start
+    with ThreadPoolExecutor(max_workers=len(plan.sources)) as executor:
+        for source in plan.sources:
+            parent = futures.get(source_key(_parent(source))) if _parent(source) else None
+            futures[source_key(source)] = executor.submit(span_trace.in_context(resolve), source, parent)
+        wait(futures.values())
+        observe_checks(connection, plan, start, finished)
+        return evaluate(plan, lambda source: futures[source_key(source)].result())
+
+
+async def run_plan_async(connection, plan):
+    ''' Async version of run_plan, for an async_redfish client.'''
+
+    tasks = {}
+    finished = {}
+    host = span_trace.host_of(connection)
+    start = time.perf_counter()
+
+    async def resolve(source, parent):
+        sourceSpan = None
+        try:
+            with span_trace.span(describe(source), host, 'source') as sourceSpan:
+                return await _resolve_async(connection, source, parent)
+        finally:
+            finished[source_key(source)] = (time.perf_counter(), sourceSpan.wait if sourceSpan else 0,
+                                            describe(source))
+
+    for source in plan.sources:
+        parent = tasks.get(source_key(_parent(source))) if _parent(source) else None
+        tasks[source_key(source)] = asyncio.ensure_future(resolve(source, parent))
+    await asyncio.wait(list(tasks.values()))
+    observe_checks(connection, plan, start, finished)
+    for task in tasks.values():
+        # Errors are raised by the rules reading the source, not by the loop
+        task.exception()
+    return evaluate(plan, lambda source: tasks[source_key(source)].result())
@@ -1,13 +1,27 @@
 import sys
-import redfish
 import json
 
+import uri_crawler
+import topology_cache
+import host_guard
+
 # Main Uri addresses
 ROOT_URI = '/redfish/v1/'
 ILOSYS_URI = '/redfish/v1/systems/1'
 IDRACSYS_URI = '/redfish/v1/Systems/System.Embedded.1'
+ILOMAN_URI = '/redfish/v1/managers/1'
+IDRACMAN_URI = '/redfish/v1/Managers/iDRAC.Embedded.1'
 # HP Resource URI
 RESOURCE_URI = '/redfish/v1/ResourceDirectory/'
+# System and manager uris, and the collections whose member counts tell
+# servers of the same model apart
+TOPOLOGY_URIS = {
+    'HP': (ILOSYS_URI, ILOMAN_URI, [ILOSYS_URI + '/Memory', ILOSYS_URI + '/Processors',
+                                    ILOSYS_URI + '/EthernetInterfaces',
+                                    ILOSYS_URI + '/SmartStorage/ArrayControllers', '/redfish/v1/Chassis']),
+    'Dell': (IDRACSYS_URI, IDRACMAN_URI, [IDRACSYS_URI + '/Memory', IDRACSYS_URI + '/Processors',
+                                          IDRACSYS_URI + '/EthernetInterfaces', IDRACSYS_URI + '/Storage',
+                                          '/redfish/v1/Chassis'])}
 
 # Populate server list
 def parse_json(filename):  # Parses the JSON data from a file, populates a Python dict with the data and returns it.
@@ -25,15 +39,18 @@ def parse_json(filename):  # Parses the JSON data from a file, populates a Pytho
 def open_connection(systemUrl, loginAccount, loginPassword):
     ''' Open a https session using redfish to a target server.
     If the connection is not established, either the server is down or redfish
-    is not supported.    
+    is not supported: the error of the redfish library is raised, as is
+    host_guard.UnknownServerError for a server that is neither HP nor Dell.
 
     Input: server address, user account and password
     Output: returns an object with the open session'''
-    
+
+    import redfish
+
+    serverConnection = redfish.RedfishClient(base_url=systemUrl, username=loginAccount,
+                                  password=loginPassword, **host_guard.client_options())
+    serverConnection.login()
     try:
-        serverConnection = redfish.RedfishClient(base_url=systemUrl, username=loginAccount,
-                                      password=loginPassword)
-        serverConnection.login()
         serverInfo = serverConnection.get(ROOT_URI).dict
         if 'Hp' in serverInfo['Oem'] or 'Hpe' in serverInfo['Oem']:
             serverInfo = serverConnection.get(ILOSYS_URI).dict
@@ -42,13 +59,11 @@ def open_connection(systemUrl, loginAccount, loginPassword):
             serverInfo = serverConnection.get(IDRACSYS_URI).dict
             serverType = 'Dell'
         else:
-            print('Unknown server')
-            serverConnection.logout()
-            sys.exit()
-        print('Connected to', serverInfo['HostName'], 'Vendor:', serverType)
-    except redfish.ServerDownOrUnreachableError:
-        sys.stderr.write("ERROR: server not reachable or doesn't support Redfish.\n")
-        sys.exit()
+            raise host_guard.UnknownServerError('Unknown server ' + systemUrl)
+    except BaseException:
+        serverConnection.logout()
+        raise
+    print('Connected to', serverInfo['HostName'], 'Vendor:', serverType)
     return (serverConnection, serverType)
 
 
@@ -68,24 +83,15 @@ def ilo_item_generator(ilo_data, lookup_key='@odata.id'):
         for item in ilo_data:
             yield from ilo_item_generator(item, lookup_key)
 
-def map_idrac(serverConnection, idracData, uriList=[]):
-    lookup = '@odata.id'
-    if isinstance(idracData, dict):
-        if lookup in idracData and idracData[lookup] not in uriList:
-            uriList.append(idracData[lookup])
-            uri = parse_uri(serverConnection, idracData[lookup])
-            map_idrac(serverConnection, uri, uriList)
-       
-        for key, value in idracData.items():
-            if isinstance(value, list) or isinstance(value, dict):
-                map_idrac(serverConnection, value, uriList)
-   
-    elif isinstance(idracData, list):
-        for element in idracData:
-            if isinstance(element, list) or isinstance(element, dict):
-                map_idrac(serverConnection, element, uriList)
-   
-    return uriList
+def map_idrac(serverConnection, idracData, visit=None):
+    ''' Crawls the iDRAC tree breadth first from the uris referenced in
+    idracData (see uri_crawler), visit(uri, resource) is called with every
+    fetched resource.
+
+    Input: redfish connection and resource to start from
+    Output: list with the crawled uris'''
+
+    return uri_crawler.crawl(serverConnection, list(ilo_item_generator(idracData)), visit)
 
 def find_status(serverData):
     lookup = 'Status'
@@ -104,34 +110,65 @@ def find_status(serverData):
    
     return False
 
+def map_server(serverConnection, serverType):
+    ''' Crawls a server for the uris reporting a health status.
+
+    Input: redfish connection and server type
+    Output: list with the health status uris'''
+
+    hcUris = []
+
+    def add_status_uri(uri, uriData):
+        # Runs on the responses of the crawl, no uri is fetched twice
+        if find_status(uriData):
+            hcUris.append(uri)
+
+    print('Filtering health status uris.')
+    if serverType == 'HP':
+        resourceUris = serverConnection.get(RESOURCE_URI).dict
+        uri_crawler.crawl(serverConnection, list(ilo_item_generator(resourceUris)), add_status_uri,
+                          follow=False)
+
+    elif serverType == 'Dell':
+        idracData = serverConnection.get(ROOT_URI).dict
+        map_idrac(serverConnection, idracData, add_status_uri)
+
+    return hcUris
+
 def build_hc_uris(serversFile):
+    ''' Maps the health status uris of every server of serversFile into
+    serverData.json. A server that fails keeps its previous HC_uris, if any,
+    and gets its failure (see host_guard.failure_result) in 'Failure'; the
+    other servers are still mapped.'''
+
     serversDict = parse_json(serversFile)
-    
+
+    def map_uris(serverInfo):
+        serverConnection, serverType = open_connection(**serversDict[serverInfo])
+        try:
+            # Servers of an already mapped model, firmware and fingerprint
+            # inherit its uris, only new topologies are crawled
+            topology = topology_cache.server_topology(serverConnection, serverType, *TOPOLOGY_URIS[serverType])
+            return topology_cache.discover(serverConnection, topology,
+                                           lambda: map_server(serverConnection, serverType))
+        finally:
+            serverConnection.logout()
+
     for serverInfo in serversDict:
         
         print('Mapping Healthcheck uris for', serverInfo)
-        serverConnection, serverType = open_connection(**serversDict[serverInfo])
-        
-        hcUris = []
-        
-        if serverType == 'HP':
-            resourceUris = serverConnection.get(RESOURCE_URI).dict
-            uriList = list(ilo_item_generator(resourceUris))
-            
-        elif serverType == 'Dell':
-            idracData = serverConnection.get(ROOT_URI).dict
-            uriList = map_idrac(serverConnection, idracData)
-            
-        print('Filtering health status uris.')
-        for uri in uriList:
-            uriData = parse_uri(serverConnection, uri)
-            if find_status(uriData):
-                hcUris.append(uri)
-        
+        serverData = serversDict[serverInfo]
+        try:
+            hcUris = host_guard.check_host(serverInfo, serverData['systemUrl'], lambda: map_uris(serverInfo))
+        except host_guard.HostFailure as e:
+            sys.stderr.write('ERROR: {}: {}\n'.format(serverInfo, e))
+            serverData['Failure'] = e.result['Failure']
+            continue
+
         print('Adding health status uri list to', serverInfo)        
-        serversDict[serverInfo]['HC_uris'] = hcUris
+        serverData.pop('Failure', None)
+        serverData['HC_uris'] = hcUris
         print('Done!')
-        serverConnection.logout()
     
     print('Creating server data json file...')
     with open('serverData.json', 'w') as outfile:
@@ -0,0 +1,226 @@
+''' Health history: every healthcheck written to an SQLite database as one
+row per component, (host, timestamp, component, status, detail), so
+questions like "which hosts had Disk drives Nok in the last week" are an
+indexed query instead of a scan of json files.
+
+    python health_history.py --component "Disk drives" --status Nok --days 7
+'''
+
+import sys
+import json
+import sqlite3
+import argparse
+import datetime
+import threading
+
+import snapshot_diff
+
+# Database of the history
+HISTORY_DB = 'hc history.db'
+# Rows inserted per transaction
+BATCH_ROWS = 500
+# Seconds rows wait at most before they are inserted, when fewer come
+FLUSH_INTERVAL = 10
+# Format of serverHC['Date'], sorts like the dates it holds
+DATE_FORMAT = '%Y-%m-%d %H:%M'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS health (
+    host TEXT NOT NULL,
+    hostname TEXT,
+    timestamp TEXT NOT NULL,
+    component TEXT NOT NULL,
+    status TEXT NOT NULL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS health_host ON health (host, timestamp);
+CREATE INDEX IF NOT EXISTS health_component ON health (component, status, timestamp);
+CREATE INDEX IF NOT EXISTS health_status ON health (status, timestamp);
+'''
+
+
+def open_db(path=HISTORY_DB):
+    ''' Opens the history database in WAL mode, so queries run while a sweep
+    writes, and creates the table and indexes when missing.'''
+
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(SCHEMA)
+    return db
+
+
+def normalize_status(value):
+    ''' Status of a healthcheck entry: OK, Nok (the 'Nok, check ...'
+    entries) or the value reported by the BMC (Warning, Absent...).'''
+
+    if not isinstance(value, str):
+        return json.dumps(value)
+    if value.upper() == 'OK':
+        return 'OK'
+    if value.startswith('Nok'):
+        return 'Nok'
+    return value
+
+
+def snapshot_rows(server, serverHC):
+    ''' Rows of one healthcheck, one per component (one per changed
+    component for the change events of snapshot_diff).
+
+    Input: server key and healthcheck dictionary
+    Output: list of (host, hostname, timestamp, component, status, detail)'''
+
+    timestamp = serverHC.get('Date') or datetime.datetime.now().strftime(DATE_FORMAT)
+    if 'Failure' in serverHC:
+        # Failed host (see host_guard), a single row
+        failure = serverHC['Failure']
+        return [(server, serverHC.get('Hostname'), timestamp, 'Failure', 'Failed',
+                 '{}: {}'.format(failure['Error'], failure['Message']))]
+    if 'Changes' in serverHC:
+        # Change event of snapshot_diff, only the components that changed
+        values = {component: change['to'] for component, change in serverHC['Changes'].items()
+                  if change['to'] is not None and component not in snapshot_diff.COMPARED_FIELDS}
+    else:
+        values = serverHC.get('Healthcheck') or {}
+    rows = []
+    for component, value in values.items():
+        status = normalize_status(value)
+        detail = value if isinstance(value, str) else json.dumps(value)
+        rows.append((server, serverHC.get('Hostname'), timestamp, component, status,
+                     None if detail == status else detail))
+    return rows
+
+
+class HistorySink(object):
+    ''' Result sink (see result_sinks) storing the healthchecks in the
+    history database. Rows are inserted in batches of batchRows, one
+    transaction each, or flushInterval seconds after the first pending row,
+    so a slow stream (a poll daemon in diff mode) is queryable right away,
+    and the rest on close.'''
+
+    def __init__(self, path=HISTORY_DB, batchRows=BATCH_ROWS, flushInterval=FLUSH_INTERVAL):
+        self.name = path
+        self.usesStdout = False
+        self.batchRows = batchRows
+        self.flushInterval = flushInterval
+        self._db = open_db(path)
+        self._rows = []
+        self._timer = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def write(self, server, serverHC):
+        with self._lock:
+            self._rows += snapshot_rows(server, serverHC)
+            if len(self._rows) >= self.batchRows:
+                self.flush()
+            elif self._rows and self._timer is None and self.flushInterval:
+                self._timer = threading.Timer(self.flushInterval, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _timed_flush(self):
+        with self._lock:
+            self._timer = None
+            if not self._closed:
+                self.flush()
+
+    def flush(self):
+        ''' Inserts the pending rows. Called with the lock held.'''
+
+        if not self._rows:
+            return
+        with self._db:
+            self._db.executemany('INSERT INTO health VALUES (?, ?, ?, ?, ?, ?)', self._rows)
+        self._rows = []
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self.flush()
+            self._closed = True
+            self._db.close()
+
+
+def query(db, host=None, component=None, status=None, since=None, until=None, limit=None):
+    ''' Rows of the history matching all the given filters, newest first.
+
+    Input: database, host (server key), component, status (OK, Nok...),
+    since/until timestamps ('YYYY-MM-DD HH:MM', or a prefix such as
+    'YYYY-MM-DD') and maximum number of rows
+    Output: list of (host, hostname, timestamp, component, status, detail)'''
+
+    conditions = []
+    params = []
+    for column, value in (('host', host), ('component', component), ('status', status)):
+        if value is not None:
+            conditions.append('{} = ?'.format(column))
+            params.append(value)
+    if since is not None:
+        conditions.append('timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('timestamp < ?')
+        params.append(until)
+    sql = 'SELECT host, hostname, timestamp, component, status, detail FROM health'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY timestamp DESC, host, component'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return db.execute(sql, params).fetchall()
+
+
+def hosts_with(db, component, status='Nok', since=None):
+    ''' Hosts that reported component with status, and how many times.
+
+    Output: list of (host, hostname, count, last timestamp), most frequent
+    first'''
+
+    sql = ('SELECT host, hostname, COUNT(*), MAX(timestamp) FROM health '
+           'WHERE component = ? AND status = ?')
+    params = [component, status]
+    if since is not None:
+        sql += ' AND timestamp >= ?'
+        params.append(since)
+    sql += ' GROUP BY host ORDER BY COUNT(*) DESC, host'
+    return db.execute(sql, params).fetchall()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query the healthcheck history.')
+    parser.add_argument('--db', default=HISTORY_DB, help='history database')
+    parser.add_argument('--host', help='server key, as in servers.json')
+    parser.add_argument('--component', help='healthcheck entry, e.g. "Disk drives"')
+    parser.add_argument('--status', help='OK, Nok or a status reported by the BMC')
+    parser.add_argument('--since', help="'YYYY-MM-DD[ HH:MM]'")
+    parser.add_argument('--until', help="'YYYY-MM-DD[ HH:MM]'")
+    parser.add_argument('--days', type=int, help='only the last days, instead of --since')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--hosts', action='store_true',
+                        help='count per host instead of rows (needs --component)')
+    args = parser.parse_args(argv)
+
+    since = args.since
+    if args.days is not None:
+        since = (datetime.datetime.now() - datetime.timedelta(days=args.days)).strftime(DATE_FORMAT)
+    db = open_db(args.db)
+    try:
+        if args.hosts:
+            if args.component is None:
+                parser.error('--hosts needs --component')
+            rows = hosts_with(db, args.component, args.status or 'Nok', since)
+        else:
+            rows = query(db, args.host, args.component, args.status, since, args.until, args.limit)
+    finally:
+        db.close()
+    for row in rows:
+        print('\t'.join('' if field is None else str(field) for field in row))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
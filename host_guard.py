@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import asyncio
+import datetime
+import threading
+
+import fanout
+import async_redfish
+
+# Seconds to connect to a BMC and to wait for each response
+CONNECT_TIMEOUT = async_redfish.CONNECT_TIMEOUT
+READ_TIMEOUT = async_redfish.READ_TIMEOUT
+# Retries of a failed request by the redfish library (its default is 50)
+RETRIES = 1
+# Seconds a host may take for its whole healthcheck
+HOST_DEADLINE = 300
+# Hosts failing this many times in a row are skipped for COOLDOWN seconds
+FAILURE_THRESHOLD = 3
+COOLDOWN = 1800
+# State of the circuit breakers, one file per host
+BREAKER_DIR = 'hc breakers'
+
+# Format of the Date of the results
+DATE_FORMAT = '%Y-%m-%d %H:%M'
+
+
+class UnknownServerError(Exception):
+    ''' The service root is neither an ILO nor an IDRAC.'''
+
+
+class UnsupportedFirmwareError(Exception):
+    ''' No healthcheck module supports the firmware of the BMC.'''
+
+
+class DeadlineExceeded(Exception):
+    ''' The host did not finish its healthcheck within its deadline.'''
+
+
+class CircuitOpenError(Exception):
+    ''' The host failed too often, it is skipped until its cooldown ends.'''
+
+
+class HostFailure(Exception):
+    ''' Failure of one host, with its structured result (see
+    failure_result) in .result.'''
+
+    def __init__(self, result):
+        Exception.__init__(self, '{Error}: {Message}'.format(**result['Failure']))
+        self.result = result
+
+
+def client_options(connectTimeout=CONNECT_TIMEOUT, readTimeout=READ_TIMEOUT, retries=RETRIES):
+    ''' Keyword arguments of redfish.RedfishClient bounding the time of each
+    request, instead of the library defaults (80 minutes, 50 retries).
+    Throttled requests (503 with Retry-After) are not retried by urllib3,
+    adaptive_limit retries them.'''
+
+    import urllib3
+
+    return {'timeout': urllib3.util.Timeout(connect=connectTimeout, read=readTimeout),
+            'retries': urllib3.util.Retry(total=retries, connect=retries, read=retries, redirect=3,
+                                          respect_retry_after_header=False)}
+
+
+def failure_kind(error):
+    ''' Short name of the cause of a failure.'''
+
+    # Imported here so the async sweeps and the CLI start without them
+    import urllib3
+    from redfish.rest.v1 import ServerDownOrUnreachableError, InvalidCredentialsError
+    from redfish.rest.connections import RetriesExhaustedError
+
+    if isinstance(error, CircuitOpenError):
+        return 'circuit open'
+    if isinstance(error, (DeadlineExceeded, asyncio.TimeoutError)):
+        return 'deadline'
+    if isinstance(error, UnknownServerError):
+        return 'unknown server'
+    if isinstance(error, UnsupportedFirmwareError):
+        return 'unsupported firmware'
+    if isinstance(error, InvalidCredentialsError):
+        return 'credentials'
+    if isinstance(error, (ServerDownOrUnreachableError, RetriesExhaustedError, OSError,
+                          urllib3.exceptions.HTTPError)):
+        return 'unreachable'
+    return 'error'
+
+
+def failure_result(server, systemUrl, error):
+    ''' Result written to the sinks for a host that failed, in place of its
+    healthcheck.
+
+    Output: {"Hostname": None, "Host address", "Date", "Failure": {"Error":
+    failure_kind, "Message", "Server"}}'''
+
+    return {'Hostname': None, 'Host address': systemUrl,
+            'Date': datetime.datetime.now().strftime(DATE_FORMAT),
+            'Failure': {'Error': failure_kind(error), 'Message': str(error) or type(error).__name__,
+                        'Server': server}}
+
+
+class CircuitBreaker(object):
+    ''' On-disk circuit breaker per host, shared by the sweeps. After
+    threshold failures in a row a host is skipped for cooldown seconds, then
+    tried again: one more failure skips it for another cooldown, a success
+    resets it. Files are written atomically.'''
+
+    def __init__(self, directory=BREAKER_DIR, threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN):
+        self.directory = directory
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    def _path(self, host):
+        name = host.split('://')[-1].rstrip('/').replace(':', '_').replace('/', '_')
+        return os.path.join(self.directory, name + '.json')
+
+    def _load(self, host):
+        try:
+            with open(self._path(host)) as breakerFile:
+                return json.load(breakerFile)
+        except (OSError, ValueError):
+            return {'failures': 0, 'openUntil': 0}
+
+    def _save(self, host, state):
+        path = self._path(host)
+        tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmpPath, 'w') as breakerFile:
+                json.dump(state, breakerFile)
+            os.replace(tmpPath, path)
+        except OSError:
+            pass
+
+    def open_until(self, host):
+        ''' Time (time.time) until which the host is skipped, 0 when it is
+        not.'''
+
+        openUntil = self._load(host)['openUntil']
+        return openUntil if openUntil > time.time() else 0
+
+    def success(self, host):
+        with self._lock:
+            try:
+                os.remove(self._path(host))
+            except OSError:
+                pass
+
+    def failure(self, host, failure):
+        with self._lock:
+            state = self._load(host)
+            state['failures'] += 1
+            state['lastFailure'] = failure
+            if state['failures'] >= self.threshold:
+                state['openUntil'] = time.time() + self.cooldown
+            self._save(host, state)
+
+
+_defaultBreaker = None
+_defaultLock = threading.Lock()
+
+
+def default_breaker():
+    ''' Breaker shared by all the sweeps of the process.'''
+
+    global _defaultBreaker
+    with _defaultLock:
+        if _defaultBreaker is None:
+            _defaultBreaker = CircuitBreaker()
+    return _defaultBreaker
+
+
+class DeadlineConnection(object):
+    ''' Wraps a redfish connection so that no request starts after the
+    deadline (time.monotonic) of the host. A request in flight ends at worst
+    with its read timeout. Everything but get is passed through to the
+    wrapped connection.'''
+
+    def __init__(self, connection, deadline):
+        self.connection = connection
+        self.deadline = deadline
+
+    def get(self, path, *args, **kwargs):
+        if time.monotonic() > self.deadline:
+            raise DeadlineExceeded('deadline exceeded before GET ' + path)
+        return self.connection.get(path, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def deadlined(connection, deadline):
+    ''' Returns the connection wrapped in a DeadlineConnection, the
+    connection itself without deadline or when it already has one.'''
+
+    if deadline is None or fanout.find_wrapper(connection, DeadlineConnection) is not None:
+        return connection
+    return DeadlineConnection(connection, deadline)
+
+
+def _skip(systemUrl, breaker):
+    openUntil = breaker.open_until(systemUrl)
+    if not openUntil:
+        return None
+    return CircuitOpenError('skipped until {} after {} failures'.format(
+        time.strftime('%H:%M:%S', time.localtime(openUntil)), breaker.threshold))
+
+
+def _failed(server, systemUrl, error, sink, breaker):
+    result = failure_result(server, systemUrl, error)
+    if not isinstance(error, CircuitOpenError):
+        breaker.failure(systemUrl, result['Failure'])
+    if sink is not None:
+        sink.write(server, result)
+    return HostFailure(result)
+
+
+def check_host(server, systemUrl, check, sink=None, breaker=None):
+    ''' Runs check() for a host, unless its circuit breaker is open. Any
+    failure is written to sink as a structured result (see failure_result)
+    and raised as HostFailure, so the sweep goes on with the other hosts.
+
+    Input: server key, address, check function, result sink and breaker
+    Output: the result of check'''
+
+    breaker = breaker or default_breaker()
+    error = _skip(systemUrl, breaker)
+    if error is None:
+        try:
+            result = check()
+        except Exception as e:
+            error = e
+        else:
+            breaker.success(systemUrl)
+            return result
+    raise _failed(server, systemUrl, error, sink, breaker) from error
+
+
+async def check_host_async(server, systemUrl, check, sink=None, breaker=None, deadline=None):
+    ''' Async version of check_host: the coroutine check() is cancelled
+    when it takes longer than deadline seconds (HOST_DEADLINE by default).'''
+
+    breaker = breaker or default_breaker()
+    deadline = deadline or HOST_DEADLINE
+    error = _skip(systemUrl, breaker)
+    if error is None:
+        try:
+            result = await asyncio.wait_for(check(), deadline)
+        except asyncio.TimeoutError:
+            error = DeadlineExceeded('no healthcheck after {}s'.format(deadline))
+        except Exception as e:
+            error = e
+        else:
+            breaker.success(systemUrl)
+            return result
+    raise _failed(server, systemUrl, error, sink, breaker) from error
@@ -1,5 +1,9 @@
 import sys
-import redfish
+import fanout
+import hc_plan
+import session_cache
+import projection
+import etag_cache
 
 # Main Uri addresses
 SYSTEMS_URI = '/redfish/v1/Systems/System.Embedded.1'
@@ -11,203 +15,75 @@ STORAGE_URI = '/redfish/v1/Systems/System.Embedded.1/Storage'
 NETWORK_URI = '/redfish/v1/Systems/System.Embedded.1/NetworkAdapters'
 ETHIF_URI = '/redfish/v1/Systems/System.Embedded.1/EthernetInterfaces'
 
+SYSTEM = hc_plan.resource(SYSTEMS_URI)
+ARRAYS = hc_plan.members(STORAGE_URI)
+ADAPTERS = hc_plan.members(NETWORK_URI)
 
-def build_healthcheck(idrac):
+# Checks in the order they appear in the healthcheck
+PLAN = hc_plan.compile_plan([
+    ('chassis', [hc_plan.value('Chassis', hc_plan.resource(CHASSIS_URI), 'Status/Health')]),
+    ('power supplies', [
+        hc_plan.items('Power supplies', hc_plan.links(SYSTEM, 'Links/PoweredBy',
+                                                      pattern=CHASSIS_URI + '/Power/PowerSupplies/*'),
+                      'Name', 'Nok, check PSU: ')]),
+    ('system', [hc_plan.value('System', SYSTEM, 'Status/Health')]),
+    ('fans', [
+        hc_plan.items('Fans', hc_plan.links(SYSTEM, 'Links/CooledBy', pattern=CHASSIS_URI + '/Sensors/Fans/*'),
+                      'FanName', 'Nok, check fans: ')]),
+    ('temperatures', [
+        hc_plan.items('Temperatures', hc_plan.resource(THERMAL_URI), 'Name', 'Nok, check temperature: ',
+                      field='Temperatures', skip=[KeyError])]),
+    ('memory', [hc_plan.items('Memory', hc_plan.members(MEMORY_URI), 'Name', 'Nok, check mems: ')]),
+    ('processors', [hc_plan.items('Processors', hc_plan.members(PROCESSORS_URI), 'Name', 'Nok, check cpu: ')]),
+    ('storage', [
+        hc_plan.items('Array Controller', ARRAYS, 'Name', 'Nok, check array controller: '),
+        hc_plan.items('Virtual Disks', hc_plan.subcollection(ARRAYS, 'Volumes'), 'Name', 'Nok, check logical disk: '),
+        hc_plan.items('Disk drives', hc_plan.links(ARRAYS, 'Drives', pattern=STORAGE_URI + '/Drives/*'), 'Name',
+                      'Nok, check disk drive: '),
+        hc_plan.items('Storage Enclosure', hc_plan.links(ARRAYS, 'Links/Enclosures', contains='Enclosure',
+                                                         pattern='/redfish/v1/Chassis/*'),
+                      'Name', 'Nok, check enclosure: ')]),
+    ('network', [
+        hc_plan.items('Network adapters', ADAPTERS, 'Id', 'Nok, check adapter: ', ok=('Status/State', 'Enabled')),
+        hc_plan.items('Network device function', hc_plan.subcollection(ADAPTERS, 'NetworkDeviceFunctions'), 'Id',
+                      'Nok, check network device function: ', ok=('Status/State', 'Enabled')),
+        hc_plan.items('Network ports', hc_plan.subcollection(ADAPTERS, 'NetworkPorts'), 'Id',
+                      'Nok, check network port: ', ok=('Status/State', 'Enabled'))]),
+])
+
+# Fields read by the checks from each resource, * matches one uri segment
+FIELDS = PLAN.fields
+
+
+def build_healthcheck(idrac, maxInflight=None):
     ''' This function builds a dictionary with the hostname and health status
     of the idrac. (IDRAC 7)
     The dictionary contains bios, hardware and self test diagnostics.
     Most of the info is in nested dictionaries and lists, so I used iterations
     to structure the data into a simple dictionary.
+    The checks are described by PLAN, its requests run in parallel with at
+    most maxInflight requests sent to the idrac at once (by default the
+    adaptive limit of the connection, see adaptive_limit). Responses are cached
+    for the session, so each uri is only fetched once, and revalidated with
+    its ETag on the next sweeps.
     
     Input: redfish object with the idrac connection.
     Output: dictionary with the hostname and health status of the idrac'''
-    
-    idracHealth = {}
-    
-    # Chassis health
-    print('Checking chassis...')
-    idracObj = idrac.get(CHASSIS_URI)
-    idracHealth['Chassis'] = idracObj.dict['Status']['Health']
-    
-    # Power supplies
-    print('Checking power supplies')
-    idracObj = idrac.get(SYSTEMS_URI)
-    psuList = idracObj.dict['Links']['PoweredBy']
-    psuCheck = []
-    for psu in psuList:
-        for psu_uri in psu.values():
-            idracObj = idrac.get(psu_uri)
-            if idracObj.dict['Status']['Health'] != 'OK':
-                psuCheck.append(idracObj['Name'])
-    if len(psuCheck) > 0:
-        idracHealth['Power supplies'] = 'Nok, check PSU: ' + ', '.join(psuCheck)
-    else:
-        idracHealth['Power supplies'] = 'OK'
-        
-    # System health
-    print('Checking system...')
-    idracObj = idrac.get(SYSTEMS_URI)
-    idracHealth['System'] = idracObj.dict['Status']['Health']
-    
-    # Fan health
-    print('Checking fans...')
-    idracObj = idrac.get(SYSTEMS_URI)
-    fanList = idracObj.dict['Links']['CooledBy']
-    fanCheck = []
-    for fan in fanList:
-        for fan_uri in fan.values():
-            idracObj = idrac.get(fan_uri)
-            if idracObj.dict['Status']['Health'] != 'OK':
-                    fanCheck.append(idracObj.dict['FanName'])
-    if len(fanCheck) > 0:
-        idracHealth['Fans'] = 'Nok, check fans: ' + ', '.join(fanCheck)
-    else:
-        idracHealth['Fans'] = 'OK'   
-        
-    # Temperatures
-    print('Checking temperatures...')
-    idracObj = idrac.get(THERMAL_URI)
-    tempList = idracObj.dict['Temperatures']
-    tempCheck = []
-    for element in tempList:
-        try:
-            if element['Status']['Health'] != 'OK':
-                tempCheck.append(element['Name'])
-        except KeyError:
-            continue
-    if len(tempCheck) > 0:
-        idracHealth['Temperatures'] = 'Nok, check temperature: ' + ', '.join(tempCheck)
-    else:
-        idracHealth['Temperatures'] = 'OK'
-    
-    # Memory health
-    print('Checking memory...')
-    idracObj = idrac.get(MEMORY_URI)
-    memList = idracObj.dict['Members']
-    memCheck = []
-    for mem in memList:
-        for mem_uri in mem.values():
-            idracObj = idrac.get(mem_uri)
-            if idracObj.dict['Status']['Health'] != 'OK':
-                memCheck.append(idrac.dict['Name'])
-    if len(memCheck) > 0:
-        idracHealth['Memory'] = 'Nok, check mems: ' + ', '.join(memCheck)
-    else:
-        idracHealth['Memory'] = 'OK'
-    
-    # Cpu Health
-    print('Checking processors...')
-    idracObj = idrac.get(PROCESSORS_URI)
-    cpuList = idracObj.dict['Members']
-    cpuCheck = []
-    for cpu in cpuList:
-        for cpu_uri in cpu.values():
-            idracObj = idrac.get(cpu_uri)
-            if idracObj.dict['Status']['Health'] != 'OK':
-                cpuCheck.append(idracObj.dict['Name'])
-    if len(cpuCheck) > 0:
-        idracHealth['Processors'] = 'Nok, check cpu: ' + ', '.join(cpuCheck)
-    else:
-        idracHealth['Processors'] = 'OK'
-    
-    # Storage health
-    print('Checking storage...')
-    # Array Controllers
-    idracObj = idrac.get(STORAGE_URI)
-    arrayList = idracObj.dict['Members']
-    arrayCheck = []
-    diskCheck = []
-    enclosureCheck = []
-    volumeCheck = []
-    for array in arrayList:
-        for array_uri in array.values():
-            idracObj = idrac.get(array_uri)
-            if idracObj.dict['Status']['Health'] != 'OK':
-                arrayCheck.append(idracObj['Name'])
-            # Physical disks
-            diskList = idracObj.dict['Drives']
-            for disk in diskList:
-                for disk_uri in disk.values():
-                    idracObj = idrac.get(disk_uri)
-                    if idracObj.dict['Status']['Health'] != 'OK':
-                        diskCheck.append(idracObj.dict['Name'])
-            # Enclosures
-            idracObj = idrac.get(array_uri)
-            enclosureList = idracObj.dict['Links']['Enclosures']
-            for enclosure in enclosureList:
-                for enclosure_uri in enclosure.values():
-                    if 'Enclosure' not in enclosure_uri:
-                        continue
-                    else:
-                        idracObj = idrac.get(enclosure_uri)
-                        if idracObj.dict['Status']['Health'] != 'OK':
-                            enclosureCheck.append(idracObj.dict['Name'])
-            # Virtual disks
-            idracObj = idrac.get(array_uri + '/Volumes')
-            volumeList = idracObj.dict['Members']
-            for volume in volumeList:
-                for volume_uri in volume.values():
-                    idracObj = idrac.get(volume_uri)
-                    if idracObj.dict['Status']['Health'] != 'OK':
-                        volumeCheck.append(idracObj.dict['Name'])
-    if len(arrayCheck) > 0:
-        idracHealth['Array Controller'] = 'Nok, check array controller: ' + ', '.join(arrayCheck)
-    else:
-        idracHealth['Array Controller'] = 'OK'
-    if len(volumeCheck) > 0:
-        idracHealth['Virtual Disks'] = 'Nok, check logical disk: ' + ', '.join(volumeCheck)
-    else:
-        idracHealth['Virtual Disks'] = 'OK'
-    if len(diskCheck) > 0:
-        idracHealth['Disk drives'] = 'Nok, check disk drive: ' + ', '.join(diskCheck)
-    else:
-        idracHealth['Disk drives'] = 'OK'
-    if len(enclosureCheck) > 0:
-        idracHealth['Storage Enclosure'] = 'Nok, check enclosure: ' + ', '.join(enclosureCheck)
-    else:
-        idracHealth['Storage Enclosure'] = 'OK'
-        
-    # Network
-    print('Checking network...')
-    idracObj = idrac.get(NETWORK_URI)
-    adapterList = idracObj.dict['Members']
-    adapterCheck = []
-    netdeviceCheck = []
-    netportCheck = []
-    # Network adpaters/interfaces
-    for adapter in adapterList:
-        for adapter_uri in adapter.values():
-            idracObj = idrac.get(adapter_uri)
-            if idracObj.dict['Status']['State'] != 'Enabled':
-                adapterCheck.append(idracObj.dict['Id'])
-            # Network device functions
-            idracObj = idrac.get(adapter_uri + '/NetworkDeviceFunctions')
-            netdeviceList = idracObj.dict['Members']
-            for netdevice in netdeviceList:
-                for device_uri in netdevice.values():
-                    idracObj = idrac.get(device_uri)
-                    if idracObj.dict['Status']['State'] != 'Enabled':
-                        netdeviceCheck.append(idracObj.dict['Id'])
-            # Network ports
-            idracObj = idrac.get(adapter_uri + '/NetworkPorts')
-            netportList = idracObj.dict['Members']
-            for netport in netportList:
-                for netport_uri in netport.values():
-                    idracObj = idrac.get(netport_uri)
-                    if idracObj.dict['Status']['State'] != 'Enabled':
-                        netportCheck.append(idracObj.dict['Id'])
-    if len(adapterCheck) > 0:
-         idracHealth['Network adapters'] = 'Nok, check adapter: ' + ', '.join(adapterCheck)
-    else:
-        idracHealth['Network adapters'] = 'OK'
-    if len(netdeviceCheck) > 0:
-         idracHealth['Network device function'] = 'Nok, check network device function: ' + ', '.join(netdeviceCheck)
-    else:
-        idracHealth['Network device function'] = 'OK'
-    if len(netportCheck) > 0:
-         idracHealth['Network ports'] = 'Nok, check network port: ' + ', '.join(netportCheck)
-    else:
-        idracHealth['Network ports'] = 'OK'
-                        
+
+    idrac = projection.projected(etag_cache.conditional(idrac), FIELDS)
+    idracHealth = hc_plan.run_plan(fanout.bounded(session_cache.cached(idrac), maxInflight), PLAN)
+    print('Healthcheck successful!')
+    return idracHealth
+
+
+async def build_healthcheck_async(idrac):
+    ''' Async version of build_healthcheck for an async_redfish client.
+    The resulting dictionary is the same as build_healthcheck.
+
+    Input: AsyncRedfishClient object with the idrac connection.
+    Output: dictionary with the hostname and health status of the idrac'''
+
+    idrac = session_cache.cached(projection.projected(etag_cache.conditional(idrac), FIELDS))
+    idracHealth = await hc_plan.run_plan_async(idrac, PLAN)
     print('Healthcheck successful!')
-    return idracHealth        
\ No newline at end of file
+    return idracHealth
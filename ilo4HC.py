@@ -1,3 +1,9 @@
+import fanout
+import hc_plan
+import session_cache
+import projection
+import etag_cache
+
 # Main Uri addresses
 SYSTEMS_URI = '/redfish/v1/systems/1'
 MANAGERS_URI = '/redfish/v1/managers/1'
@@ -12,223 +18,80 @@ EMBMEDIA_URI = '/redfish/v1/Managers/1/EmbeddedMedia'
 NETWORK_URI = '/redfish/v1/Systems/1/NetworkAdapters'
 ETHIF_URI = '/redfish/v1/Systems/1/EthernetInterfaces'
 
+SYSTEM = hc_plan.resource(SYSTEMS_URI)
+THERMAL = hc_plan.resource(THERMAL_URI)
+ARRAYS = hc_plan.members(ARRAY_URI)
+ADAPTERS = hc_plan.members(NETWORK_URI)
+
+# Checks in the order they appear in the healthcheck
+PLAN = hc_plan.compile_plan([
+    ('chassis', [hc_plan.value('Chassis', hc_plan.resource(CHASSIS_URI), 'Status/Health')]),
+    ('power supplies', [
+        hc_plan.items('Power Supplies', hc_plan.resource(POWER_URI), 'SerialNumber', 'Nok, check PSU with serial: ',
+                      field='PowerSupplies', missing='Absent')]),
+    ('system', [hc_plan.value('System', SYSTEM, 'Status/Health')]),
+    ('fans', [hc_plan.items('Fans', THERMAL, 'FanName', 'Nok, check fans: ', field='Fans')]),
+    ('temperatures', [
+        hc_plan.items('Temperatures', THERMAL, 'Name', 'Nok, check temperature: ', field='Temperatures',
+                      skip=[KeyError])]),
+    ('memory', [
+        hc_plan.items('Memory', hc_plan.members(MEMORY_URI), 'Name', 'Nok, check mems: ',
+                      ok=('DIMMStatus', 'GoodInUse'))]),
+    ('processors', [hc_plan.items('Processors', hc_plan.members(PROCESSORS_URI), 'Id', 'Nok, check cpu: ')]),
+    ('storage', [
+        hc_plan.value('Smart Storage', hc_plan.resource(SSTORAGE_URI), 'Status/Health'),
+        hc_plan.value('Smart Storage Battery', SYSTEM, 'Oem/Hp/Battery/0/Condition'),
+        hc_plan.items('Array Controller', ARRAYS, 'Id', 'Nok, check array controller: '),
+        hc_plan.items('Logical Disks', hc_plan.subcollection(ARRAYS, 'LogicalDrives'), 'Id',
+                      'Nok, check logical disk: '),
+        hc_plan.items('Disk drives', hc_plan.subcollection(ARRAYS, 'DiskDrives'), 'Id', 'Nok, check disk drive: '),
+        hc_plan.items('Storage Enclosure', hc_plan.subcollection(ARRAYS, 'StorageEnclosures'), 'Id',
+                      'Nok, check enclosure: ')]),
+    ('network', [
+        hc_plan.items('Network adapters', ADAPTERS, 'Name', 'Nok, check network adapter: '),
+        hc_plan.items('Physical ports', ADAPTERS, 'Name', 'Nok, check physical port: ', field='PhysicalPorts',
+                      skip=[KeyError], onlyNok=True)]),
+    ('ethernet interfaces', [
+        hc_plan.items('Ethernet interfaces', hc_plan.members(ETHIF_URI), 'Id', 'Nok, check ethernet interface: ',
+                      skip=[KeyError, TypeError])]),
+    ('embedded media', [
+        hc_plan.value('Embedded Media controller', hc_plan.resource(EMBMEDIA_URI), 'Controller/Status/Health')]),
+    ('self test diagnostics', [hc_plan.self_tests(hc_plan.resource(MANAGERS_URI), 'Oem/Hp/iLOSelfTestResults')]),
+])
+
+# Fields read by the checks from each resource, * matches one uri segment
+FIELDS = PLAN.fields
 
 
-def build_healthcheck(ilo):
+def build_healthcheck(ilo, maxInflight=None):
     ''' This function builds a dictionary with the hostname and health status
     of the ilo. (ILO 4)
     The dictionary contains bios, hardware and self test diagnostics.
     Most of the info is in nested dictionaries and lists, so I used iterations
     to structure the data into a simple dictionary.
+    The checks are described by PLAN, its requests run in parallel with at
+    most maxInflight requests sent to the ilo at once (by default the
+    adaptive limit of the connection, see adaptive_limit). Responses are cached
+    for the session, so each uri is only fetched once, and revalidated with
+    its ETag on the next sweeps.
     
     Input: redfish object with the ilo connection.
     Output: dictionary with the hostname and health status of the ilo'''
-    
-    iloHealth = {}
-        
-    # Chassis health
-    print('Checking chassis...')
-    iloObj = ilo.get(CHASSIS_URI)
-    iloHealth['Chassis'] = iloObj.dict['Status']['Health']
-    
-    # Power supplies
-    print('Checking power supplies...')
-    iloObj = ilo.get(POWER_URI)
-    try:
-        psuList = iloObj.dict['PowerSupplies']
-        psuCheck = []
-        for psu in psuList:
-            if psu['Status']['Health'] != 'OK':
-                psuCheck.append(psu['SerialNumber'])
-        if len(psuCheck) > 0:
-            iloHealth['Power Supplies'] = 'Nok, check PSU with serial: ' + ', '.join(psuCheck)
-        else:
-            iloHealth['Power Supplies'] = 'OK'
-    except KeyError:
-        iloHealth['Power Supplies'] = 'Absent'
-    
-    # System health
-    print('Checking system...')
-    iloObj = ilo.get(SYSTEMS_URI)
-    iloHealth['System'] = iloObj.dict['Status']['Health']
-    
-    # Fan health
-    print('Checking fans...')
-    iloObj = ilo.get(THERMAL_URI)
-    fanList = iloObj.dict['Fans']
-    fanCheck = []
-    for fan in fanList:
-        if fan['Status']['Health'] != 'OK':
-            fanCheck.append(fan['FanName'])
-    if len(fanCheck) > 0:
-        iloHealth['Fans'] = 'Nok, check fans: ' + ', '.join(fanCheck)
-    else:
-        iloHealth['Fans'] = 'OK'
-        
-    # Temperatures
-    print('Checking temperatures...')
-    iloObj = ilo.get(THERMAL_URI)
-    tempList = iloObj.dict['Temperatures']
-    tempCheck = []
-    for element in tempList:
-        try:
-            if element['Status']['Health'] != 'OK':
-                tempCheck.append(element['Name'])
-        except KeyError:
-            continue
-    if len(tempCheck) > 0:
-        iloHealth['Temperatures'] = 'Nok, check temperature: ' + ', '.join(tempCheck)
-    else:
-        iloHealth['Temperatures'] = 'OK'
-    
-    # Memory health
-    print('Checking memory...')
-    iloObj = ilo.get(MEMORY_URI)
-    memList = iloObj.dict['Members']
-    memCheck = []
-    for mem in memList:
-        for mem_uri in mem.values():
-            iloObj = ilo.get(mem_uri)
-            if iloObj.dict['DIMMStatus'] != 'GoodInUse':
-                memCheck.append(iloObj.dict['Name'])
-    if len(memCheck) > 0:
-        iloHealth['Memory'] = 'Nok, check mems: ' + ', '.join(memCheck)
-    else:
-        iloHealth['Memory'] = 'OK'
-        
-    # Cpu Health
-    print('Checking processors...')
-    iloObj = ilo.get(PROCESSORS_URI)
-    cpuList = iloObj.dict['Members']
-    cpuCheck = []
-    for cpu in cpuList:
-        for cpu_uri in cpu.values():
-            iloObj = ilo.get(cpu_uri)
-            if iloObj.dict['Status']['Health'] != 'OK':
-                cpuCheck.append(iloObj.dict['Id'])
-    if len(cpuCheck) > 0:
-        iloHealth['Processors'] = 'Nok, check cpu: ' + ', '.join(cpuCheck)
-    else:
-        iloHealth['Processors'] = 'OK'
-        
-    # Smartstorage health
-    print('Checking storage...')
-    iloObj = ilo.get(SSTORAGE_URI)
-    iloHealth['Smart Storage'] = iloObj.dict['Status']['Health']
-    # Battery
-    iloObj = ilo.get(SYSTEMS_URI)
-    iloHealth['Smart Storage Battery'] = iloObj.dict['Oem']['Hp']['Battery'][0]['Condition']
-    # Array 
-    iloObj = ilo.get(ARRAY_URI)
-    arrayList = iloObj.dict['Members']
-    arrayCheck = []
-    logicalCheck = []
-    diskCheck = []
-    enclosureCheck = []
-    for array in arrayList:
-        for uri in array.values():
-            iloObj = ilo.get(uri)
-            if iloObj.dict['Status']['Health'] != 'OK':
-                arrayCheck.append(iloObj.dict['Id'])
-            # Logical drives
-            iloObj = ilo.get(uri + '/LogicalDrives')
-            logicalList = iloObj.dict['Members']
-            for drive in logicalList:
-                for drive_uri in drive.values():
-                    iloObj = ilo.get(drive_uri)
-                    if iloObj.dict['Status']['Health'] != 'OK':
-                        logicalCheck.append(iloObj.dict['Id'])
-            # Disk Drives
-            iloObj = ilo.get(uri + '/DiskDrives')
-            diskList = iloObj.dict['Members']
-            for disk in diskList:
-                for disk_uri in disk.values():
-                    iloObj = ilo.get(disk_uri)
-                    if iloObj.dict['Status']['Health'] != 'OK':
-                        diskCheck.append(iloObj.dict['Id'])  
-            # Enclosures
-            iloObj = ilo.get(uri + '/StorageEnclosures')
-            enclosureList = iloObj.dict['Members']
-            for enclosure in enclosureList:
-                for enclosure_uri in enclosure.values():
-                    iloObj = ilo.get(enclosure_uri)
-                    if iloObj.dict['Status']['Health'] != 'OK':
-                         enclosureCheck.append(iloObj.dict['Id'])
-                    
-    if len(arrayCheck) > 0:
-        iloHealth['Array Controller'] = 'Nok, check array controller: ' + ', '.join(arrayCheck)
-    else:
-        iloHealth['Array Controller'] = 'OK'
-    if len(logicalCheck) > 0:
-        iloHealth['Logical Disks'] = 'Nok, check logical disk: ' + ', '.join(logicalCheck)
-    else:
-        iloHealth['Logical Disks'] = 'OK'
-    if len(diskCheck) > 0:
-        iloHealth['Disk drives'] = 'Nok, check disk drive: ' + ', '.join(diskCheck)
-    else:
-        iloHealth['Disk drives'] = 'OK'
-    if len(enclosureCheck) > 0:
-        iloHealth['Storage Enclosure'] = 'Nok, check enclosure: ' + ', '.join(enclosureCheck)
-    else:
-        iloHealth['Storage Enclosure'] = 'OK'
-    
-    # Network adapters
-    print('Checking network...')
-    iloObj = ilo.get(NETWORK_URI)
-    adapterList = iloObj.dict['Members']
-    adapterCheck = []
-    portCheck = []
-    for adapter in adapterList:
-        for adapter_uri in adapter.values():
-            iloObj = ilo.get(adapter_uri)
-            if iloObj.dict['Status']['Health'] != 'OK':
-                adapterCheck.append(iloObj.dict['Name'])
-            # Network ports
-            portList = iloObj.dict['PhysicalPorts']
-            for port in portList:
-                try:
-                    if port['Status']['Health'] != 'OK':
-                        portCheck.append(port['Name'])
-                except KeyError:
-                    continue
-    if len(adapterCheck) > 0:
-        iloHealth['Network adapters'] = 'Nok, check network adapter: ' + ', '.join(enclosureCheck)
-    else:
-        iloHealth['Network adapters'] = 'OK'
-    if len(portCheck) > 0:
-        iloHealth['Physical ports'] = 'Nok, check physical port: ' + ', '.join(portCheck)
-    # Ethernet interfaces
-    print('Checking ethernet interfaces...')
-    iloObj = ilo.get(ETHIF_URI)
-    ethList = iloObj.dict['Members']
-    ethCheck = []
-    for interface in ethList:
-        for interface_uri in interface.values():
-            iloObj = ilo.get(interface_uri)
-            try:
-                if iloObj.dict['Status']['Health'] != 'OK':
-                    ethCheck.append(iloObj.dict['Id'])
-            except KeyError:
-                continue
-            except TypeError:
-                continue
-    if len(ethCheck) > 0:
-        iloHealth['Ethernet interfaces'] = 'Nok, check ethernet interface: ' + ', '.join(ethCheck)
-    else:
-        iloHealth['Ethernet interfaces'] = 'OK'
-    
-    # Embedded Media
-    print('Checking embedded media...')
-    iloObj = ilo.get(EMBMEDIA_URI)
-    iloHealth['Embedded Media controller'] = iloObj.dict['Controller']['Status']['Health']
-    
-    # Self test status eg. NVRAM, EEMPROM
-    print('Checking self test diagnostics...')
-    iloObj = ilo.get(MANAGERS_URI)
-    selfTestLst = iloObj.dict['Oem']['Hp']['iLOSelfTestResults']
-    for test in range(len(selfTestLst)):
-        if selfTestLst[test]['Status'] == 'Informational':
-            continue
-        iloHealth[selfTestLst[test]['SelfTestName']] = selfTestLst[test]['Status']
+
+    ilo = projection.projected(etag_cache.conditional(ilo), FIELDS)
+    iloHealth = hc_plan.run_plan(fanout.bounded(session_cache.cached(ilo), maxInflight), PLAN)
+    print('Healthcheck successful!')
+    return iloHealth
+
+
+async def build_healthcheck_async(ilo):
+    ''' Async version of build_healthcheck for an async_redfish client.
+    The resulting dictionary is the same as build_healthcheck.
+
+    Input: AsyncRedfishClient object with the ilo connection.
+    Output: dictionary with the hostname and health status of the ilo'''
+
+    ilo = session_cache.cached(projection.projected(etag_cache.conditional(ilo), FIELDS))
+    iloHealth = await hc_plan.run_plan_async(ilo, PLAN)
     print('Healthcheck successful!')
     return iloHealth
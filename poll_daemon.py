@@ -0,0 +1,251 @@
+''' Continuous polling of the fleet. Every host has its own schedule:
+
+    healthy hosts     BASE_INTERVAL, backing off by BACKOFF up to MAX_INTERVAL
+    hosts with Nok    NOK_INTERVAL, until the healthcheck is clean again
+    unreachable       RETRY_INTERVAL, doubling up to MAX_RETRY_INTERVAL
+
+Intervals are jittered so BMCs are not hit in lockstep, and stretched so
+the checks of a host never take more than HOST_BUDGET seconds per hour.
+
+    python poll_daemon.py --output "hc history.db" --diff
+    python poll_daemon.py --output hc.ndjson --rotate-bytes 100000000 --compress
+'''
+
+import sys
+import time
+import heapq
+import signal
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import serversHC
+import fleet_sweep
+import result_sinks
+import health_history
+import redfish_metrics
+import span_trace
+import rate_limit
+
+# Seconds between the polls of a healthy host, multiplied by BACKOFF after
+# each clean poll up to MAX_INTERVAL
+BASE_INTERVAL = 300
+BACKOFF = 1.5
+MAX_INTERVAL = 3600
+# Seconds between the polls of a host with Nok entries
+NOK_INTERVAL = 60
+# First retry of an unreachable host, doubled on every failure
+RETRY_INTERVAL = 60
+MAX_RETRY_INTERVAL = 3600
+# Intervals vary randomly by this fraction
+JITTER = 0.1
+# Seconds of checks allowed per host and hour
+HOST_BUDGET = 120
+# Statuses (see health_history.normalize_status) that make a host be
+# polled more often
+NOK_STATUS = ('Nok', 'Warning', 'Critical')
+# Seconds between two writes of the metrics textfile and of the trace
+EXPORT_INTERVAL = 60
+
+
+def has_nok(serverHC):
+    ''' True when an entry of the healthcheck is Nok, Warning or Critical.'''
+
+    return any(health_history.normalize_status(value) in NOK_STATUS
+               for value in (serverHC.get('Healthcheck') or {}).values())
+
+
+class HostSchedule(object):
+    ''' Polling state of one host.'''
+
+    def __init__(self):
+        # None until the first clean poll, and again after a failure
+        self.interval = None
+        self.failures = 0
+        self.polls = 0
+
+
+class PollScheduler(object):
+    ''' Priority queue of the hosts, ordered by the time of their next poll.
+
+    Input: server keys, interval settings (see the module constants) and
+    random generator, for repeatable jitter'''
+
+    def __init__(self, servers, baseInterval=BASE_INTERVAL, backoff=BACKOFF, maxInterval=MAX_INTERVAL,
+                 nokInterval=NOK_INTERVAL, retryInterval=RETRY_INTERVAL, maxRetryInterval=MAX_RETRY_INTERVAL,
+                 jitter=JITTER, hostBudget=HOST_BUDGET, rand=None):
+        self.baseInterval = baseInterval
+        self.backoff = backoff
+        self.maxInterval = maxInterval
+        self.nokInterval = nokInterval
+        self.retryInterval = retryInterval
+        self.maxRetryInterval = maxRetryInterval
+        self.jitter = jitter
+        self.hostBudget = hostBudget
+        self.random = rand or random.Random()
+        self.hosts = {server: HostSchedule() for server in servers}
+        self._queue = []
+        self._order = 0
+        now = time.monotonic()
+        # The first polls are spread too, over the jitter of one interval
+        for server in self.hosts:
+            self.push(server, now + self.random.uniform(0, self.jitter * self.baseInterval))
+
+    def push(self, server, due):
+        self._order += 1
+        heapq.heappush(self._queue, (due, self._order, server))
+
+    def next_due(self):
+        return self._queue[0][0] if self._queue else None
+
+    def pop_due(self, now):
+        ''' Returns the hosts due at now, earliest first.'''
+
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            due.append(heapq.heappop(self._queue)[2])
+        return due
+
+    def next_interval(self, server, healthy, duration):
+        ''' Interval before the next poll of a host after a poll that took
+        duration seconds: healthy is True (clean healthcheck), False (Nok
+        entries) or None (the host failed).'''
+
+        host = self.hosts[server]
+        host.polls += 1
+        if healthy is None:
+            host.failures += 1
+            host.interval = None
+            interval = min(self.retryInterval * 2 ** (host.failures - 1), self.maxRetryInterval)
+        elif not healthy:
+            host.failures = 0
+            host.interval = interval = self.nokInterval
+        else:
+            host.failures = 0
+            if host.interval is None or host.interval < self.baseInterval:
+                # First clean poll, or the host just recovered
+                host.interval = self.baseInterval
+            else:
+                host.interval = min(host.interval * self.backoff, self.maxInterval)
+            interval = host.interval
+        if self.hostBudget:
+            interval = max(interval, duration * 3600 / self.hostBudget)
+        return interval * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def reschedule(self, server, healthy, duration, now=None):
+        interval = self.next_interval(server, healthy, duration)
+        self.push(server, (time.monotonic() if now is None else now) + interval)
+        return interval
+
+
+def run_daemon(servers=None, sink=None, maxWorkers=fleet_sweep.MAX_WORKERS,
+               maxSubnetWorkers=fleet_sweep.MAX_SUBNET_WORKERS, scheduler=None, stop=None, task=None):
+    ''' Polls the servers until stop is set, each on its own schedule (see
+    PollScheduler), on a bounded thread pool: at most maxWorkers hosts at
+    once and at most maxSubnetWorkers per subnet. A due host whose subnet
+    is busy waits for one of its checks to finish.
+
+    Input: servers dict (serversHC.servers by default), result sink (see
+    result_sinks), concurrency, scheduler, threading.Event ending the
+    daemon, task(server, serverInfo, sink) returning the healthcheck
+    (serversHC.check_server by default)'''
+
+    servers = serversHC.servers if servers is None else servers
+    sink = result_sinks.open_sink() if sink is None else sink
+    scheduler = PollScheduler(servers) if scheduler is None else scheduler
+    stop = threading.Event() if stop is None else stop
+    task = serversHC.check_server if task is None else task
+    maxWorkers = max(1, maxWorkers)
+    maxSubnetWorkers = max(1, maxSubnetWorkers or maxWorkers)
+    subnets = {server: fleet_sweep.subnet_key(servers[server]['systemUrl']) for server in servers}
+    subnetBusy = dict.fromkeys(subnets.values(), 0)
+    # Due hosts waiting for a worker or for their subnet
+    waiting = []
+    running = {}
+    exported = time.monotonic()
+
+    def poll(server):
+        start = time.monotonic()
+        try:
+            serverHC = task(server, servers[server], sink)
+        except Exception as e:
+            sys.stderr.write('ERROR: {} failed: {!r}\n'.format(server, e))
+            return None, time.monotonic() - start
+        return not has_nok(serverHC), time.monotonic() - start
+
+    try:
+        with result_sinks.progress_output(sink), ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            while not stop.is_set():
+                waiting += scheduler.pop_due(time.monotonic())
+                for server in list(waiting):
+                    if len(running) >= maxWorkers:
+                        break
+                    if subnetBusy[subnets[server]] >= maxSubnetWorkers:
+                        continue
+                    waiting.remove(server)
+                    subnetBusy[subnets[server]] += 1
+                    running[executor.submit(poll, server)] = server
+
+                nextDue = scheduler.next_due()
+                timeout = None if nextDue is None else max(0, nextDue - time.monotonic())
+                if not running:
+                    stop.wait(timeout)
+                    continue
+                # Wake up at the next due host, or to notice stop
+                done, _ = wait(running, timeout=1 if timeout is None else min(timeout, 1),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    server = running.pop(future)
+                    subnetBusy[subnets[server]] -= 1
+                    healthy, duration = future.result()
+                    interval = scheduler.reschedule(server, healthy, duration)
+                    print('Next poll of {} in {:.0f}s'.format(server, interval))
+                if done and time.monotonic() - exported >= EXPORT_INTERVAL:
+                    redfish_metrics.export()
+                    span_trace.export()
+                    exported = time.monotonic()
+            wait(running)
+    finally:
+        sink.close()
+        redfish_metrics.export()
+        span_trace.export()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Poll the healthchecks of servers.json continuously.')
+    parser.add_argument('--output', action='append',
+                        help="sink target (see result_sinks.open_sink), can be repeated, default 'hc dump'")
+    parser.add_argument('--diff', action='store_true', help='only write the changes of each host')
+    parser.add_argument('--rotate-bytes', type=int,
+                        help='rotate the json lines files once they reach this size (see result_sinks.NdjsonSink)')
+    parser.add_argument('--compress', action='store_true', help='gzip the rotated json lines files')
+    parser.add_argument('--workers', type=int, default=fleet_sweep.MAX_WORKERS)
+    parser.add_argument('--subnet-workers', type=int, default=fleet_sweep.MAX_SUBNET_WORKERS)
+    parser.add_argument('--metrics', help='Prometheus textfile to write the metrics to (e.g. hc.prom)')
+    parser.add_argument('--metrics-port', type=int, help='serve the metrics on http://:port/metrics')
+    parser.add_argument('--trace', help='Chrome/Perfetto trace file of the healthchecks (see span_trace)')
+    parser.add_argument('--rate', type=float, help='requests per second to all the BMCs (see rate_limit)')
+    parser.add_argument('--bandwidth', type=float, help='response bytes per second from all the BMCs')
+    parser.add_argument('--subnet-rate', type=float, help='requests per second to the BMCs of a subnet')
+    parser.add_argument('--subnet-bandwidth', type=float, help='response bytes per second from a subnet')
+    args = parser.parse_args(argv)
+
+    redfish_metrics.export_to(args.metrics)
+    span_trace.trace_to(args.trace)
+    rate_limit.limit_to(args.rate, args.bandwidth, args.subnet_rate, args.subnet_bandwidth)
+    if args.metrics_port:
+        redfish_metrics.serve(args.metrics_port)
+
+    sink = result_sinks.open_sink(args.output or result_sinks.HC_DIR, args.rotate_bytes, args.compress, args.diff)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        run_daemon(sink=sink, maxWorkers=args.workers, maxSubnetWorkers=args.subnet_workers, stop=stop)
+    except KeyboardInterrupt:
+        stop.set()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
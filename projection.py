@@ -0,0 +1,209 @@
+import asyncio
+import threading
+from fnmatch import fnmatchcase
+
+import fanout
+
+# Always kept, the checks and the collection helpers rely on them
+KEEP_FIELDS = ('@odata.id', '@odata.type')
+
+
+def merge_fields(*fieldTables):
+    ''' Merges field tables ({uri pattern: [field, ...]}) of several modules
+    into one.'''
+
+    merged = {}
+    for fields in fieldTables:
+        for pattern, paths in fields.items():
+            merged.setdefault(pattern, [])
+            merged[pattern] += [path for path in paths if path not in merged[pattern]]
+    return merged
+
+
+def _segments(uri):
+    return uri.split('?')[0].rstrip('/').lower().split('/')
+
+
+def fields_for(fields, uri):
+    ''' Returns the fields read from a resource, the union of all the
+    patterns matching its uri. Patterns are uris where * matches one path
+    segment, case is ignored.
+
+    Input: field table and resource uri
+    Output: list of fields, None when no pattern matches'''
+
+    segments = _segments(uri)
+    matched = None
+    for pattern, paths in fields.items():
+        patternSegments = _segments(pattern)
+        if len(patternSegments) == len(segments) and all(
+                fnmatchcase(segment, patternSegment)
+                for segment, patternSegment in zip(segments, patternSegments)):
+            matched = (matched or []) + [path for path in paths if path not in (matched or [])]
+    return matched
+
+
+def project(data, paths):
+    ''' Keeps only the given fields of a resource. Fields are Redfish $select
+    paths, nested properties separated by / (e.g. Oem/Hp/Battery). Missing
+    fields are skipped, so reading them still raises KeyError.
+
+    Input: resource dictionary and list of fields
+    Output: new dictionary with the selected fields'''
+
+    result = {key: data[key] for key in KEEP_FIELDS if key in data}
+    for path in paths:
+        keys = path.split('/')
+        value = data
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = result
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return result
+
+
+def select_supported(root):
+    ''' True when the service root advertises $select support.'''
+
+    try:
+        return bool(root['ProtocolFeaturesSupported']['SelectQuery'])
+    except (KeyError, TypeError):
+        return False
+
+
+class ProjectedResponse(object):
+    ''' Response holding only the projected resource. The original body is
+    dropped right after parsing.'''
+
+    def __init__(self, response, data):
+        self.status = response.status
+        self.dict = data
+        self.path = getattr(response, 'path', None)
+        try:
+            self._headers = {key.lower(): value for key, value in response.getheaders().items()}
+        except (AttributeError, TypeError):
+            self._headers = {}
+
+    def getheader(self, name):
+        return self._headers.get(name.lower())
+
+    def getheaders(self):
+        return dict(self._headers)
+
+
+class ProjectedConnection(object):
+    ''' Wraps a redfish connection so that only the fields read by the
+    healthchecks are kept from each resource. When the BMC supports it, the
+    fields are requested with $select so less data is transferred; a BMC
+    refusing the query gets plain GETs for the rest of the session. Members
+    inlined by $expand are projected as well. Everything but get is passed
+    through to the wrapped connection.'''
+
+    def __init__(self, connection, fields):
+        self.connection = connection
+        self.fields = fields
+        self._select = None
+        self._lock = threading.Lock()
+
+    def _use_select(self):
+        if self._select is None:
+            with self._lock:
+                if self._select is None:
+                    self._select = select_supported(fanout.service_root(self.connection))
+        return self._select
+
+    def select_uri(self, path, args):
+        ''' Uri to request with $select, None when the plain uri is used.'''
+
+        paths = fields_for(self.fields, path)
+        if not paths or args or '?' in path or not self._use_select():
+            return None
+        return path + '?$select=' + ','.join(paths)
+
+    def project_response(self, path, response):
+        if not 200 <= response.status < 300:
+            return response
+        data = response.dict
+        if not isinstance(data, dict):
+            return response
+        paths = fields_for(self.fields, path)
+        if paths:
+            data = project(data, paths)
+        if isinstance(data.get('Members'), list):
+            members = []
+            for member in data['Members']:
+                memberPaths = len(member) > 1 and fields_for(self.fields, member.get('@odata.id', ''))
+                members.append(project(member, memberPaths) if memberPaths else member)
+            data = dict(data, Members=members)
+        return ProjectedResponse(response, data)
+
+    def get(self, path, args=None, headers=None):
+        kwargs = _request_kwargs(args, headers)
+        selectUri = self.select_uri(path, args)
+        response = None
+        if selectUri:
+            response = self.connection.get(selectUri, **kwargs)
+            if response.status != 200:
+                self._select = False
+                response = None
+        if response is None:
+            response = self.connection.get(path, **kwargs)
+        return self.project_response(path, response)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class AsyncProjectedConnection(ProjectedConnection):
+    ''' Same as ProjectedConnection, for an async_redfish client. The client
+    keeps the service root read at login, so no request is needed to know if
+    $select is supported.'''
+
+    def _use_select(self):
+        if self._select is None:
+            root = getattr(self.connection, 'root', None)
+            if root is None:
+                return False
+            self._select = select_supported(root.dict)
+        return self._select
+
+    async def get(self, path, args=None, headers=None):
+        kwargs = _request_kwargs(args, headers)
+        selectUri = self.select_uri(path, args)
+        response = None
+        if selectUri:
+            response = await self.connection.get(selectUri, **kwargs)
+            if response.status != 200:
+                self._select = False
+                response = None
+        if response is None:
+            response = await self.connection.get(path, **kwargs)
+        return self.project_response(path, response)
+
+
+def _request_kwargs(args, headers):
+    kwargs = {}
+    if args:
+        kwargs['args'] = args
+    if headers:
+        kwargs['headers'] = headers
+    return kwargs
+
+
+def projected(connection, fields):
+    ''' Returns the connection wrapped in a projection of the given fields.
+    When one of its wrappers already projects (serversHC sets it up before
+    the vendor module is known), the fields are added to that projection.'''
+
+    wrapper = fanout.find_wrapper(connection, ProjectedConnection)
+    if wrapper is not None:
+        wrapper.fields = merge_fields(wrapper.fields, fields)
+        return connection
+    if asyncio.iscoroutinefunction(connection.get):
+        return AsyncProjectedConnection(connection, fields)
+    return ProjectedConnection(connection, fields)
@@ -0,0 +1,241 @@
+''' Token bucket rate limits of the Redfish traffic of the whole fleet, so
+parallel sweeps do not saturate the jump host and the firewalls of the
+management network.
+
+    requests     GETs and logins per second, all the BMCs
+    bandwidth    response bytes per second, all the BMCs
+    subnet       the same, per subnet of the BMCs (fleet_sweep.subnet_key)
+
+A request waits until every bucket it draws from has a token; the bytes of
+its response are taken from the bandwidth buckets once it is read, so the
+next requests wait when the network is busy. Behind adaptive_limit, every
+attempt of a retried request is paced, not only the first. The waits are
+recorded in redfish_ratelimit_wait_seconds (see redfish_metrics).
+
+Limits are off until limit_to is called.
+
+    python poll_daemon.py --rate 200 --subnet-rate 50 --bandwidth 5000000
+'''
+
+import time
+import asyncio
+import threading
+
+import fanout
+import fleet_sweep
+import adaptive_limit
+import redfish_metrics
+
+# Tokens a bucket holds, in seconds of its rate
+BURST_TIME = 1
+
+
+class TokenBucket(object):
+    ''' Token bucket refilled at rate tokens per second, holding at most
+    burst tokens. Tokens are reserved: a taker gets the time to wait for
+    them and the bucket goes into debt, so takers are served in order.'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, self.rate * BURST_TIME))
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        # Called with the lock held
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount=1):
+        ''' Takes amount tokens (0 only waits for the debt to be paid).
+
+        Output: seconds to wait until they are there'''
+
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def charge(self, amount):
+        ''' Takes amount tokens that were already used.'''
+
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+
+
+class RateLimiter(object):
+    ''' Request and bandwidth buckets of the fleet and of each subnet. A
+    rate of None leaves that bucket out.'''
+
+    def __init__(self, rate=None, bandwidth=None, subnetRate=None, subnetBandwidth=None,
+                 prefix=fleet_sweep.SUBNET_PREFIX):
+        self.rate = rate
+        self.bandwidth = bandwidth
+        self.subnetRate = subnetRate
+        self.subnetBandwidth = subnetBandwidth
+        self.prefix = prefix
+        self._requests = TokenBucket(rate) if rate else None
+        self._bytes = TokenBucket(bandwidth) if bandwidth else None
+        self._subnets = {}
+        self._lock = threading.Lock()
+
+    def _buckets(self, subnet):
+        with self._lock:
+            buckets = self._subnets.get(subnet)
+            if buckets is None:
+                buckets = self._subnets[subnet] = (
+                    TokenBucket(self.subnetRate) if self.subnetRate else None,
+                    TokenBucket(self.subnetBandwidth) if self.subnetBandwidth else None)
+        return (self._requests, buckets[0]), (self._bytes, buckets[1])
+
+    def subnet(self, host):
+        return fleet_sweep.subnet_key(host, self.prefix)
+
+    def reserve(self, host):
+        ''' Takes a request token for host.
+
+        Output: seconds to wait before sending the request'''
+
+        requests, transfers = self._buckets(self.subnet(host))
+        waits = [bucket.reserve() for bucket in requests if bucket is not None]
+        waits += [bucket.reserve(0) for bucket in transfers if bucket is not None]
+        return max(waits or [0.0])
+
+    def charge(self, host, size):
+        ''' Takes the bytes of a response of host from the bandwidth buckets.'''
+
+        for bucket in self._buckets(self.subnet(host))[1]:
+            if bucket is not None:
+                bucket.charge(size)
+
+
+# Limiter of the process, None when the limits are off
+_limiter = None
+
+
+def limit_to(rate=None, bandwidth=None, subnetRate=None, subnetBandwidth=None):
+    ''' Limits the Redfish traffic from now on: requests per second and
+    response bytes per second, of the fleet and per subnet. All None turns
+    the limits off.'''
+
+    global _limiter
+    if rate or bandwidth or subnetRate or subnetBandwidth:
+        _limiter = RateLimiter(rate, bandwidth, subnetRate, subnetBandwidth)
+    else:
+        _limiter = None
+
+
+def limiting():
+    return _limiter is not None
+
+
+def _observe(limiter, host, seconds):
+    redfish_metrics.default_registry().observe('redfish_ratelimit_wait_seconds',
+                                               {'subnet': limiter.subnet(host)}, seconds)
+
+
+def wait(host):
+    ''' Waits for a request token of host, e.g. before a login. Returns the
+    seconds waited.'''
+
+    if _limiter is None:
+        return 0.0
+    seconds = _limiter.reserve(host)
+    if seconds:
+        time.sleep(seconds)
+    _observe(_limiter, host, seconds)
+    return seconds
+
+
+async def wait_async(host):
+    ''' Async version of wait.'''
+
+    if _limiter is None:
+        return 0.0
+    seconds = _limiter.reserve(host)
+    if seconds:
+        await asyncio.sleep(seconds)
+    _observe(_limiter, host, seconds)
+    return seconds
+
+
+def _size(response):
+    size = response.getheader('content-length')
+    return int(size) if size and size.isdigit() else len(response.read or '')
+
+
+class Pacer(object):
+    ''' Pacing of the requests of one host: wait before each of them, charge
+    its response bytes after.'''
+
+    def __init__(self, host, limiter):
+        self.host = host
+        self.limiter = limiter
+
+    def wait(self):
+        seconds = self.limiter.reserve(self.host)
+        if seconds:
+            time.sleep(seconds)
+        _observe(self.limiter, self.host, seconds)
+
+    async def wait_async(self):
+        seconds = self.limiter.reserve(self.host)
+        if seconds:
+            await asyncio.sleep(seconds)
+        _observe(self.limiter, self.host, seconds)
+
+    def charge(self, response):
+        self.limiter.charge(self.host, _size(response))
+
+
+class RateLimitedConnection(object):
+    ''' Wraps a redfish connection so that every GET waits for the buckets of
+    its host and pays for its response bytes. Everything but get is passed
+    through to the wrapped connection.'''
+
+    def __init__(self, connection, host, limiter):
+        self.connection = connection
+        self.host = host
+        self.limiter = limiter
+        self.pacer = Pacer(host, limiter)
+
+    def get(self, path, *args, **kwargs):
+        self.pacer.wait()
+        response = self.connection.get(path, *args, **kwargs)
+        self.pacer.charge(response)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class AsyncRateLimitedConnection(RateLimitedConnection):
+    ''' Same as RateLimitedConnection, for an async_redfish client.'''
+
+    async def get(self, path, *args, **kwargs):
+        await self.pacer.wait_async()
+        response = await self.connection.get(path, *args, **kwargs)
+        self.pacer.charge(response)
+        return response
+
+
+def limited(connection, host=None):
+    ''' Returns the connection wrapped in a RateLimitedConnection when the
+    limits are on, the connection itself otherwise. An adaptive_limit
+    connection is paced by its own retry loop instead, so its retries draw
+    tokens too.'''
+
+    if _limiter is None or fanout.find_wrapper(connection, RateLimitedConnection) is not None:
+        return connection
+    host = host or connection.base_url
+    adaptiveConnection = fanout.find_wrapper(connection, adaptive_limit.AdaptiveConnection)
+    if adaptiveConnection is not None:
+        if adaptiveConnection.pacer is None:
+            adaptiveConnection.pacer = Pacer(host, _limiter)
+        return connection
+    if asyncio.iscoroutinefunction(connection.get):
+        return AsyncRateLimitedConnection(connection, host, _limiter)
+    return RateLimitedConnection(connection, host, _limiter)
@@ -0,0 +1,149 @@
+''' Command line of the healthchecks, one entry point for the sweeps, the
+mapping of the health uris, the diffs and the benchmark.
+
+    sweep      healthchecks of servers.json, or of the --server ones only
+    discover   maps the health uris of servers.json into serverData.json
+    diff       changes between two healthchecks of a host
+    bench      sweeps of a simulated fleet (see bench_fleet)
+
+Each command imports only the modules it needs, the inventory is read when
+the sweep starts and the vendor healthchecks (ilo4HC, ilo5HC, idracHC) are
+imported when a server of that type shows up (see serversHC.vendor_module),
+so a one host check from cron starts right away.
+
+    python redfish_hc.py sweep --server web01
+    python redfish_hc.py sweep --async --output hc.ndjson --diff
+    python redfish_hc.py discover
+    python redfish_hc.py diff "hc snapshots/web01.json" "hc dump/web01.json"
+    python redfish_hc.py bench --sizes 50 --modes async
+
+Run it as redfish-hc with e.g. alias redfish-hc='python /path/to/redfish_hc.py'.
+'''
+
+import sys
+import argparse
+
+SERVERS_FILE = 'servers.json'
+
+
+def sweep(args):
+    ''' Healthchecks of the servers, written to the --output sinks.
+
+    Output: exit status, 1 when a server failed'''
+
+    import serversHC
+    import fleet_sweep
+    import rate_limit
+    import span_trace
+    import result_sinks
+    import redfish_metrics
+
+    servers = serversHC.load_servers(args.servers)
+    if servers is None:
+        return 1
+    if args.server:
+        unknown = [server for server in args.server if server not in servers]
+        if unknown:
+            sys.stderr.write('ERROR: not in {}: {}\n'.format(args.servers, ', '.join(unknown)))
+            return 1
+        servers = {server: servers[server] for server in args.server}
+
+    redfish_metrics.export_to(args.metrics)
+    span_trace.trace_to(args.trace)
+    rate_limit.limit_to(args.rate, args.bandwidth, args.subnet_rate, args.subnet_bandwidth)
+    sink = result_sinks.open_sink(args.output or result_sinks.HC_DIR, diff=args.diff)
+    subnetWorkers = args.subnet_workers or fleet_sweep.MAX_SUBNET_WORKERS
+    if args.asynchronous:
+        results, errors = serversHC.create_hcfiles_async(args.workers or fleet_sweep.MAX_ASYNC_HOSTS,
+                                                         subnetWorkers, sink, servers)
+    else:
+        results, errors = serversHC.create_hcfiles(args.workers or fleet_sweep.MAX_WORKERS,
+                                                   subnetWorkers, sink, servers)
+    sys.stderr.write('{} servers checked, {} failed\n'.format(len(results), len(errors)))
+    return 1 if errors else 0
+
+
+def discover(args):
+    ''' Maps the health uris of the servers into serverData.json.'''
+
+    import health_check_map
+
+    health_check_map.build_hc_uris(args.servers)
+    return 0
+
+
+def diff(args):
+    ''' Prints the changes between two healthchecks of a host (see
+    snapshot_diff.diff_healthcheck), as json. Files are healthchecks written
+    by a sweep ('hc dump') or snapshots of the differential sinks ('hc
+    snapshots').
+
+    Output: exit status, as diff(1): 0 same, 1 changed, 2 unreadable file'''
+
+    import json
+    import snapshot_diff
+
+    healthchecks = []
+    for path in (args.old, args.new):
+        try:
+            with open(path) as hcFile:
+                serverHC = json.load(hcFile)
+        except (OSError, ValueError) as e:
+            sys.stderr.write('ERROR: {}: {}\n'.format(path, e))
+            return 2
+        healthchecks.append(serverHC.get('snapshot', serverHC))
+    changes = snapshot_diff.diff_healthcheck(*healthchecks)
+    print(json.dumps(changes, indent=2, sort_keys=True))
+    return 1 if changes else 0
+
+
+def bench(args, benchArgs):
+    ''' Runs bench_fleet with the rest of the command line.'''
+
+    import bench_fleet
+
+    return bench_fleet.main(benchArgs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='redfish-hc', description='Healthchecks of ILO and IDRAC servers.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sweepParser = commands.add_parser('sweep', help='check the servers')
+    sweepParser.add_argument('--servers', default=SERVERS_FILE, help='inventory file')
+    sweepParser.add_argument('--server', action='append',
+                             help='only this server key of the inventory, can be repeated')
+    sweepParser.add_argument('--async', dest='asynchronous', action='store_true',
+                             help='drive the servers from one event loop instead of threads')
+    sweepParser.add_argument('--output', action='append',
+                             help="sink target (see result_sinks.open_sink), can be repeated, default 'hc dump'")
+    sweepParser.add_argument('--diff', action='store_true', help='only write the changes of each host')
+    sweepParser.add_argument('--workers', type=int, help='hosts at once (see fleet_sweep)')
+    sweepParser.add_argument('--subnet-workers', type=int, help='hosts at once per subnet')
+    sweepParser.add_argument('--metrics', help='Prometheus textfile to write the metrics to (e.g. hc.prom)')
+    sweepParser.add_argument('--trace', help='Chrome/Perfetto trace file of the healthchecks (see span_trace)')
+    sweepParser.add_argument('--rate', type=float, help='requests per second to all the BMCs (see rate_limit)')
+    sweepParser.add_argument('--bandwidth', type=float, help='response bytes per second from all the BMCs')
+    sweepParser.add_argument('--subnet-rate', type=float, help='requests per second to the BMCs of a subnet')
+    sweepParser.add_argument('--subnet-bandwidth', type=float, help='response bytes per second from a subnet')
+
+    discoverParser = commands.add_parser('discover', help='map the health uris into serverData.json')
+    discoverParser.add_argument('--servers', default=SERVERS_FILE, help='inventory file')
+
+    diffParser = commands.add_parser('diff', help='changes between two healthchecks of a host')
+    diffParser.add_argument('old', help='previous healthcheck or snapshot file')
+    diffParser.add_argument('new', help='new healthcheck or snapshot file')
+
+    # Its options are those of bench_fleet, --help included
+    commands.add_parser('bench', help='benchmark the sweeps on a simulated fleet', add_help=False)
+
+    args, rest = parser.parse_known_args(argv)
+    if args.command == 'bench':
+        return bench(args, rest)
+    if rest:
+        parser.error('unrecognized arguments: ' + ' '.join(rest))
+    return {'sweep': sweep, 'discover': discover, 'diff': diff}[args.command](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,304 @@
+''' Metrics of the Redfish calls and of the healthchecks, in the Prometheus
+exposition format:
+
+    redfish_request_duration_seconds     histogram {host, vendor, uri}
+    redfish_requests_total               counter   {host, vendor, uri, code}
+    redfish_response_bytes_total         counter   {host, vendor, uri}
+    redfish_request_errors_total         counter   {host, vendor, uri, error}
+    redfish_ratelimit_wait_seconds       histogram {subnet}
+    healthcheck_check_duration_seconds   histogram {host, vendor, check}
+    healthcheck_duration_seconds         histogram {host, vendor}
+
+uri is the template of the uri, member ids replaced by {id}, so the
+resource types that take the time of a sweep add up across the fleet
+(e.g. /redfish/v1/Systems/{id}/NetworkAdapters/{id}/NetworkDeviceFunctions/{id}).
+The metrics are written to a file for the textfile collector of
+node_exporter (export_to), or served over http (serve).
+'''
+
+import os
+import re
+import time
+import asyncio
+import threading
+
+import fanout
+
+# Histogram buckets, in seconds
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CHECK_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+WAIT_BUCKETS = (0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+METRICS = {
+    'redfish_request_duration_seconds': ('histogram', 'Latency of the Redfish requests.', REQUEST_BUCKETS),
+    'redfish_requests_total': ('counter', 'Redfish requests, by http status.', None),
+    'redfish_response_bytes_total': ('counter', 'Bytes of the Redfish responses.', None),
+    'redfish_request_errors_total': ('counter', 'Redfish requests that failed or got an http error.', None),
+    'redfish_ratelimit_wait_seconds': ('histogram', 'Time the requests waited for the rate limits (see rate_limit).',
+                                       WAIT_BUCKETS),
+    'healthcheck_check_duration_seconds': ('histogram', 'Time until the resources of a check were fetched.',
+                                           CHECK_BUCKETS),
+    'healthcheck_duration_seconds': ('histogram', 'Time to fetch the resources of a healthcheck.', CHECK_BUCKETS),
+}
+
+# Segments of a uri holding a digit are member ids (1, System.Embedded.1,
+# proc1dimm3...), except the version of /redfish/v1
+_ID_SEGMENT = re.compile(r'\d')
+
+
+def uri_template(uri):
+    ''' Uri with its member ids replaced by {id} and only the names of its
+    query parameters.
+
+    Input: uri, e.g. /redfish/v1/Systems/1/Memory/proc1dimm3?$select=Status
+    Output: template, e.g. /redfish/v1/Systems/{id}/Memory/{id}?$select'''
+
+    path, _, query = uri.partition('?')
+    segments = path.rstrip('/').split('/')
+    template = '/'.join(segments[:3] + ['{id}' if _ID_SEGMENT.search(segment) else segment
+                                        for segment in segments[3:]]) or '/'
+    if query:
+        template += '?' + '&'.join(sorted(set(parameter.split('=', 1)[0] for parameter in query.split('&'))))
+    return template
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+class Registry(object):
+    ''' Counters and histograms of METRICS, by label values. Safe to update
+    from the threads of a sweep.'''
+
+    def __init__(self, metrics=METRICS):
+        self.metrics = metrics
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = self.metrics[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                # Count per bucket (not cumulative), sum and count
+                histogram = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        ''' Metrics in the Prometheus text exposition format.'''
+
+        with self._lock:
+            values = sorted((key, list(value[0]) + [value[1], value[2]] if isinstance(value, list) else value)
+                            for key, value in self._values.items())
+        lines = []
+        for name, (kind, description, buckets) in sorted(self.metrics.items()):
+            series = [(labels, value) for (metric, labels), value in values if metric == name]
+            if not series:
+                continue
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(name, _labels(labels), value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, _labels(labels, [('le', bound)]), cumulative))
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels, [('le', '+Inf')]), value[-1]))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), round(value[-2], 6)))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        ''' Writes the metrics atomically, as the textfile collector of
+        node_exporter requires (path should end in .prom).'''
+
+        tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(tmpPath, 'w') as metricsFile:
+            metricsFile.write(self.render())
+        os.replace(tmpPath, path)
+
+
+_defaultRegistry = None
+_defaultLock = threading.Lock()
+# Textfile written by export, None when off
+_textfile = None
+
+
+def default_registry():
+    ''' Registry shared by all the connections of the process.'''
+
+    global _defaultRegistry
+    with _defaultLock:
+        if _defaultRegistry is None:
+            _defaultRegistry = Registry()
+    return _defaultRegistry
+
+
+def export_to(path):
+    ''' Makes export write the metrics to path, None stops it.'''
+
+    global _textfile
+    _textfile = path
+
+
+def export():
+    ''' Writes the metrics to the textfile set by export_to, if any.'''
+
+    if _textfile is not None:
+        default_registry().write_textfile(_textfile)
+
+
+def vendor_of(root):
+    ''' Vendor of a service root, as serversHC names it (HP, Dell).'''
+
+    oem = (root or {}).get('Oem') or {}
+    if 'Hp' in oem or 'Hpe' in oem:
+        return 'HP'
+    if 'Dell' in oem:
+        return 'Dell'
+    return 'unknown'
+
+
+class MeasuredConnection(object):
+    ''' Wraps a redfish client and counts every GET in the registry: latency,
+    status, bytes and errors, labelled by host, vendor and uri template. The
+    vendor is read from the service root of the client. Everything but get
+    is passed through to the wrapped connection.'''
+
+    def __init__(self, connection, host, registry):
+        self.connection = connection
+        self.host = host
+        self.registry = registry
+        self._vendor = None
+
+    @property
+    def vendor(self):
+        if self._vendor is None:
+            root = getattr(self.connection, 'root', None)
+            if root is None:
+                return 'unknown'
+            self._vendor = vendor_of(root.dict)
+        return self._vendor
+
+    def labels(self, **extra):
+        return dict({'host': self.host, 'vendor': self.vendor}, **extra)
+
+    def measure(self, path, start, response=None, error=None):
+        labels = self.labels(uri=uri_template(path))
+        self.registry.observe('redfish_request_duration_seconds', labels, time.monotonic() - start)
+        if error is not None:
+            self.registry.inc('redfish_request_errors_total', dict(labels, error=type(error).__name__))
+            return
+        self.registry.inc('redfish_requests_total', dict(labels, code=response.status))
+        size = response.getheader('content-length')
+        self.registry.inc('redfish_response_bytes_total', labels,
+                          int(size) if size and size.isdigit() else len(response.read or ''))
+        if response.status >= 400:
+            self.registry.inc('redfish_request_errors_total', dict(labels, error='http_{}'.format(response.status)))
+
+    def get(self, path, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            response = self.connection.get(path, *args, **kwargs)
+        except Exception as e:
+            self.measure(path, start, error=e)
+            raise
+        self.measure(path, start, response)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class AsyncMeasuredConnection(MeasuredConnection):
+    ''' Same as MeasuredConnection, for an async_redfish client.'''
+
+    async def get(self, path, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            response = await self.connection.get(path, *args, **kwargs)
+        except Exception as e:
+            self.measure(path, start, error=e)
+            raise
+        self.measure(path, start, response)
+        return response
+
+
+def measured(connection, host=None, registry=None):
+    ''' Returns the connection wrapped in a MeasuredConnection, unless one of
+    its wrappers already is one. host defaults to the base url of the client,
+    registry to the one shared by the process.'''
+
+    if fanout.find_wrapper(connection, MeasuredConnection) is not None:
+        return connection
+    host = host or connection.base_url
+    registry = registry or default_registry()
+    if asyncio.iscoroutinefunction(connection.get):
+        return AsyncMeasuredConnection(connection, host, registry)
+    return MeasuredConnection(connection, host, registry)
+
+
+def observe_checks(connection, durations, total):
+    ''' Records the duration of the checks of a healthcheck, and of the
+    whole healthcheck, for a measured connection (nothing otherwise).
+
+    Input: connection, {check title: seconds} and seconds of the healthcheck'''
+
+    measurer = fanout.find_wrapper(connection, MeasuredConnection)
+    if measurer is None:
+        return
+    for check, seconds in durations.items():
+        measurer.registry.observe('healthcheck_check_duration_seconds', measurer.labels(check=check), seconds)
+    measurer.registry.observe('healthcheck_duration_seconds', measurer.labels(), total)
+
+
+def serve(port, host='', registry=None):
+    ''' Serves the metrics on http://host:port/metrics from a daemon thread.
+
+    Output: the http server (shutdown() stops it)'''
+
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    registry = registry or default_registry()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,144 @@
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import threading
+import contextlib
+
+import health_history
+import snapshot_diff
+
+# Directory of the per server files
+HC_DIR = 'hc dump'
+
+
+class FileSink(object):
+    ''' Writes each healthcheck to its own file, <directory>/<server>.json.
+    Files are written atomically, a reader never sees half a healthcheck.'''
+
+    def __init__(self, directory=HC_DIR):
+        self.directory = directory
+        self.name = directory
+        self.usesStdout = False
+
+    def write(self, server, serverHC):
+        path = os.path.join(self.directory, '{}.json'.format(server))
+        tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        os.makedirs(self.directory, exist_ok=True)
+        with open(tmpPath, 'w') as hcFile:
+            json.dump(serverHC, hcFile)
+        os.replace(tmpPath, path)
+
+    def close(self):
+        pass
+
+
+class NdjsonSink(object):
+    ''' Appends each healthcheck as one json line, {"Server": ..., fields of
+    the healthcheck}, to a single file or to stdout ('-'). The file is line
+    buffered, so every finished healthcheck is readable right away, and
+    lines of concurrent servers never interleave.
+
+    maxBytes: the file is rotated to <path>.<timestamp> once it grows over it
+    compress: rotated files are gzipped'''
+
+    def __init__(self, path='-', maxBytes=None, compress=False):
+        self.path = path
+        self.name = 'stdout' if path == '-' else path
+        self.usesStdout = path == '-'
+        self.maxBytes = maxBytes
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._file = sys.stdout if self.usesStdout else self._open()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return open(self.path, 'a', buffering=1)
+
+    def write(self, server, serverHC):
+        line = json.dumps(dict({'Server': server}, **serverHC)) + '\n'
+        with self._lock:
+            self._file.write(line)
+            if self.usesStdout:
+                self._file.flush()
+            elif self.maxBytes and self._file.tell() >= self.maxBytes:
+                self.rotate()
+
+    def rotate(self):
+        ''' Moves the current file aside (gzipped when compress is set) and
+        starts a new one. Called with the lock held.'''
+
+        self._file.close()
+        rotatedPath = '{}.{}'.format(self.path, time.strftime('%Y%m%d-%H%M%S'))
+        suffix = 0
+        while os.path.exists(rotatedPath) or os.path.exists(rotatedPath + '.gz'):
+            suffix += 1
+            rotatedPath = '{}.{}.{}'.format(self.path, time.strftime('%Y%m%d-%H%M%S'), suffix)
+        os.replace(self.path, rotatedPath)
+        if self.compress:
+            with open(rotatedPath, 'rb') as plainFile, gzip.open(rotatedPath + '.gz', 'wb') as gzipFile:
+                shutil.copyfileobj(plainFile, gzipFile)
+            os.remove(rotatedPath)
+        self._file = self._open()
+
+    def close(self):
+        with self._lock:
+            if self.usesStdout:
+                self._file.flush()
+            else:
+                self._file.close()
+
+
+class MultiSink(object):
+    ''' Writes each healthcheck to several sinks, e.g. the per server files
+    and the history database.'''
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+        self.name = ', '.join(sink.name for sink in self.sinks)
+        self.usesStdout = any(sink.usesStdout for sink in self.sinks)
+
+    def write(self, server, serverHC):
+        for sink in self.sinks:
+            sink.write(server, serverHC)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def open_sink(target=HC_DIR, maxBytes=None, compress=False, diff=False):
+    ''' Opens the sink for a target: '-' streams json lines to stdout, a
+    .ndjson/.jsonl file gets json lines appended, a .db/.sqlite file is the
+    health history (see health_history), anything else is the directory of
+    the per server files. A list of targets writes to all of them.
+    With diff, the targets only get the changes since the last healthcheck
+    of each host and a periodic full one (see snapshot_diff), which suits
+    json lines and the history rather than the per server files.
+
+    Input: target, rotation size and compression of json lines files,
+    differential mode
+    Output: sink object with write(server, serverHC) and close()'''
+
+    if diff:
+        return snapshot_diff.DiffSink(open_sink(target, maxBytes, compress))
+    if isinstance(target, (list, tuple)):
+        return MultiSink(open_sink(oneTarget, maxBytes, compress) for oneTarget in target)
+    if target == '-' or target.endswith(('.ndjson', '.jsonl')):
+        return NdjsonSink(target, maxBytes, compress)
+    if target.endswith(('.db', '.sqlite')):
+        return health_history.HistorySink(target)
+    return FileSink(target)
+
+
+def progress_output(sink):
+    ''' Context manager sending the progress messages to stderr while the
+    sink streams to stdout, so the stream only holds json lines.'''
+
+    if sink.usesStdout:
+        return contextlib.redirect_stdout(sys.stderr)
+    return contextlib.nullcontext()
@@ -1,10 +1,21 @@
-import sys
-import redfish
 import json
+import asyncio
+import time
 import datetime
-import ilo5HC
-import ilo4HC
-import idracHC
+import importlib
+import fleet_sweep
+import async_redfish
+import session_cache
+import projection
+import etag_cache
+import session_pool
+import result_sinks
+import traffic_capture
+import redfish_metrics
+import span_trace
+import host_guard
+import adaptive_limit
+import rate_limit
 
 # Main Uri addresses
 ROOT_URI = '/redfish/v1/'
@@ -16,9 +27,17 @@ IDRACMAN_URI = '/redfish/v1/Managers/iDRAC.Embedded.1'
 # HP ONLY Resource URI
 RESOURCE_URI = '/redfish/v1/ResourceDirectory/'
 
+# Fields projected before the vendor module is known: none, the system and
+# manager resources read here stay whole in the session cache for the vendor
+# healthcheck, which adds its own fields to the projection when it is loaded
+FIELDS = {}
+
+# Healthcheck module of each server type and firmware major version (None
+# for any version), imported when a server of that type shows up
+VENDOR_MODULES = {('HP', '4'): 'ilo4HC', ('HP', '5'): 'ilo5HC', ('Dell', None): 'idracHC'}
+
+SERVERS_FILE = 'servers.json'
 
-# Create time stamp
-dateStamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
 
 # Populate server list
 def parse_json(filename):  # Parses the JSON data from a file, populates a Python dict with the data and returns it.
@@ -31,20 +50,85 @@ def parse_json(filename):  # Parses the JSON data from a file, populates a Pytho
             print('Unable to load json')
             print(e)
 
-servers = parse_json('servers.json')           
+_servers = None
+
+def load_servers(filename=None):
+    ''' Returns the servers dict, read from filename (SERVERS_FILE by default)
+    the first time it is needed, so importing this module does no I/O.
+    Giving a filename reads that file instead.
+
+    Input: inventory file
+    Output: servers dict'''
+
+    global _servers
+    if filename is not None or _servers is None:
+        _servers = parse_json(filename or SERVERS_FILE)
+    return _servers
+
+def __getattr__(name):
+    # serversHC.servers is loaded on first use
+    if name == 'servers':
+        return load_servers()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def vendor_module(serverType, fwVersion):
+    ''' Imports the healthcheck module of a server, see VENDOR_MODULES.
+
+    Input: server type and firmware version of its manager
+    Output: the module, None when the version is not supported (the
+    healthcheck raises host_guard.UnsupportedFirmwareError)'''
 
-def open_connection(systemUrl, loginAccount, loginPassword):
+    version = None
+    if serverType == 'HP':
+        # e.g. 'iLO 5 v2.30'
+        version = (fwVersion.split()[1:] or [None])[0]
+    name = VENDOR_MODULES.get((serverType, version))
+    return importlib.import_module(name) if name else None
+
+def instrumented(client, systemUrl, deadline=None):
+    ''' Wraps a logged in client (sync or async) in the instrumentation of
+    its requests: spans of the trace (span_trace, when tracing), traffic
+    recording (traffic_capture, when recording) and metrics
+    (redfish_metrics). The wrappers sit right on the client, so they see
+    the requests that really go to the BMC. No request starts after
+    deadline (time.monotonic), when given (see host_guard.deadlined). On top
+    of them, adaptive_limit bounds the requests in flight to what the BMC
+    handles and retries the throttled ones, and rate_limit paces each attempt
+    of the requests of the whole fleet (when limits are set), retries
+    included, so the time spent waiting for either is not counted as BMC
+    latency.'''
+
+    return rate_limit.limited(adaptive_limit.adaptive(redfish_metrics.measured(traffic_capture.recorded(
+        span_trace.traced(host_guard.deadlined(client, deadline), systemUrl), systemUrl), systemUrl), systemUrl),
+        systemUrl)
+
+def open_connection(systemUrl, loginAccount, loginPassword, deadline=None):
     ''' Open a https session using redfish to a target server.
     If the connection is not established, either the server is down or redfish
-    is not supported.    
+    is not supported: the error of the redfish library is raised, as is
+    host_guard.UnknownServerError for a server that is neither HP nor Dell.
+    Each request is bounded by the timeouts of host_guard.client_options, and
+    none starts after deadline (time.monotonic), when given.
+
+    The session of the previous sweep is reused while the BMC accepts it.
+    The client is instrumented, see instrumented.
 
     Input: server address, user account and password
     Output: returns a tupple with the open session, server name and server type'''
     
+    import redfish
+
+    def new_client(sessionKey, sessionLocation):
+        return redfish.RedfishClient(base_url=systemUrl, username=loginAccount, password=loginPassword,
+                                     session_key=sessionKey, session_location=sessionLocation,
+                                     **host_guard.client_options())
+
+    # The handshake and login of the session count as one request
+    rate_limit.wait(systemUrl)
+    serverConnection = session_cache.cached(projection.projected(etag_cache.conditional(
+        instrumented(session_pool.open_session(new_client, systemUrl, loginAccount), systemUrl, deadline),
+        systemUrl), FIELDS))
     try:
-        serverConnection = redfish.RedfishClient(base_url=systemUrl, username=loginAccount,
-                                      password=loginPassword)
-        serverConnection.login()
         serverInfo = serverConnection.get(ROOT_URI).dict
         if 'Hp' in serverInfo['Oem'] or 'Hpe' in serverInfo['Oem']:
             serverInfo = serverConnection.get(ILOSYS_URI).dict
@@ -53,13 +137,11 @@ def open_connection(systemUrl, loginAccount, loginPassword):
             serverInfo = serverConnection.get(IDRACSYS_URI).dict
             serverType = 'Dell'
         else:
-            print('Unknown server')
-            serverConnection.logout()
-            sys.exit()
-        print('Connected to', serverInfo['HostName'], 'Vendor:', serverType)
-    except redfish.ServerDownOrUnreachableError:
-        sys.stderr.write("ERROR: server not reachable or doesn't support Redfish.\n")
-        sys.exit()
+            raise host_guard.UnknownServerError('Unknown server ' + systemUrl)
+    except BaseException:
+        session_pool.release(serverConnection)
+        raise
+    print('Connected to', serverInfo['HostName'], 'Vendor:', serverType)
     return (serverConnection, serverInfo['HostName'], systemUrl, serverType)
 
 def build_healthcheck(serverConnection, serverName, serverAddress, serverType):
@@ -68,6 +150,8 @@ def build_healthcheck(serverConnection, serverName, serverAddress, serverType):
     The dictionary contains bios, hardware and self test diagnostics.
     Most of the info is in nested dictionaries and lists, so I used iterations
     to structure the data in to a simple dictionary.
+    A firmware that no vendor module supports raises
+    host_guard.UnsupportedFirmwareError.
     
     Input: tuple with redfish connection, server name and server type.
     Output: dictionary with the hostname and health status of the server'''
@@ -77,39 +161,184 @@ def build_healthcheck(serverConnection, serverName, serverAddress, serverType):
     # Server name
     serverHC['Hostname'] = serverName
     serverHC['Host address'] = serverAddress
-    serverHC['Date'] = dateStamp
+    serverHC['Date'] = datetime.datetime.now().strftime(host_guard.DATE_FORMAT)
     
     # Server type and version
-    if serverType == 'HP':
-        serverObj = serverConnection.get(ILOMAN_URI).dict
-        serverHC['FwVersion'] = serverObj['FirmwareVersion']
-        if serverHC['FwVersion'].split()[1] == '5':
-            healthcheck = ilo5HC.build_healthcheck(serverConnection)
-        elif serverHC['FwVersion'].split()[1] == '4':
-            healthcheck = ilo4HC.build_healthcheck(serverConnection)
-        else:
-            print('ILO version: ' + serverHC['FwVersion'], 'Unable to build healthcheck' )
-            
-    elif serverType == 'Dell':
-        serverObj = serverConnection.get(IDRACMAN_URI).dict
-        serverHC['FwVersion'] = serverObj['FirmwareVersion']
-        healthcheck = idracHC.build_healthcheck(serverConnection)
+    serverObj = serverConnection.get(ILOMAN_URI if serverType == 'HP' else IDRACMAN_URI).dict
+    serverHC['FwVersion'] = serverObj['FirmwareVersion']
+    adaptive_limit.identify(serverConnection, serverType, serverObj.get('Model'), serverHC['FwVersion'])
+    vendorModule = vendor_module(serverType, serverHC['FwVersion'])
+    if vendorModule is None:
+        raise host_guard.UnsupportedFirmwareError('ILO version: {}, unable to build healthcheck'.format(
+            serverHC['FwVersion']))
+    healthcheck = vendorModule.build_healthcheck(serverConnection)
 
     print('Version:', serverHC['FwVersion'])
+    print('Requests: {1}, served from cache: {0}'.format(*session_cache.cache_stats(serverConnection)))
+    print('Sent to the BMC: {1}, not modified: {0}'.format(*etag_cache.etag_stats(serverConnection)))
+    limiter = adaptive_limit.remember(serverConnection)
+    if limiter is not None:
+        print('Requests in flight: {}, throttled: {}'.format(int(limiter.limit), limiter.stats['throttled']))
     
     serverHC['Healthcheck'] = healthcheck
 
     return serverHC
 
-def create_hcfiles():
-    ''''This function will iterate the servers dict and connect to each server.
-    Depending on the type of server (HP or Dell) a connection will be opened and a healthcheck wil be performed
-    '''
-    for server in servers:
-        serverConnection, serverName, serverAddress, serverType = open_connection(**servers[server])
-        serverHC = build_healthcheck(serverConnection, serverName, serverAddress, serverType)
-        print('Dumping healtcheck to file...')
-        with open('hc dump/{}.json'.format(server), 'w') as hcFile:
-            json.dump(serverHC, hcFile)
-        print('File {}.json created successfully'.format(server))
-        serverConnection.logout()
\ No newline at end of file
+def check_server(server, serverInfo, sink):
+    ''' Opens a connection to one server, builds its healthcheck and writes it
+    to the sink. The session is always released, even when the healthcheck fails.
+    A server that fails (unreachable, unknown, past host_guard.HOST_DEADLINE
+    or skipped by its circuit breaker) gets a failure result in the sink and
+    raises host_guard.HostFailure, see host_guard.check_host.
+
+    Input: server key, its entry of the servers dict and result sink
+    Output: dictionary with the healthcheck of the server'''
+
+    def check():
+        deadline = time.monotonic() + host_guard.HOST_DEADLINE
+        serverConnection, serverName, serverAddress, serverType = open_connection(deadline=deadline, **serverInfo)
+        try:
+            serverHC = build_healthcheck(serverConnection, serverName, serverAddress, serverType)
+        finally:
+            traffic_capture.finish(serverConnection)
+            session_pool.release(serverConnection)
+        print('Dumping healtcheck to {}...'.format(sink.name))
+        sink.write(server, serverHC)
+        print('Healthcheck of {} written successfully'.format(server))
+        return serverHC
+
+    with span_trace.span('healthcheck ' + str(server), serverInfo['systemUrl'], 'server'):
+        return host_guard.check_host(server, serverInfo['systemUrl'], check, sink)
+
+def create_hcfiles(maxWorkers=fleet_sweep.MAX_WORKERS, maxSubnetWorkers=fleet_sweep.MAX_SUBNET_WORKERS, sink=None,
+                   servers=None):
+    ''''This function will iterate the servers dict (all of servers.json by
+    default) and connect to each server.
+    Depending on the type of server (HP or Dell) a connection will be opened and a healthcheck wil be performed.
+    Servers are checked in parallel, at most maxWorkers at once and at most
+    maxSubnetWorkers per subnet, so a sweep takes as long as the slowest servers.
+    Healthchecks go to sink (see result_sinks, one file per server in
+    'hc dump' by default), which is closed at the end of the sweep.
+
+    Output: tuple with the healthchecks and the errors, keyed by server'''
+    if sink is None:
+        sink = result_sinks.open_sink()
+    try:
+        with result_sinks.progress_output(sink):
+            return fleet_sweep.sweep(load_servers() if servers is None else servers, lambda server, serverInfo: check_server(server, serverInfo, sink),
+                                     maxWorkers, maxSubnetWorkers)
+    finally:
+        sink.close()
+        redfish_metrics.export()
+        span_trace.export()
+
+
+async def open_connection_async(systemUrl, loginAccount, loginPassword):
+    ''' Async version of open_connection, using an async_redfish client.
+    Failures raise instead of exiting so the other servers of the event loop
+    keep running.
+
+    Input: server address, user account and password
+    Output: returns a tupple with the open session, server name, address and server type'''
+
+    def new_client(sessionKey, sessionLocation):
+        return async_redfish.AsyncRedfishClient(systemUrl, loginAccount, loginPassword,
+                                                sessionKey=sessionKey, sessionLocation=sessionLocation,
+                                                maxConnections=adaptive_limit.MAX_LIMIT)
+
+    # The handshake and login of the session count as one request
+    await rate_limit.wait_async(systemUrl)
+    serverConnection = session_cache.cached(projection.projected(etag_cache.conditional(
+        instrumented(await session_pool.open_session_async(new_client, systemUrl, loginAccount), systemUrl),
+        systemUrl), FIELDS))
+    try:
+        serverInfo = serverConnection.root.dict
+        if 'Hp' in serverInfo['Oem'] or 'Hpe' in serverInfo['Oem']:
+            serverInfo = (await serverConnection.get(ILOSYS_URI)).dict
+            serverType = 'HP'
+        elif 'Dell' in serverInfo['Oem']:
+            serverInfo = (await serverConnection.get(IDRACSYS_URI)).dict
+            serverType = 'Dell'
+        else:
+            raise host_guard.UnknownServerError('Unknown server ' + systemUrl)
+    except BaseException:
+        await session_pool.release_async(serverConnection)
+        raise
+    print('Connected to', serverInfo['HostName'], 'Vendor:', serverType)
+    return (serverConnection, serverInfo['HostName'], systemUrl, serverType)
+
+async def build_healthcheck_async(serverConnection, serverName, serverAddress, serverType):
+    ''' Async version of build_healthcheck, runs the async healthcheck of the
+    vendor module.
+
+    Input: tuple with async redfish connection, server name and server type.
+    Output: dictionary with the hostname and health status of the server'''
+
+    serverHC = {}
+
+    # Server name
+    serverHC['Hostname'] = serverName
+    serverHC['Host address'] = serverAddress
+    serverHC['Date'] = datetime.datetime.now().strftime(host_guard.DATE_FORMAT)
+
+    # Server type and version
+    serverObj = (await serverConnection.get(ILOMAN_URI if serverType == 'HP' else IDRACMAN_URI)).dict
+    serverHC['FwVersion'] = serverObj['FirmwareVersion']
+    adaptive_limit.identify(serverConnection, serverType, serverObj.get('Model'), serverHC['FwVersion'])
+    vendorModule = vendor_module(serverType, serverHC['FwVersion'])
+    if vendorModule is None:
+        raise host_guard.UnsupportedFirmwareError('ILO version: {}, unable to build healthcheck'.format(
+            serverHC['FwVersion']))
+    healthcheck = await vendorModule.build_healthcheck_async(serverConnection)
+
+    print('Version:', serverHC['FwVersion'])
+    print('Requests: {1}, served from cache: {0}'.format(*session_cache.cache_stats(serverConnection)))
+    print('Sent to the BMC: {1}, not modified: {0}'.format(*etag_cache.etag_stats(serverConnection)))
+    limiter = adaptive_limit.remember(serverConnection)
+    if limiter is not None:
+        print('Requests in flight: {}, throttled: {}'.format(int(limiter.limit), limiter.stats['throttled']))
+
+    serverHC['Healthcheck'] = healthcheck
+
+    return serverHC
+
+async def check_server_async(server, serverInfo, sink):
+    ''' Async version of check_server. A server still running after
+    host_guard.HOST_DEADLINE is cancelled.
+
+    Input: server key, its entry of the servers dict and result sink
+    Output: dictionary with the healthcheck of the server'''
+
+    async def check():
+        serverConnection, serverName, serverAddress, serverType = await open_connection_async(**serverInfo)
+        try:
+            serverHC = await build_healthcheck_async(serverConnection, serverName, serverAddress, serverType)
+        finally:
+            traffic_capture.finish(serverConnection)
+            await session_pool.release_async(serverConnection)
+        print('Dumping healtcheck to {}...'.format(sink.name))
+        sink.write(server, serverHC)
+        print('Healthcheck of {} written successfully'.format(server))
+        return serverHC
+
+    with span_trace.span('healthcheck ' + str(server), serverInfo['systemUrl'], 'server'):
+        return await host_guard.check_host_async(server, serverInfo['systemUrl'], check, sink)
+
+def create_hcfiles_async(maxHosts=fleet_sweep.MAX_ASYNC_HOSTS, maxSubnetHosts=fleet_sweep.MAX_SUBNET_WORKERS,
+                         sink=None, servers=None):
+    ''' Same as create_hcfiles, but all the servers are driven by a single
+    event loop instead of a thread per server.
+
+    Output: tuple with the healthchecks and the errors, keyed by server'''
+    if sink is None:
+        sink = result_sinks.open_sink()
+    try:
+        with result_sinks.progress_output(sink):
+            return asyncio.run(fleet_sweep.sweep_async(
+                load_servers() if servers is None else servers,
+                lambda server, serverInfo: check_server_async(server, serverInfo, sink),
+                maxHosts, maxSubnetHosts))
+    finally:
+        sink.close()
+        redfish_metrics.export()
+        span_trace.export()
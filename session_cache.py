@@ -0,0 +1,132 @@
+import json
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+def cache_key(path, args=None):
+    ''' Key of a GET in the cache. Trailing slashes are ignored, the BMCs
+    serve the same resource with or without them.'''
+
+    return (path.rstrip('/') or '/', json.dumps(args, sort_keys=True) if args else None)
+
+
+def _cacheable(response):
+    return 200 <= getattr(response, 'status', 200) < 300
+
+
+class CachedConnection(object):
+    ''' Wraps a redfish connection and memoizes GET responses for the life of
+    the session, so each uri is fetched at most once per healthcheck.
+    Concurrent GETs of the same uri wait for the request already in flight
+    instead of sending their own. Only successful responses are kept.
+    The cache is dropped on logout. Everything but get and logout is passed
+    through to the wrapped connection.'''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.hits = 0
+        self.misses = 0
+        self._responses = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, args=None, headers=None):
+        key = cache_key(path, args)
+        with self._lock:
+            future = self._responses.get(key)
+            owner = future is None
+            if owner:
+                future = self._responses[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if not owner:
+            return future.result()
+        try:
+            response = self.connection.get(path, **_request_kwargs(args, headers))
+        except BaseException as e:
+            with self._lock:
+                self._responses.pop(key, None)
+            future.set_exception(e)
+            raise
+        if not _cacheable(response):
+            with self._lock:
+                self._responses.pop(key, None)
+        future.set_result(response)
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._responses = {}
+
+    def logout(self):
+        self.clear()
+        return self.connection.logout()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class AsyncCachedConnection(object):
+    ''' Same as CachedConnection, for an async_redfish client.'''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.hits = 0
+        self.misses = 0
+        self._responses = {}
+
+    async def get(self, path, args=None, headers=None):
+        key = cache_key(path, args)
+        task = self._responses.get(key)
+        if task is not None:
+            self.hits += 1
+            return await asyncio.shield(task)
+        self.misses += 1
+        task = self._responses[key] = asyncio.ensure_future(
+            self.connection.get(path, **_request_kwargs(args, headers)))
+        try:
+            response = await asyncio.shield(task)
+        except BaseException:
+            self._responses.pop(key, None)
+            raise
+        if not _cacheable(response):
+            self._responses.pop(key, None)
+        return response
+
+    def clear(self):
+        self._responses = {}
+
+    async def logout(self):
+        self.clear()
+        return await self.connection.logout()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def _request_kwargs(args, headers):
+    kwargs = {}
+    if args:
+        kwargs['args'] = args
+    if headers:
+        kwargs['headers'] = headers
+    return kwargs
+
+
+def cached(connection):
+    ''' Returns the connection wrapped in a session cache (async or not,
+    following the connection), unless it already has one.'''
+
+    if isinstance(connection, (CachedConnection, AsyncCachedConnection)):
+        return connection
+    if asyncio.iscoroutinefunction(connection.get):
+        return AsyncCachedConnection(connection)
+    return CachedConnection(connection)
+
+
+def cache_stats(connection):
+    ''' Returns a (hits, misses) tuple for a cached connection, (0, 0) if the
+    connection is not cached.'''
+
+    return (getattr(connection, 'hits', 0), getattr(connection, 'misses', 0))
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextlib
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: only the threads of one process are serialized
+    fcntl = None
+
+# Sessions kept between sweeps, one file per BMC
+SESSION_DIR = 'hc sessions'
+# BMCs cap concurrent sessions (ILO 4 has few), never hold more than this
+MAX_SESSIONS = 2
+# Idle timeout when the BMC does not report SessionService.SessionTimeout
+SESSION_TIMEOUT = 1800
+# Sessions are dropped a bit before the BMC expires them
+EXPIRY_MARGIN = 60
+# A lease older than this belongs to a sweep that died
+LEASE_TIMEOUT = 900
+SESSION_SERVICE_URI = '/redfish/v1/SessionService'
+
+
+class SessionPool(object):
+    ''' On-disk pool of X-Auth-Token sessions per BMC. Each host file holds
+    up to maxSessions sessions with their idle expiry and lease. A sweep
+    leases a free session of its user, or reserves a slot to log in; when
+    all the slots are leased it shares one of them, since a token can serve
+    several clients, so the BMC never sees more than maxSessions sessions.
+    Files are written atomically and only readable by the owner. Their
+    updates are serialized with a lock file per host (flock), so the sweeps
+    of other processes sharing the directory (sweep_shards workers, a poll
+    daemon and a cron sweep) do not lose each other's sessions.'''
+
+    def __init__(self, directory=SESSION_DIR, maxSessions=MAX_SESSIONS, leaseTimeout=LEASE_TIMEOUT):
+        self.directory = directory
+        self.maxSessions = maxSessions
+        self.leaseTimeout = leaseTimeout
+        self._lock = threading.Lock()
+
+    def _path(self, host):
+        name = host.split('://')[-1].rstrip('/').replace(':', '_').replace('/', '_')
+        return os.path.join(self.directory, name + '.json')
+
+    @contextlib.contextmanager
+    def _locked(self, host):
+        ''' Holds the lock of the host file, against the other threads and
+        the other processes.'''
+
+        with self._lock:
+            lockFile = None
+            if fcntl is not None:
+                try:
+                    os.makedirs(self.directory, exist_ok=True)
+                    lockFile = os.fdopen(os.open(self._path(host) + '.lock', os.O_WRONLY | os.O_CREAT, 0o600), 'w')
+                    fcntl.flock(lockFile, fcntl.LOCK_EX)
+                except OSError:
+                    # Nowhere to save the sessions either, see _save
+                    if lockFile is not None:
+                        lockFile.close()
+                    lockFile = None
+            try:
+                yield
+            finally:
+                if lockFile is not None:
+                    # Closing the file releases the lock
+                    lockFile.close()
+
+    def _load(self, host):
+        try:
+            with open(self._path(host)) as sessionFile:
+                return json.load(sessionFile)
+        except (OSError, ValueError):
+            return []
+
+    def _save(self, host, sessions):
+        path = self._path(host)
+        tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with os.fdopen(os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as sessionFile:
+                json.dump(sessions, sessionFile)
+            os.replace(tmpPath, path)
+        except OSError:
+            pass
+
+    def acquire(self, host, username):
+        ''' Leases a session of the host for the user.
+
+        Input: host address and user account
+        Output: session dictionary, its token is None when a new session has
+        to be created (the slot is reserved until release)'''
+
+        now = time.time()
+        with self._locked(host):
+            sessions = [session for session in self._load(host)
+                        if session['expires'] > now or session['leasedUntil'] > now]
+            mine = [session for session in sessions if session['username'] == username and session['token']]
+            free = [session for session in mine if session['leasedUntil'] <= now]
+            if free:
+                session = free[0]
+            elif len(sessions) < self.maxSessions or not mine:
+                session = {'id': uuid.uuid4().hex, 'username': username, 'token': None,
+                           'location': None, 'timeout': SESSION_TIMEOUT, 'expires': 0}
+                sessions.append(session)
+            else:
+                # Every slot is leased, share the one that was used last
+                session = max(mine, key=lambda session: session['expires'])
+            session['leasedUntil'] = now + self.leaseTimeout
+            self._save(host, sessions)
+        return dict(session)
+
+    def release(self, host, session):
+        ''' Frees the lease of a session and stores its token, the idle expiry
+        restarts from now. A session without a token frees its slot.'''
+
+        now = time.time()
+        with self._locked(host):
+            sessions = [stored for stored in self._load(host) if stored['id'] != session['id']]
+            if session['token']:
+                sessions.append(dict(session, leasedUntil=0,
+                                     expires=now + session['timeout'] - EXPIRY_MARGIN))
+            self._save(host, sessions)
+
+    def discard(self, host, session):
+        self.release(host, dict(session, token=None))
+
+
+_defaultPool = None
+_defaultLock = threading.Lock()
+
+
+def default_pool():
+    ''' Pool shared by all the sweeps of the process.'''
+
+    global _defaultPool
+    with _defaultLock:
+        if _defaultPool is None:
+            _defaultPool = SessionPool()
+    return _defaultPool
+
+
+def _session_timeout(response):
+    try:
+        return int(response.dict['SessionTimeout'])
+    except (KeyError, TypeError, ValueError):
+        return SESSION_TIMEOUT
+
+
+def _location_path(location):
+    # Clients keep the Location header as sent by the BMC, with or without host
+    return urlsplit(location).path if location else None
+
+
+def _close(client):
+    # The redfish library has no close, its urllib3 pool is behind the bound
+    # request method of its connection
+    manager = getattr(getattr(getattr(client, 'connection', None), '_conn', None), '__self__', None)
+    if manager is not None:
+        manager.clear()
+
+
+def open_session(newClient, host, username, pool=None):
+    ''' Returns a logged in client, reusing the stored session of the host
+    when its token is still accepted (checked with a GET of the session
+    itself). Otherwise the client logs in and the new session is stored.
+    Hand the client back with release instead of logging out.
+
+    Input: newClient(sessionKey, sessionLocation) building a redfish client,
+    host address and user account
+    Output: logged in redfish client'''
+
+    pool = pool or default_pool()
+    session = pool.acquire(host, username)
+    try:
+        if session['token']:
+            client = newClient(session['token'], session['location'])
+            client.login()
+            if client.get(session['location'] or SESSION_SERVICE_URI).status == 200:
+                client.pooledSession = (pool, host, session)
+                return client
+            _close(client)
+        client = newClient(None, None)
+        client.login()
+        session.update(token=client.session_key, location=_location_path(client.session_location),
+                       timeout=_session_timeout(client.get(SESSION_SERVICE_URI)))
+    except BaseException:
+        pool.discard(host, session)
+        raise
+    client.pooledSession = (pool, host, session)
+    return client
+
+
+async def open_session_async(newClient, host, username, pool=None):
+    ''' Async version of open_session, for an async_redfish client.'''
+
+    pool = pool or default_pool()
+    session = pool.acquire(host, username)
+    try:
+        if session['token']:
+            client = newClient(session['token'], session['location'])
+            await client.login()
+            if (await client.get(session['location'] or SESSION_SERVICE_URI)).status == 200:
+                client.pooledSession = (pool, host, session)
+                return client
+            await client.close()
+        client = newClient(None, None)
+        await client.login()
+        session.update(token=client.session_key, location=_location_path(client.session_location),
+                       timeout=_session_timeout(await client.get(SESSION_SERVICE_URI)))
+    except BaseException:
+        pool.discard(host, session)
+        raise
+    client.pooledSession = (pool, host, session)
+    return client
+
+
+def release(connection):
+    ''' Keeps the session of a client opened by open_session for the next
+    sweep. Clients opened otherwise are logged out.'''
+
+    pooled = getattr(connection, 'pooledSession', None)
+    if pooled is None:
+        connection.logout()
+        return
+    pool, host, session = pooled
+    pool.release(host, session)
+
+
+async def release_async(connection):
+    ''' Async version of release, also closes the pooled connections.'''
+
+    pooled = getattr(connection, 'pooledSession', None)
+    if pooled is None:
+        await connection.logout()
+        return
+    pool, host, session = pooled
+    pool.release(host, session)
+    await connection.close()
@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import threading
+
+# Last snapshot of each host, one file per server
+SNAPSHOT_DIR = 'hc snapshots'
+# A full healthcheck is written at least this often (seconds), changes only
+# in between
+FULL_INTERVAL = 24 * 3600
+# Fields compared besides the Healthcheck entries
+COMPARED_FIELDS = ('FwVersion',)
+
+
+def failed_items(value):
+    ''' Labels listed by a 'Nok, check ...: a, b' entry, empty for any other
+    value.'''
+
+    if not isinstance(value, str) or not value.startswith('Nok') or ': ' not in value:
+        return []
+    return value.split(': ', 1)[1].split(', ')
+
+
+def diff_healthcheck(old, new):
+    ''' Compares two healthchecks entry by entry.
+
+    Input: previous and new serverHC dictionaries
+    Output: dict of the changed entries, {entry: {'from': old value, 'to':
+    new value}}, a None value when the entry did not exist. Nok entries also
+    list the labels that started ('failed') and stopped ('recovered')
+    failing.'''
+
+    oldValues = dict(old.get('Healthcheck') or {}, **{field: old.get(field) for field in COMPARED_FIELDS})
+    newValues = dict(new.get('Healthcheck') or {}, **{field: new.get(field) for field in COMPARED_FIELDS})
+    changes = {}
+    for entry in list(oldValues) + [entry for entry in newValues if entry not in oldValues]:
+        oldValue, newValue = oldValues.get(entry), newValues.get(entry)
+        if oldValue == newValue:
+            continue
+        change = {'from': oldValue, 'to': newValue}
+        oldFailed, newFailed = failed_items(oldValue), failed_items(newValue)
+        if oldFailed or newFailed:
+            change['failed'] = [label for label in newFailed if label not in oldFailed]
+            change['recovered'] = [label for label in oldFailed if label not in newFailed]
+        changes[entry] = change
+    return changes
+
+
+class DiffSink(object):
+    ''' Result sink writing to another sink only what changed since the last
+    healthcheck of each host: {"Hostname", "Host address", "Date",
+    "Changes": diff_healthcheck(...)}. Hosts without changes write nothing.
+    The full healthcheck is written for a host seen for the first time and
+    then every fullInterval seconds, so the downstream can rebuild the state
+    of any host. The last snapshot of each host is kept in directory.'''
+
+    def __init__(self, sink, directory=SNAPSHOT_DIR, fullInterval=FULL_INTERVAL):
+        self.sink = sink
+        self.directory = directory
+        self.fullInterval = fullInterval
+        self.name = sink.name
+        self.usesStdout = sink.usesStdout
+
+    def _path(self, server):
+        name = str(server).replace(os.sep, '_').replace(':', '_')
+        return os.path.join(self.directory, name + '.json')
+
+    def _load(self, server):
+        try:
+            with open(self._path(server)) as snapshotFile:
+                return json.load(snapshotFile)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, server, state):
+        path = self._path(server)
+        tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmpPath, 'w') as snapshotFile:
+                json.dump(state, snapshotFile)
+            os.replace(tmpPath, path)
+        except OSError:
+            pass
+
+    def write(self, server, serverHC):
+        if 'Failure' in serverHC:
+            # Failed host (see host_guard), its snapshot is kept for the next
+            # healthcheck
+            self.sink.write(server, serverHC)
+            return
+        now = time.time()
+        state = self._load(server)
+        if state is None or now - state['fullTime'] >= self.fullInterval:
+            self.sink.write(server, serverHC)
+            self._save(server, {'fullTime': now, 'snapshot': serverHC})
+            return
+        changes = diff_healthcheck(state['snapshot'], serverHC)
+        if not changes:
+            return
+        self.sink.write(server, {'Hostname': serverHC.get('Hostname'),
+                                 'Host address': serverHC.get('Host address'),
+                                 'Date': serverHC.get('Date'),
+                                 'Changes': changes})
+        self._save(server, dict(state, snapshot=serverHC))
+
+    def close(self):
+        self.sink.close()
@@ -0,0 +1,251 @@
+''' Span tracing of the healthchecks, viewable in chrome://tracing or
+ui.perfetto.dev.
+
+Each server is a process of the trace, holding nested spans:
+
+    server    healthcheck of the server (serversHC.check_server)
+    source    fetch of a source of the plan (see hc_plan), e.g. the
+              members of the Memory collection
+    http      one request to the BMC
+    phase     one check of the healthcheck (chassis, fans, memory...), from
+              the start of the plan until its last source was fetched, with
+              the time its sources waited on the BMC and the source on its
+              critical path
+
+Tracing is off until trace_to is called: span returns a shared no-op
+context and the connections are not wrapped.
+
+    python poll_daemon.py --trace "hc trace.json"
+'''
+
+import os
+import json
+import time
+import asyncio
+import threading
+import contextvars
+
+import fanout
+
+# Events kept by a tracer, the next ones are dropped (and counted)
+MAX_EVENTS = 1000000
+
+# Span the code runs in, the parent of the spans it starts
+_currentSpan = contextvars.ContextVar('currentSpan', default=None)
+
+
+def _lane():
+    # Threads of a sweep, or tasks of the event loop
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return ('task', id(task)) if task is not None else ('thread', threading.get_ident())
+
+
+class Span(object):
+    ''' Running span. wait adds up the time its requests (and those of the
+    spans it contains) waited on the BMC.'''
+
+    def __init__(self, tracer, name, host, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.host = host
+        self.category = category
+        self.args = args
+        self.wait = 0.0
+        self.parent = _currentSpan.get()
+        self.start = None
+        self._token = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self._token = _currentSpan.set(self)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        end = time.perf_counter()
+        _currentSpan.reset(self._token)
+        if excType is not None:
+            self.args['error'] = repr(excValue)
+        if self.category == 'http':
+            self.tracer.add_wait(self.parent, end - self.start)
+        args = dict(self.args, bmcWaitMs=round(self.wait * 1000, 3)) if self.category != 'http' else self.args
+        self.tracer.add(self.name, self.host, self.category, self.start, end, args)
+        return False
+
+
+class _NoSpan(object):
+    # Context of span when tracing is off
+    def __enter__(self):
+        return None
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Tracer(object):
+    ''' Collects the spans of the process as Chrome trace events and writes
+    them to path.'''
+
+    def __init__(self, path, maxEvents=MAX_EVENTS):
+        self.path = path
+        self.maxEvents = maxEvents
+        self.dropped = 0
+        self._origin = time.perf_counter()
+        self._events = []
+        self._pids = {}
+        self._tids = {}
+        self._lock = threading.Lock()
+
+    def _ids(self, host, lane):
+        # Called with the lock held
+        pid = self._pids.get(host)
+        if pid is None:
+            pid = self._pids[host] = len(self._pids) + 1
+            self._events.append({'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': 0,
+                                 'args': {'name': host}})
+        tid = self._tids.get((pid, lane))
+        if tid is None:
+            tid = self._tids[(pid, lane)] = len([key for key in self._tids if key[0] == pid]) + 1
+            name = lane if isinstance(lane, str) else '{} {}'.format(lane[0], tid)
+            self._events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        return pid, tid
+
+    def add(self, name, host, category, start, end, args=None, lane=None):
+        ''' Adds a finished span, start and end in time.perf_counter seconds.
+        lane names the track of the span, the current thread or task by
+        default.'''
+
+        lane = lane or _lane()
+        with self._lock:
+            if len(self._events) >= self.maxEvents:
+                self.dropped += 1
+                return
+            pid, tid = self._ids(host, lane)
+            self._events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                                 'ts': round((start - self._origin) * 1e6, 1),
+                                 'dur': round((end - start) * 1e6, 1), 'args': args or {}})
+
+    def add_wait(self, span, seconds):
+        with self._lock:
+            while span is not None:
+                span.wait += seconds
+                span = span.parent
+
+    def save(self):
+        ''' Writes the trace atomically.'''
+
+        with self._lock:
+            trace = {'traceEvents': list(self._events), 'displayTimeUnit': 'ms',
+                     'otherData': {'droppedEvents': self.dropped}}
+        tmpPath = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.get_ident())
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(tmpPath, 'w') as traceFile:
+            json.dump(trace, traceFile)
+        os.replace(tmpPath, self.path)
+
+
+# Tracer of the process, None when tracing is off
+_tracer = None
+
+
+def trace_to(path):
+    ''' Traces the healthchecks from now on, export writes the trace to path.
+    None stops tracing.'''
+
+    global _tracer
+    _tracer = Tracer(path) if path else None
+
+
+def tracing():
+    return _tracer is not None
+
+
+def export():
+    ''' Writes the trace, if tracing.'''
+
+    if _tracer is not None:
+        _tracer.save()
+
+
+def span(name, host, category='phase', **args):
+    ''' Context manager timing a span of the trace of host, nested in the
+    span the code runs in. Yields the Span, None when tracing is off.'''
+
+    if _tracer is None or host is None:
+        return _NO_SPAN
+    return Span(_tracer, name, host, category, args)
+
+
+def add_span(name, host, category, start, end, lane=None, **args):
+    ''' Adds a span measured by the caller (time.perf_counter seconds).'''
+
+    if _tracer is not None and host is not None:
+        _tracer.add(name, host, category, start, end, args, lane)
+
+
+def in_context(function):
+    ''' function running in a copy of the current context, so spans started
+    by another thread nest in the current span. function itself when tracing
+    is off.'''
+
+    if _tracer is None:
+        return function
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
+
+
+class TracedConnection(object):
+    ''' Wraps a redfish client so that every GET is an http span of the trace
+    of host. Everything but get is passed through to the wrapped
+    connection.'''
+
+    def __init__(self, connection, host):
+        self.connection = connection
+        self.host = host
+
+    def get(self, path, *args, **kwargs):
+        with span('GET ' + path, self.host, 'http') as request:
+            response = self.connection.get(path, *args, **kwargs)
+            if request is not None:
+                request.args['status'] = response.status
+            return response
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class AsyncTracedConnection(TracedConnection):
+    ''' Same as TracedConnection, for an async_redfish client.'''
+
+    async def get(self, path, *args, **kwargs):
+        with span('GET ' + path, self.host, 'http') as request:
+            response = await self.connection.get(path, *args, **kwargs)
+            if request is not None:
+                request.args['status'] = response.status
+            return response
+
+
+def traced(connection, host=None):
+    ''' Returns the connection wrapped in a TracedConnection when tracing, the
+    connection itself otherwise.'''
+
+    if _tracer is None or fanout.find_wrapper(connection, TracedConnection) is not None:
+        return connection
+    host = host or connection.base_url
+    if asyncio.iscoroutinefunction(connection.get):
+        return AsyncTracedConnection(connection, host)
+    return TracedConnection(connection, host)
+
+
+def host_of(connection):
+    ''' Host of the trace of a traced connection, None otherwise.'''
+
+    tracedConnection = fanout.find_wrapper(connection, TracedConnection)
+    return tracedConnection.host if tracedConnection is not None else None
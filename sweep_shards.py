@@ -0,0 +1,438 @@
+''' Sharded sweeps: the servers of servers.json split across worker
+processes, on this machine or on several, through a lease based work queue.
+
+    coordinator   puts every server of the sweep in the queue, assigned to
+                  a shard (worker) by consistent hashing of its key, starts
+                  the local workers and merges the results into one sink
+    workers       lease a server whenever one of their checks ends, their
+                  own shard first, check it (serversHC.check_server) and
+                  store the result in the queue; the leases of the servers
+                  they are checking are renewed while they work
+
+Consistent hashing keeps a server on the same worker from sweep to sweep,
+so the session, ETag and topology caches of that node stay warm, and adding
+a worker only moves its share of the servers. A worker that dies stops
+renewing its leases: they expire after LEASE_TIME and its servers are leased
+by the others, which also take the pending servers of other shards once
+their own is done.
+
+The queue is an SQLite database (WorkQueue), for one machine or a shared
+filesystem. Every node needs the same inventory (servers.json, or the file
+given with --servers).
+
+    python sweep_shards.py run --workers 4 --output "hc history.db"
+    python sweep_shards.py run --workers 2 --remote node2 --remote node3
+    python sweep_shards.py work --worker node2          (on node2)
+'''
+
+import os
+import sys
+import json
+import time
+import bisect
+import sqlite3
+import hashlib
+import argparse
+import threading
+import contextlib
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import serversHC
+import fleet_sweep
+import host_guard
+import result_sinks
+
+# Work queue of the sweeps
+QUEUE_DB = 'hc queue.db'
+# Logs of the local workers
+LOG_DIR = 'hc shards'
+# Seconds a lease lasts, renewed every third of it while the worker runs
+LEASE_TIME = 120
+# Servers leased at once by a worker
+LEASE_BATCH = fleet_sweep.MAX_WORKERS
+# A worker done with its shard leases this fraction of a batch from the others
+STEAL_SHARE = 4
+# Leases of a server that expired before it is given up
+MAX_ATTEMPTS = 3
+# Points of each worker on the hash ring
+REPLICAS = 64
+# Seconds between two looks at the queue
+POLL_INTERVAL = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sweeps (
+    sweep INTEGER PRIMARY KEY AUTOINCREMENT,
+    shards TEXT NOT NULL,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS work (
+    sweep INTEGER NOT NULL,
+    server TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    shard TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    leasedUntil REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    PRIMARY KEY (sweep, server)
+);
+CREATE INDEX IF NOT EXISTS work_state ON work (sweep, state, shard);
+'''
+
+
+def _hash(key):
+    return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    ''' Consistent hashing of the server keys on the workers, each worker
+    holding replicas points of the ring.'''
+
+    def __init__(self, workers, replicas=REPLICAS):
+        self.workers = list(workers)
+        self._ring = sorted((_hash('{}#{}'.format(worker, index)), worker)
+                            for worker in self.workers for index in range(replicas))
+        self._points = [point for point, _ in self._ring]
+
+    def worker(self, key):
+        ''' Worker owning a server key.'''
+
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._ring[index][1]
+
+
+class WorkQueue(object):
+    ''' Lease based queue of the servers of the sweeps, in an SQLite
+    database shared by the coordinator and the workers. A server is pending,
+    leased by a worker until leasedUntil, done (with its result) or failed.'''
+
+    def __init__(self, path=QUEUE_DB):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Write transaction, taken at once so two workers never lease the
+        # same servers
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def new_sweep(self, servers, shards):
+        ''' Queues a sweep of the servers, each assigned to a shard of the
+        hash ring.
+
+        Input: server keys, in inventory order, and worker names
+        Output: sweep id'''
+
+        ring = HashRing(shards)
+        with self._transaction() as db:
+            sweep = db.execute('INSERT INTO sweeps (shards, started) VALUES (?, ?)',
+                               (json.dumps(list(shards)), time.time())).lastrowid
+            db.executemany("INSERT INTO work (sweep, server, position, shard, state) VALUES (?, ?, ?, ?, 'pending')",
+                           [(sweep, server, position, ring.worker(server))
+                            for position, server in enumerate(servers)])
+        return sweep
+
+    def latest_sweep(self):
+        rows = self._query('SELECT MAX(sweep) FROM sweeps')
+        return rows[0][0]
+
+    def lease(self, sweep, worker, count=LEASE_BATCH, leaseTime=LEASE_TIME):
+        ''' Leases up to count servers of the shard of the worker: pending
+        ones or expired leases. When the shard has none left, up to
+        count // STEAL_SHARE servers of the other shards are leased, so the
+        workers finish together without taking over each other's shards.
+        Servers whose lease expired MAX_ATTEMPTS times are failed instead.
+
+        Output: list of server keys'''
+
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("UPDATE work SET state = 'failed', error = 'lease expired ' || attempts || ' times' "
+                       "WHERE sweep = ? AND state = 'leased' AND leasedUntil < ? AND attempts >= ?",
+                       (sweep, now, MAX_ATTEMPTS))
+            available = "SELECT server FROM work WHERE sweep = ? AND (state = 'pending' OR " \
+                        "(state = 'leased' AND leasedUntil < ?)) AND shard {} ? ORDER BY position LIMIT ?"
+            servers = [row[0] for row in db.execute(available.format('='), (sweep, now, worker, count))]
+            if not servers:
+                servers = [row[0] for row in db.execute(available.format('!='),
+                                                        (sweep, now, worker, max(1, count // STEAL_SHARE)))]
+            db.executemany("UPDATE work SET state = 'leased', worker = ?, leasedUntil = ?, attempts = attempts + 1 "
+                           "WHERE sweep = ? AND server = ?",
+                           [(worker, now + leaseTime, sweep, server) for server in servers])
+        return servers
+
+    def renew(self, sweep, worker, servers, leaseTime=LEASE_TIME):
+        ''' Extends the leases of the worker on servers, the ones it is still
+        checking.'''
+
+        leasedUntil = time.time() + leaseTime
+        with self._transaction() as db:
+            db.executemany("UPDATE work SET leasedUntil = ? "
+                           "WHERE sweep = ? AND server = ? AND worker = ? AND state = 'leased'",
+                           [(leasedUntil, sweep, server, worker) for server in servers])
+
+    def complete(self, sweep, server, worker, result):
+        ''' Stores the result of a server. A late result of a worker whose
+        lease expired still counts, unless another worker finished first.'''
+
+        with self._transaction() as db:
+            db.execute("UPDATE work SET state = 'done', worker = ?, result = ?, error = NULL "
+                       "WHERE sweep = ? AND server = ? AND state != 'done'",
+                       (worker, json.dumps(result), sweep, server))
+
+    def fail(self, sweep, server, worker, error):
+        with self._transaction() as db:
+            db.execute("UPDATE work SET state = 'failed', worker = ?, error = ? "
+                       "WHERE sweep = ? AND server = ? AND state != 'done'",
+                       (worker, error, sweep, server))
+
+    def progress(self, sweep):
+        ''' Number of servers of the sweep per state.'''
+
+        counts = dict.fromkeys(('pending', 'leased', 'done', 'failed'), 0)
+        counts.update(self._query('SELECT state, COUNT(*) FROM work WHERE sweep = ? GROUP BY state', (sweep,)))
+        return counts
+
+    def remaining(self, sweep):
+        counts = self.progress(sweep)
+        return counts['pending'] + counts['leased']
+
+    def outcomes(self, sweep):
+        ''' Servers of the sweep in inventory order, with their result (None
+        when failed), error and worker.'''
+
+        return [(server, json.loads(result) if result else None, error, worker) for server, result, error, worker
+                in self._query('SELECT server, result, error, worker FROM work WHERE sweep = ? ORDER BY position',
+                               (sweep,))]
+
+    def close(self):
+        self._db.close()
+
+
+class QueueSink(object):
+    ''' Result sink (see result_sinks) storing the healthchecks of a worker
+    in the queue, for the coordinator to merge.'''
+
+    usesStdout = False
+
+    def __init__(self, queue, sweep, worker):
+        self.queue = queue
+        self.sweep = sweep
+        self.worker = worker
+        self.name = '{} (sweep {})'.format(queue.path, sweep)
+
+    def write(self, server, serverHC):
+        self.queue.complete(self.sweep, server, self.worker, serverHC)
+
+    def close(self):
+        pass
+
+
+def run_worker(worker, sweep=None, path=QUEUE_DB, maxWorkers=fleet_sweep.MAX_WORKERS,
+               maxSubnetWorkers=fleet_sweep.MAX_SUBNET_WORKERS, serversFile=serversHC.SERVERS_FILE):
+    ''' Checks servers of a sweep (the latest by default) until none is left
+    to lease and no other worker holds one. Up to maxWorkers servers are
+    checked at once, at most maxSubnetWorkers per subnet (see fleet_sweep),
+    and a server is leased whenever a check ends, so a slow host only holds
+    its own slot. The servers are looked up in serversFile, the inventory
+    the coordinator queued them from.
+
+    Input: worker name, sweep id, queue database, concurrency of the
+    checks, inventory file
+    Output: number of servers checked'''
+
+    servers = serversHC.load_servers(serversFile) or {}
+    maxWorkers = max(1, maxWorkers)
+    maxSubnetWorkers = max(1, maxSubnetWorkers or maxWorkers)
+    queue = WorkQueue(path)
+    sweep = sweep or queue.latest_sweep()
+    sink = QueueSink(queue, sweep, worker)
+    subnetBusy = Counter()
+    # Leased servers waiting for their subnet
+    waiting = []
+    running = {}
+    checked = 0
+    renewed = time.monotonic()
+
+    def subnet(server):
+        return fleet_sweep.subnet_key(servers[server]['systemUrl'])
+
+    def check(server):
+        start = time.monotonic()
+        serversHC.check_server(server, servers[server], sink)
+        print('Finished {} in {:.1f}s'.format(server, time.monotonic() - start))
+
+    try:
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            while True:
+                free = maxWorkers - len(running) - len(waiting)
+                if free > 0:
+                    for server in queue.lease(sweep, worker, free):
+                        if server in servers:
+                            waiting.append(server)
+                        else:
+                            queue.fail(sweep, server, worker, 'not in the inventory of ' + worker)
+                for server in list(waiting):
+                    if subnetBusy[subnet(server)] >= maxSubnetWorkers:
+                        continue
+                    waiting.remove(server)
+                    subnetBusy[subnet(server)] += 1
+                    running[executor.submit(check, server)] = server
+                if not running:
+                    if not queue.remaining(sweep):
+                        break
+                    # The rest is leased by other workers, theirs may expire
+                    time.sleep(POLL_INTERVAL)
+                    continue
+
+                # Wake up to renew the leases and to lease expired ones
+                done, _ = wait(running, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    server = running.pop(future)
+                    subnetBusy[subnet(server)] -= 1
+                    checked += 1
+                    try:
+                        future.result()
+                    except Exception as e:
+                        sys.stderr.write('ERROR: {} failed: {!r}\n'.format(server, e))
+                        # Failed hosts already wrote their failure result
+                        if not isinstance(e, host_guard.HostFailure):
+                            queue.fail(sweep, server, worker, repr(e))
+                if done:
+                    print('{}: {} servers checked, sweep {}: {}'.format(worker, checked, sweep, queue.progress(sweep)))
+                if time.monotonic() - renewed >= LEASE_TIME / 3:
+                    queue.renew(sweep, worker, list(running.values()) + waiting)
+                    renewed = time.monotonic()
+    finally:
+        queue.close()
+    return checked
+
+
+def start_worker(worker, sweep, path=QUEUE_DB, maxWorkers=fleet_sweep.MAX_WORKERS,
+                 maxSubnetWorkers=fleet_sweep.MAX_SUBNET_WORKERS, logDir=LOG_DIR, serversFile=serversHC.SERVERS_FILE):
+    ''' Starts a worker in a new python process, its output going to
+    logDir/worker.log.
+
+    Output: subprocess.Popen'''
+
+    os.makedirs(logDir, exist_ok=True)
+    with open(os.path.join(logDir, worker + '.log'), 'a') as log:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--db', path, 'work', '--worker', worker,
+                                 '--sweep', str(sweep), '--max-workers', str(maxWorkers),
+                                 '--subnet-workers', str(maxSubnetWorkers), '--servers', os.path.abspath(serversFile)],
+                                stdout=log, stderr=subprocess.STDOUT)
+
+
+def merge(queue, sweep, servers, sink):
+    ''' Writes the results of a sweep to sink, in inventory order. Servers
+    that failed without a result get a failure result.
+
+    Output: tuple with the healthchecks and the errors, keyed by server'''
+
+    results = {}
+    errors = {}
+    for server, result, error, worker in queue.outcomes(sweep):
+        if result is None:
+            failure = RuntimeError('{} ({})'.format(error or 'not checked', worker))
+            systemUrl = servers.get(server, {}).get('systemUrl')
+            result = host_guard.failure_result(server, systemUrl, failure)
+        if 'Failure' in result:
+            errors[server] = result['Failure']
+        else:
+            results[server] = result
+        sink.write(server, result)
+    return (results, errors)
+
+
+def coordinate(workers=2, remote=(), sink=None, path=QUEUE_DB, serversFile=serversHC.SERVERS_FILE,
+               maxWorkers=fleet_sweep.MAX_WORKERS, maxSubnetWorkers=fleet_sweep.MAX_SUBNET_WORKERS):
+    ''' Runs a sharded sweep: queues the servers on the hash ring of the
+    local and remote workers, starts the local ones, waits for the sweep and
+    merges its results into sink (see result_sinks, 'hc dump' by default),
+    which is closed at the end. When all the local workers are gone with
+    servers left, the coordinator checks them itself.
+
+    Input: number of local workers, names of the remote workers, sink,
+    queue database, inventory file, also read by the local workers (the
+    remote ones are given theirs with work --servers), concurrency of each
+    local worker
+    Output: tuple with the healthchecks and the errors, keyed by server'''
+
+    servers = serversHC.load_servers(serversFile) or {}
+    if sink is None:
+        sink = result_sinks.open_sink()
+    queue = WorkQueue(path)
+    try:
+        with result_sinks.progress_output(sink):
+            local = ['worker{}'.format(index + 1) for index in range(workers)]
+            sweep = queue.new_sweep(list(servers), local + list(remote))
+            print('Sweep {}: {} servers on {} workers'.format(sweep, len(servers), len(local) + len(remote)))
+            children = [start_worker(worker, sweep, path, maxWorkers, maxSubnetWorkers, serversFile=serversFile)
+                        for worker in local]
+            while queue.remaining(sweep):
+                if all(child.poll() is not None for child in children) and not remote:
+                    print('No worker left, checking the remaining servers')
+                    run_worker('coordinator', sweep, path, maxWorkers, maxSubnetWorkers, serversFile)
+                    break
+                time.sleep(POLL_INTERVAL)
+            for child in children:
+                child.wait()
+            print('Sweep {}: {}'.format(sweep, queue.progress(sweep)))
+            return merge(queue, sweep, servers, sink)
+    finally:
+        queue.close()
+        sink.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep servers.json with several worker processes or nodes.')
+    parser.add_argument('--db', default=QUEUE_DB, help='work queue database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='coordinate a sweep')
+    run.add_argument('--workers', type=int, default=2, help='local worker processes')
+    run.add_argument('--remote', action='append', default=[],
+                     help='worker on another node (see work), can be repeated')
+    run.add_argument('--output', action='append',
+                     help="sink target (see result_sinks.open_sink), can be repeated, default 'hc dump'")
+    run.add_argument('--max-workers', type=int, default=fleet_sweep.MAX_WORKERS, help='hosts at once per worker')
+    run.add_argument('--subnet-workers', type=int, default=fleet_sweep.MAX_SUBNET_WORKERS)
+    run.add_argument('--servers', default=serversHC.SERVERS_FILE, help='inventory file')
+    work = commands.add_parser('work', help='check servers of a sweep')
+    work.add_argument('--worker', required=True, help='worker name, as given to run --remote')
+    work.add_argument('--sweep', type=int, help='sweep id (the latest)')
+    work.add_argument('--max-workers', type=int, default=fleet_sweep.MAX_WORKERS, help='hosts at once')
+    work.add_argument('--subnet-workers', type=int, default=fleet_sweep.MAX_SUBNET_WORKERS)
+    work.add_argument('--servers', default=serversHC.SERVERS_FILE,
+                      help='inventory file, with the servers of the coordinator')
+    args = parser.parse_args(argv)
+
+    if args.command == 'work':
+        run_worker(args.worker, args.sweep, args.db, args.max_workers, args.subnet_workers, args.servers)
+        return 0
+    results, errors = coordinate(args.workers, args.remote, result_sinks.open_sink(args.output or result_sinks.HC_DIR),
+                                 args.db, args.servers, args.max_workers, args.subnet_workers)
+    print('{} servers checked, {} failed'.format(len(results), len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+import os
+import json
+import hashlib
+import threading
+
+import fanout
+
+# HC uris of each topology, one file per vendor, model, firmware and fingerprint
+TOPOLOGY_DIR = 'hc topology'
+# Template uris GET to check that a server really has the cached topology
+CHECK_SAMPLES = 3
+
+
+class TopologyCache(object):
+    ''' On-disk map from a server topology to the HC uris found by crawling
+    one server of that topology. Servers of the same model and firmware
+    with the same member counts have the same Redfish tree, so they inherit
+    the uris instead of being crawled. Files are written atomically.'''
+
+    def __init__(self, directory=TOPOLOGY_DIR):
+        self.directory = directory
+
+    def _path(self, key):
+        name = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def load(self, key):
+        ''' Returns the HC uris stored for the topology, None if there are
+        none.'''
+
+        try:
+            with open(self._path(key)) as topologyFile:
+                return json.load(topologyFile)['HC_uris']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, key, hcUris):
+        path = self._path(key)
+        tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmpPath, 'w') as topologyFile:
+                json.dump({'topology': key, 'HC_uris': hcUris}, topologyFile, indent=2)
+            os.replace(tmpPath, path)
+        except OSError:
+            pass
+
+    def discard(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+_defaultCache = None
+_defaultLock = threading.Lock()
+
+
+def default_cache():
+    ''' Cache shared by all the discoveries of the process.'''
+
+    global _defaultCache
+    with _defaultLock:
+        if _defaultCache is None:
+            _defaultCache = TopologyCache()
+    return _defaultCache
+
+
+def _member_count(response):
+    if response.status != 200:
+        return None
+    data = response.dict
+    if 'Members@odata.count' in data:
+        return data['Members@odata.count']
+    return len(data.get('Members', []))
+
+
+def server_topology(connection, vendor, systemUri, managerUri, collectionUris):
+    ''' Identifies the topology of a server: vendor, model, BMC firmware and
+    the member counts of the collections telling servers of the same model
+    apart (memory, processors, controllers...). All the GETs run in
+    parallel.
+
+    Input: redfish connection, vendor, system and manager uris, collection
+    uris of the fingerprint
+    Output: dictionary with the topology, the key of the cache'''
+
+    responses = fanout.get_all(fanout.bounded(connection), [systemUri, managerUri] + list(collectionUris))
+    system, manager = responses[0].dict, responses[1].dict
+    return {'vendor': vendor,
+            'model': system.get('Model'),
+            'firmware': manager.get('FirmwareVersion'),
+            'fingerprint': {uri: _member_count(response)
+                            for uri, response in zip(collectionUris, responses[2:])}}
+
+
+def check_template(connection, hcUris, samples=CHECK_SAMPLES):
+    ''' True when a few uris spread over the template exist on the server.'''
+
+    if not hcUris:
+        return False
+    step = max(1, len(hcUris) // samples)
+    sampled = hcUris[step - 1::step][:samples]
+    return all(response.status == 200 for response in fanout.get_all(fanout.bounded(connection), sampled))
+
+
+def discover(connection, topology, crawl, cache=None):
+    ''' Returns the HC uris of a server. A server whose topology is cached
+    inherits its uris once check_template agrees, otherwise crawl() maps the
+    server and the result becomes the template of the topology.
+
+    Input: redfish connection, topology from server_topology, crawl function
+    returning the HC uris
+    Output: list of HC uris'''
+
+    if cache is None:
+        cache = default_cache()
+    hcUris = cache.load(topology)
+    if hcUris is not None:
+        if check_template(connection, hcUris):
+            print('Using the HC uris of', topology['model'], topology['firmware'])
+            return hcUris
+        cache.discard(topology)
+    hcUris = crawl()
+    cache.save(topology, hcUris)
+    return hcUris
@@ -0,0 +1,371 @@
+''' Record and replay of the Redfish traffic of a healthcheck, to reproduce
+the behaviour of a firmware away from the hardware.
+
+Recording wraps the client opened by serversHC.open_connection: every GET
+sent to the BMC is kept with its status, headers, body and timing, and the
+archive of the server (gzipped json lines) is written when its healthcheck
+ends. Replay serves an archive as a connection for the vendor
+build_healthcheck functions, at full speed or with the recorded latency,
+without any network.
+
+    python traffic_capture.py record --host server1
+    python traffic_capture.py replay "hc captures/10.0.0.5-20240101-120000.ndjson.gz" --timing
+    python traffic_capture.py replay <archive> --repeat 100 --profile
+'''
+
+import os
+import sys
+import json
+import gzip
+import time
+import asyncio
+import argparse
+import threading
+from collections import deque
+
+import fanout
+import etag_cache
+import projection
+import async_redfish
+import session_cache
+
+# Archives of the recorded healthchecks, one per server and sweep
+CAPTURE_DIR = 'hc captures'
+ARCHIVE_FORMAT = 'redfish-capture'
+ARCHIVE_VERSION = 1
+# Never written to an archive
+SECRET_HEADERS = ('x-auth-token', 'set-cookie', 'authorization')
+
+# Directory the connections of serversHC are recorded to, None when off
+_recordDirectory = None
+
+
+def record_to(directory=CAPTURE_DIR):
+    ''' Records the servers checked by serversHC from now on into directory,
+    None stops recording.'''
+
+    global _recordDirectory
+    _recordDirectory = directory
+
+
+def _headers(response):
+    try:
+        headers = response.getheaders()
+    except (AttributeError, TypeError):
+        return {}
+    return {key.lower(): value for key, value in dict(headers or {}).items()
+            if key.lower() not in SECRET_HEADERS}
+
+
+def _request_kwargs(args, headers):
+    kwargs = {}
+    if args:
+        kwargs['args'] = args
+    if headers:
+        kwargs['headers'] = headers
+    return kwargs
+
+
+class RecordingConnection(object):
+    ''' Wraps a redfish client and keeps every GET with its response and
+    timing, until finish writes them to the archive. It sits right on the
+    client, so the archive holds what went over the wire: $select and
+    $expand queries, conditional requests. The body of a 304 comes from the
+    ETag store, so a replay does not depend on the cache of the recording.
+    Everything but get is passed through to the wrapped connection.'''
+
+    def __init__(self, connection, host, directory=CAPTURE_DIR):
+        self.connection = connection
+        self.host = host
+        self.directory = directory
+        self.started = time.time()
+        self._start = time.monotonic()
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def record(self, path, args, start, response):
+        entry = {'time': round(start - self._start, 6), 'duration': round(time.monotonic() - start, 6),
+                 'method': 'GET', 'uri': path, 'args': args, 'status': response.status,
+                 'headers': _headers(response), 'body': response.read or ''}
+        if response.status == 304:
+            stored = etag_cache.default_store().load(self.host, path)
+            if stored is not None:
+                entry['body'] = json.dumps(stored[1])
+        with self._lock:
+            self._entries.append(entry)
+
+    def get(self, path, args=None, headers=None):
+        start = time.monotonic()
+        response = self.connection.get(path, **_request_kwargs(args, headers))
+        self.record(path, args, start, response)
+        return response
+
+    def header(self):
+        root = getattr(self.connection, 'root', None)
+        return {'format': ARCHIVE_FORMAT, 'version': ARCHIVE_VERSION, 'host': self.host,
+                'recorded': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                'root': root.dict if root is not None else None}
+
+    def save(self):
+        ''' Writes the archive, atomically, and returns its path.'''
+
+        name = '{}-{}.ndjson.gz'.format(self.host.split('://')[-1].rstrip('/').replace(':', '_').replace('/', '_'),
+                                        time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started)))
+        path = os.path.join(self.directory, name)
+        tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, gzip.open(tmpPath, 'wt') as archive:
+            for entry in [self.header()] + self._entries:
+                archive.write(json.dumps(entry) + '\n')
+        os.replace(tmpPath, path)
+        return path
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class AsyncRecordingConnection(RecordingConnection):
+    ''' Same as RecordingConnection, for an async_redfish client.'''
+
+    async def get(self, path, args=None, headers=None):
+        start = time.monotonic()
+        response = await self.connection.get(path, **_request_kwargs(args, headers))
+        self.record(path, args, start, response)
+        return response
+
+
+def recorded(connection, host=None, directory=None):
+    ''' Returns the connection wrapped in a recorder writing to directory
+    (the one set by record_to by default), or the connection itself when
+    recording is off.'''
+
+    directory = directory or _recordDirectory
+    if directory is None or fanout.find_wrapper(connection, RecordingConnection) is not None:
+        return connection
+    host = host or connection.base_url
+    if asyncio.iscoroutinefunction(connection.get):
+        return AsyncRecordingConnection(connection, host, directory)
+    return RecordingConnection(connection, host, directory)
+
+
+def finish(connection):
+    ''' Writes the archive of a recorded connection.
+
+    Output: path of the archive, None when the connection is not recorded'''
+
+    recorder = fanout.find_wrapper(connection, RecordingConnection)
+    if recorder is None:
+        return None
+    path = recorder.save()
+    print('Traffic recorded to', path)
+    return path
+
+
+def load_archive(path):
+    ''' Reads an archive.
+
+    Output: tuple with the header and the list of recorded requests'''
+
+    with gzip.open(path, 'rt') as archive:
+        header = json.loads(archive.readline())
+        if header.get('format') != ARCHIVE_FORMAT:
+            raise ValueError('{} is not a {} archive'.format(path, ARCHIVE_FORMAT))
+        return header, [json.loads(line) for line in archive if line.strip()]
+
+
+class _NoStore(object):
+    # ETag store of a replay: the archive already holds every body
+    def load(self, host, uri):
+        return None
+
+    def save(self, host, uri, etag, resource):
+        pass
+
+    def discard(self, host, uri):
+        pass
+
+
+class ReplayConnection(object):
+    ''' Connection answering the GETs from an archive. Each uri gets its
+    recorded responses in order, the last one again when the healthcheck
+    asks more often than it did while recording; a uri never recorded gets
+    a 404. With speed, every answer waits for its recorded duration divided
+    by speed (1 is the original timing), otherwise replay is at full speed.
+    Recorded 304s are answered with their full body.'''
+
+    def __init__(self, header, entries, speed=None):
+        self.base_url = header['host']
+        self.root = async_redfish.RedfishResponse(200, {}, json.dumps(header['root']).encode(), fanout.ROOT_URI) \
+            if header.get('root') is not None else None
+        self.speed = speed
+        self.requests = 0
+        self.missing = []
+        self._responses = {}
+        for entry in entries:
+            self._responses.setdefault(session_cache.cache_key(entry['uri'], entry['args']), deque()).append(entry)
+        self._lock = threading.Lock()
+
+    def answer(self, path, args):
+        ''' Next recorded entry of the uri, None when it was never recorded.'''
+
+        with self._lock:
+            self.requests += 1
+            queue = self._responses.get(session_cache.cache_key(path, args))
+            if not queue:
+                self.missing.append(path)
+                return None
+            return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def response(self, path, entry):
+        if entry is None:
+            return async_redfish.RedfishResponse(404, {}, json.dumps(
+                {'error': {'message': 'not in the archive: ' + path}}).encode(), path)
+        status = 200 if entry['status'] == 304 and entry['body'] else entry['status']
+        return async_redfish.RedfishResponse(status, entry['headers'], entry['body'].encode(), path)
+
+    def delay(self, entry):
+        return entry['duration'] / self.speed if self.speed and entry is not None else 0
+
+    def get(self, path, args=None, headers=None):
+        entry = self.answer(path, args)
+        if self.delay(entry):
+            time.sleep(self.delay(entry))
+        return self.response(path, entry)
+
+    def login(self):
+        pass
+
+    def logout(self):
+        pass
+
+
+class AsyncReplayConnection(ReplayConnection):
+    ''' Same as ReplayConnection, for the async healthchecks.'''
+
+    async def get(self, path, args=None, headers=None):
+        entry = self.answer(path, args)
+        if self.delay(entry):
+            await asyncio.sleep(self.delay(entry))
+        return self.response(path, entry)
+
+    async def login(self):
+        pass
+
+    async def logout(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def replay_connection(path, speed=None, asynchronous=False):
+    ''' Connection replaying an archive, ready for the vendor healthchecks.
+    It is revalidated against an empty ETag store, so nothing is written to
+    the cache of the real sweeps.
+
+    Input: archive path, replay speed (None for full speed), async or not
+    Output: connection'''
+
+    header, entries = load_archive(path)
+    connection = (AsyncReplayConnection if asynchronous else ReplayConnection)(header, entries, speed)
+    return etag_cache.conditional(connection, header['host'], _NoStore())
+
+
+def replay_stats(connection):
+    ''' Returns a (requests, uris missing from the archive) tuple.'''
+
+    replay = fanout.find_wrapper(connection, ReplayConnection)
+    return (replay.requests, list(replay.missing))
+
+
+def replay_healthcheck(path, speed=None, asynchronous=False):
+    ''' Rebuilds the healthcheck of a recorded server, the same way
+    serversHC.check_server did while recording.
+
+    Output: dictionary with the healthcheck of the server'''
+
+    import serversHC
+
+    async def build(connection, serverType):
+        serverInfo = (await connection.get(serverType[1])).dict
+        return await serversHC.build_healthcheck_async(connection, serverInfo['HostName'], connection.base_url,
+                                                       serverType[0])
+
+    connection = session_cache.cached(projection.projected(
+        replay_connection(path, speed, asynchronous), serversHC.FIELDS))
+    oem = connection.root.dict['Oem'] if connection.root is not None else {}
+    if 'Hp' in oem or 'Hpe' in oem:
+        serverType = ('HP', serversHC.ILOSYS_URI)
+    elif 'Dell' in oem:
+        serverType = ('Dell', serversHC.IDRACSYS_URI)
+    else:
+        raise ValueError('Unknown server in ' + path)
+    if asynchronous:
+        serverHC = asyncio.run(build(connection, serverType))
+    else:
+        serverInfo = connection.get(serverType[1]).dict
+        serverHC = serversHC.build_healthcheck(connection, serverInfo['HostName'], connection.base_url,
+                                               serverType[0])
+    requests, missing = replay_stats(connection)
+    if missing:
+        sys.stderr.write('WARNING: {} of {} requests not in {}: {}\n'.format(
+            len(missing), requests, path, ', '.join(sorted(set(missing)))))
+    return serverHC
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Record or replay the Redfish traffic of healthchecks.')
+    commands = parser.add_subparsers(dest='command')
+    record = commands.add_parser('record', help='check servers of servers.json and record their traffic')
+    record.add_argument('--host', action='append', help='server key, can be repeated (all the servers)')
+    record.add_argument('--directory', default=CAPTURE_DIR)
+    record.add_argument('--async', dest='asynchronous', action='store_true', help='use the async sweep')
+    replay = commands.add_parser('replay', help='rebuild healthchecks from archives')
+    replay.add_argument('archives', nargs='+')
+    replay.add_argument('--timing', action='store_true', help='wait the recorded latency of every request')
+    replay.add_argument('--speed', type=float, help='recorded latency divided by this (implies --timing)')
+    replay.add_argument('--async', dest='asynchronous', action='store_true', help='replay the async healthchecks')
+    replay.add_argument('--repeat', type=int, default=1, help='replays of every archive')
+    replay.add_argument('--profile', action='store_true', help='print a cProfile of the replays')
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        import serversHC
+        servers = serversHC.load_servers()
+        if args.host:
+            unknown = [host for host in args.host if host not in servers]
+            if unknown:
+                parser.error('not in servers.json: ' + ', '.join(unknown))
+            servers = {host: servers[host] for host in args.host}
+        # Run as a script this module is __main__, serversHC records through
+        # the imported traffic_capture
+        import traffic_capture
+        traffic_capture.record_to(args.directory)
+        sweep = serversHC.create_hcfiles_async if args.asynchronous else serversHC.create_hcfiles
+        results, errors = sweep(servers=servers)
+        return 1 if errors else 0
+
+    if args.command != 'replay':
+        parser.print_help()
+        return 2
+    speed = args.speed or (1.0 if args.timing else None)
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    for path in args.archives:
+        start = time.monotonic()
+        for _ in range(args.repeat):
+            serverHC = replay_healthcheck(path, speed, args.asynchronous)
+        print('Replayed {} {} time(s) in {:.3f}s'.format(path, args.repeat, time.monotonic() - start))
+        print(json.dumps(serverHC, indent=2))
+    if profiler is not None:
+        import pstats
+        profiler.disable()
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+from fnmatch import fnmatchcase
+
+import fanout
+
+# Requests sent at once to one BMC while crawling
+MAX_WORKERS = 8
+# Responses held in memory at once, a level can have thousands of uris
+BATCH_SIZE = 256
+# Uris followed, matched case insensitively (* matches anything, / included)
+INCLUDE_URIS = ['/redfish/v1*']
+# Schemas, message registries and log entries are thousands of uris without
+# any health status
+EXCLUDE_URIS = ['/redfish/v1/jsonschemas*', '/redfish/v1/registries*', '*/entries/*']
+
+
+def link_uris(data, lookupKey='@odata.id'):
+    ''' Yields every uri referenced in a resource, at any depth.'''
+
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key == lookupKey and isinstance(value, str):
+                yield value
+            else:
+                yield from link_uris(value, lookupKey)
+    elif isinstance(data, list):
+        for item in data:
+            yield from link_uris(item, lookupKey)
+
+
+def _matches(uri, patterns):
+    uri = uri.lower()
+    return any(fnmatchcase(uri, pattern.lower()) for pattern in patterns)
+
+
+def crawl(connection, startUris, visit=None, include=INCLUDE_URIS, exclude=EXCLUDE_URIS,
+          maxWorkers=MAX_WORKERS, follow=True):
+    ''' Breadth first crawl of a Redfish tree. Each level is fetched in
+    parallel (at most maxWorkers requests at once), every uri is fetched once:
+    the frontier is a set, and fragments (Thermal#/Fans/0) are the resource
+    they point into. The state lives in the call, so crawls of several
+    servers do not share anything.
+
+    Input: redfish connection, uris to start from, visit(uri, resource)
+    called with every fetched resource, include/exclude uri patterns,
+    whether the links of the fetched resources are followed
+    Output: list of the crawled uris, in breadth first order'''
+
+    connection = fanout.bounded(connection, maxWorkers)
+    seen = set()
+
+    def wanted(uris):
+        for uri in uris:
+            uri = uri.split('#')[0]
+            key = uri.rstrip('/').lower()
+            if key in seen or not _matches(uri, include) or _matches(uri, exclude):
+                continue
+            seen.add(key)
+            yield uri
+
+    crawled = []
+    level = list(wanted(startUris))
+    depth = 0
+    while level:
+        print('Parsing {} uris at depth {}'.format(len(level), depth))
+        nextLevel = []
+        for start in range(0, len(level), BATCH_SIZE):
+            batch = level[start:start + BATCH_SIZE]
+            for uri, response in zip(batch, fanout.get_all(connection, batch)):
+                crawled.append(uri)
+                data = response.dict
+                if visit is not None:
+                    visit(uri, data)
+                if follow:
+                    nextLevel += wanted(link_uris(data))
+        level = nextLevel
+        depth += 1
+    return crawled